@@ -12,13 +12,14 @@ setup(
     install_requires=[
         'click',
         'requests',
-        'sqlalchemy',
+        'sqlalchemy>=1.3.11',
         'Flask',
         'psycopg2',
         'pyroaring',
         'alembic',
         'lxml',
         'cssselect',
+        'numpy',
     ],
     tests_require=[
         'potstats2[test]',
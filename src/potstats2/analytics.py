@@ -1,330 +1,593 @@
 import datetime
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import re
+import resource
 import signal
 import select
 import sys
 import threading
+import traceback
 from urllib.parse import urlparse
 from queue import Queue
+from collections import namedtuple, Counter
 from time import perf_counter
 
 import click
-from sqlalchemy import bindparam, and_, func
+from sqlalchemy import func, or_
 from sqlalchemy.dialects.postgresql import insert
-from pyroaring import BitMap
+from pyroaring import BitMap, FrozenBitMap
 from lxml import html
+from lxml.cssselect import CSSSelector
 
-try:
-    import elasticsearch.helpers
-except ImportError:
-    pass
-
-from . import dal, config
+from . import dal, config, facts, inverted_index, profiling, search_index
 from .db import get_session, TierType, Thread
 from .db import Post, PostContent
-from .db import PostLinks, PostQuotes, LinkRelation, LinkType
-from .db import PosterStats, DailyStats, QuoteRelation
-from .db import MyModsUserStaging, UserTier, AccountState
-from .util import ElapsedProgressBar
+from .db import PostLinks, PostQuotes, PostSearch, AnalyzedPost, IndexedThread, LinkRelation, LinkType
+from .db import PosterStats, DailyStats, QuoteRelation, ActiveUserRollup
+from .db import MyModsUserStaging, User, UserTier, AccountState, DataVersion
+from .maintenance import maintain
+from .stages import Stage, run_stages, plan_stages
+from .util import ElapsedProgressBar, stream_query, chunk_query, copy_rows
 
 
 @click.command()
 @click.option('--skip-posts', is_flag=True, default=False)
-@click.option('--state-file', type=click.Path(dir_okay=False))
-def main(skip_posts, state_file):
+@click.option('--reanalyze', is_flag=True, default=False,
+              help='Analyze all posts and user profiles, not only new and edited ones.')
+@click.option('--itersize', default=10000, help='Number of posts fetched per round trip by each worker.')
+@click.option('--workers', type=click.IntRange(1), default=os.cpu_count(), help='Number of post analysis processes.')
+@click.option('--range-size', type=click.IntRange(1), default=20000,
+              help='Number of posts handed to a worker at a time.')
+@click.option('--sql-bakes', is_flag=True, default=False,
+              help='Bake statistics with SQL queries instead of from the post facts extract.')
+@click.option('--jobs', type=click.IntRange(1), default=os.cpu_count(),
+              help='Number of stages (bakes etc.) run concurrently.')
+@click.option('--force', metavar='STAGE', multiple=True,
+              help='Run STAGE even if its inputs did not change (repeatable, "all" for all stages).')
+@click.option('--dry-run', is_flag=True, default=False,
+              help='Only print which stages would run and why (before posts are analyzed).')
+@click.option('--profile', metavar='DIR', type=click.Path(file_okay=False),
+              help='Profile post analysis and each stage (CPU, memory, SQL) and write a report to DIR.')
+def main(skip_posts, reanalyze, itersize, workers, range_size, sql_bakes, jobs, force, dry_run, profile):
     config.setup_debugger()
     session = get_session()
 
-    if not skip_posts:
-        analyze_posts(session, state_file)
+    stages = analytics_stages(sql_bakes, reanalyze)
+    stage_names = [stage.name for stage in stages]
+    if 'all' in force:
+        force = stage_names
+    if reanalyze:
+        force = tuple(force) + ('parse_user_profiles',)
+    for name in force:
+        if name not in stage_names:
+            raise click.BadParameter('Unknown stage %s (stages: %s)' % (name, ', '.join(stage_names)),
+                                     param_hint='--force')
+    if dry_run:
+        plan_stages(session, stages, force)
+        return
 
-    index_threads(session)
-    parse_user_profiles(session)
-    aggregate_post_links(session)
-    bake_poster_stats(session)
-    bake_daily_stats(session)
-    bake_quote_relation(session)
+    if profile:
+        profiling.enable(profile)
+    try:
+        if not skip_posts:
+            with profiling.section('analyze_posts'):
+                analyze_posts(session, itersize, workers, range_size, reanalyze)
 
+        run_stages(session, stages, jobs, force)
+    finally:
+        if profile:
+            print('Wrote profile report to', profiling.write_report())
+
+    DataVersion.bump(session)
     session.commit()
     from .backend import cache
     cache.invalidate()
 
-
-def iter_posts(session, nchild, pids, chunk_size=10000):
-    pivots = (pids[len(pids) // 4], pids[len(pids) // 2], pids[len(pids) // 4 * 3])
-    if nchild == 0:
-        ec = and_(PostContent.pid >= pids[0], PostContent.pid < pivots[0])
-        ep = and_(Post.pid >= pids[0], Post.pid < pivots[0])
-    elif nchild == 1:
-        ec = and_(PostContent.pid >= pivots[0], PostContent.pid < pivots[1])
-        ep = and_(Post.pid >= pivots[0], Post.pid < pivots[1])
-    elif nchild == 2:
-        ec = and_(PostContent.pid >= pivots[1], PostContent.pid < pivots[2])
-        ep = and_(Post.pid >= pivots[1], Post.pid < pivots[2])
-    elif nchild == 3:
-        ec = PostContent.pid >= pivots[2]
-        ep = Post.pid >= pivots[2]
-
-    start_pid = bindparam('start_pid')
-    contents = (
-        session
-        .query(PostContent)
-        .filter(PostContent.pid > start_pid)
-        .filter(ec)
-        .order_by(PostContent.pid)
-        .limit(chunk_size)
-        .subquery()
+    tables = [PostLinks, LinkRelation, PosterStats, DailyStats, ActiveUserRollup, QuoteRelation, User, UserTier]
+    if not skip_posts:
+        tables += [PostQuotes, AnalyzedPost]
+    maintain(session.bind, [table.__tablename__ for table in tables], report=False)
+
+
+def analytics_stages(sql_bakes=False, reparse_profiles=False):
+    stages = [
+        # Records what it indexed in indexed_threads, which it reads as well; hence not isolated.
+        Stage('index_threads', index_threads, inputs=['threads'], outputs=['elasticsearch:thread', 'indexed_threads'],
+              isolated=False),
+        # Updates users in place, hence not isolated.
+        Stage('parse_user_profiles', functools.partial(parse_user_profiles, reparse=reparse_profiles),
+              inputs=['my_mods_users'], outputs=['users', 'user_tiers'], isolated=False),
+        Stage('aggregate_post_links', aggregate_post_links, inputs=['post_links', 'posts'], outputs=['link_relation']),
+    ]
+    if sql_bakes:
+        post_tables = ['posts', 'threads', 'post_quotes']
+        stages += [
+            Stage('bake_poster_stats', bake_poster_stats, inputs=post_tables, outputs=['baked_poster_stats']),
+            Stage('bake_daily_stats', bake_daily_stats, inputs=post_tables,
+                  outputs=['baked_daily_stats', 'baked_active_users']),
+            Stage('bake_quote_relation', bake_quote_relation, inputs=post_tables, outputs=['baked_quote_stats']),
+        ]
+    else:
+        stages += [
+            Stage('extract_post_facts', facts.extract, inputs=['posts', 'threads', 'post_quotes'],
+                  outputs=['post_facts']),
+            Stage('bake_poster_stats', facts.bake_poster_stats, inputs=['post_facts'], outputs=['baked_poster_stats']),
+            Stage('bake_daily_stats', facts.bake_daily_stats, inputs=['post_facts'],
+                  outputs=['baked_daily_stats', 'baked_active_users']),
+            Stage('bake_quote_relation', facts.bake_quote_relation, inputs=['post_facts'],
+                  outputs=['baked_quote_stats']),
+        ]
+    return stages
+
+
+def unanalyzed_posts(query):
+    """Restrict *query* to posts which were not analyzed yet or were edited since they were analyzed."""
+    return (
+        query
+        .outerjoin(AnalyzedPost, AnalyzedPost.pid == Post.pid)
+        .filter(or_(AnalyzedPost.pid.is_(None), AnalyzedPost.edit_count.is_distinct_from(Post.edit_count)))
     )
+
+
+PostRow = namedtuple('PostRow', 'pid poster_uid bid timestamp edit_count content title')
+
+
+def iter_posts(session, lower_pid, upper_pid=None, itersize=10000, unanalyzed=False):
+    """
+    Stream (pid, poster_uid, bid, timestamp, edit_count, content, title) of all posts with lower_pid <= pid < upper_pid,
+    ordered by pid.
+
+    upper_pid=None means no upper bound. With *unanalyzed*, see unanalyzed_posts.
+    """
     query = (
         session
-        .query(Post.pid, Post.poster_uid, contents.c.content, contents.c.title)
-        .join(contents, contents.c.pid == Post.pid)
-        .filter(Post.pid > start_pid)
-        .filter(ep)
+        .query(Post.pid, Post.poster_uid, Post.bid, Post.timestamp, Post.edit_count,
+               PostContent.content, PostContent.title)
+        .join(PostContent, PostContent.pid == Post.pid)
+        .filter(Post.pid >= lower_pid)
         .order_by(Post.pid)
-        .limit(chunk_size)
     )
-
-    last_pid = 0
-    while True:
-        posts = query.params(start_pid=last_pid).all()
-        yield from posts
-        if not posts:
-            break
-        last_pid = posts[-1].pid
+    if upper_pid is not None:
+        query = query.filter(Post.pid < upper_pid)
+    if unanalyzed:
+        query = unanalyzed_posts(query)
+    return map(PostRow._make, stream_query(query, itersize))
 
 
 ESP_POISON = object()
 
 
-def elasticsearch_pusher(queue):
-    es = config.elasticsearch_client()
+def queued_search_actions(queue):
+    """Bulk actions for the lists of search documents (or delete actions) put into *queue*, until ESP_POISON."""
     while True:
         bodies = queue.get()
         if bodies is ESP_POISON:
             break
-        if not es:
-            continue
-        actions = [dict(_index='post', _id=body['pid'], _source=body) for body in bodies]
-        elasticsearch.helpers.bulk(es, actions, chunk_size=10000, max_chunk_bytes=100 * 1024 * 1024)
+        for body in bodies:
+            yield body if '_op_type' in body else dict(_id=body['pid'], _source=body)
 
 
-def analyze_posts_process(nchild, progress_fd, pids, pids_to_process):
-    quote_insert_stmt = insert(PostQuotes.__table__)
-    quote_insert_stmt = quote_insert_stmt.on_conflict_do_update(
-        index_elements=PostQuotes.__table__.primary_key.columns,
-        set_=dict(count=quote_insert_stmt.excluded.count + PostQuotes.__table__.c.count)
-    )
+def elasticsearch_pusher(queue, index):
+    es = config.elasticsearch_client()
+    if not es:
+        for _ in queued_search_actions(queue):
+            pass
+        return
+    search_index.bulk_index(es, index, queued_search_actions(queue), threads=2, chunk_size=5000)
 
-    url_insert_stmt = insert(PostLinks.__table__)
-    url_insert_stmt = url_insert_stmt.on_conflict_do_update(
-        index_elements=PostLinks.__table__.primary_key.columns,
-        set_=dict(count=url_insert_stmt.excluded.count + PostLinks.__table__.c.count)
-    )
 
+def split_pid_ranges(pids_to_process, range_size):
+    """Split pids_to_process into [lower, upper) ranges of range_size posts each. The last range is open."""
+    bounds = [pids_to_process[i] for i in range(0, len(pids_to_process), range_size)]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def claim_pid_ranges(pid_ranges, next_range):
+    """
+    Yield pid ranges not yet claimed by another worker.
+
+    next_range is a shared multiprocessing.Value holding the index of the next unclaimed range,
+    so faster workers simply end up processing more ranges.
+    """
+    while True:
+        with next_range.get_lock():
+            index = next_range.value
+            next_range.value += 1
+        if index >= len(pid_ranges):
+            return
+        yield pid_ranges[index]
+
+
+# Workers COPY their (per range pre-aggregated) results into these unlogged tables; merge_analysis moves
+# them into the real tables at the end. Staging tables are not WAL-logged and have no indexes.
+STAGING_TABLES = (
+    ('post_quotes_staging', 'post_quotes', ('pid', 'quoted_pid', 'count')),
+    ('post_links_staging', 'post_links', ('pid', 'url', 'type', 'domain', 'count')),
+    ('analyzed_posts_staging', 'analyzed_posts', ('pid', 'edit_count')),
+    ('post_search_staging', 'post_search', ('pid', 'content')),
+)
+
+
+def staging_tables_exist(session):
+    return session.execute("SELECT to_regclass('analyzed_posts_staging') IS NOT NULL").scalar()
+
+
+def create_staging_tables(session):
+    for staging_table, table, columns in STAGING_TABLES:
+        session.execute('CREATE UNLOGGED TABLE IF NOT EXISTS %s (LIKE %s)' % (staging_table, table))
+
+
+def aggregate_quotes(quotes):
+    """Sum up the per-occurrence dicts collected by analyze_post into (pid, quoted_pid, count) rows."""
+    counts = Counter()
+    for quote in quotes:
+        counts[quote['pid'], quote['quoted_pid']] += quote['count']
+    return [key + (count,) for key, count in counts.items()]
+
+
+def aggregate_urls(urls):
+    """Sum up the per-occurrence dicts collected by analyze_post into (pid, url, type, domain, count) rows."""
+    counts = Counter()
+    domains = {}
+    for url in urls:
+        key = url['pid'], url['url'], url['type'].name
+        counts[key] += url['count']
+        domains[key] = url['domain']
+    return [key + (domains[key], count) for key, count in counts.items()]
+
+
+def merge_analysis(session):
+    """
+    Move staged analysis results into PostQuotes, PostLinks and AnalyzedPost, replacing earlier results
+    of the same posts, and drop the staging tables.
+    """
+    t0 = perf_counter()
+    # Staging tables added since the interrupted run started are missing.
+    create_staging_tables(session)
+    session.execute('DELETE FROM post_quotes WHERE pid IN (SELECT pid FROM analyzed_posts_staging)')
+    session.execute('DELETE FROM post_links WHERE pid IN (SELECT pid FROM analyzed_posts_staging)')
+    session.execute('DELETE FROM post_search WHERE pid IN (SELECT pid FROM analyzed_posts_staging)')
+    num_quotes = session.execute('''
+        INSERT INTO post_quotes (pid, quoted_pid, count)
+        SELECT pid, quoted_pid, sum(count) FROM post_quotes_staging GROUP BY pid, quoted_pid
+    ''').rowcount
+    num_links = session.execute('''
+        INSERT INTO post_links (pid, url, type, domain, count)
+        SELECT pid, url, type, min(domain), sum(count) FROM post_links_staging GROUP BY pid, url, type
+    ''').rowcount
+    num_posts = session.execute('''
+        INSERT INTO analyzed_posts (pid, edit_count)
+        SELECT DISTINCT ON (pid) pid, edit_count FROM analyzed_posts_staging
+        ON CONFLICT (pid) DO UPDATE SET edit_count = excluded.edit_count
+    ''').rowcount
+    session.execute('''
+        INSERT INTO post_search (pid, content)
+        SELECT DISTINCT ON (pid) pid, content FROM post_search_staging
+    ''')
+    for staging_table, table, columns in STAGING_TABLES:
+        session.execute('DROP TABLE %s' % staging_table)
+    session.commit()
+    print('Merged analysis of {} posts ({} quotes, {} links) in {:.1f} s.'.format(
+        num_posts, num_quotes, num_links, perf_counter() - t0))
+
+
+def analyze_posts_process(progress_fd, pids, pid_ranges, next_range, itersize, es_index, send_deletes, index_run):
     session = get_session()
 
     quotes = []
     urls = []
+    analyzed = []
     search_contents = []
+    # Search documents are staged like the other results for full-text search in the database.
+    search_rows = [] if config.search_backend() == 'postgres' else None
+    # For the local search backend, the search documents of each range are written into a segment of
+    # the inverted index, named after the analysis run (index_run) and the range.
+    index_docs = [] if index_run else None
     elasticsearch_queue = Queue(maxsize=10)  # maximum of ~10×10000 = 100k pending ES index updates
-    elasticsearch_thread = threading.Thread(target=elasticsearch_pusher, args=(elasticsearch_queue,))
+    elasticsearch_thread = threading.Thread(target=elasticsearch_pusher, args=(elasticsearch_queue, es_index))
     elasticsearch_thread.start()
     n = 0
 
-    for post in iter_posts(session, nchild, pids_to_process):
-        analyze_post(post, pids, quotes, urls, search_contents)
-        n += 1
-
-        if n > 2000:
-            os.write(progress_fd, n.to_bytes(4, byteorder='little'))
-            n = 0
-
-        if len(quotes) > 1000:
-            session.execute(quote_insert_stmt, quotes)
-            quotes.clear()
-        if len(urls) > 1000:
-            session.execute(url_insert_stmt, urls)
-            urls.clear()
-        if len(search_contents) > 10000:
-            elasticsearch_queue.put(search_contents)
-            search_contents = []
-
-    if quotes:
-        session.execute(quote_insert_stmt, quotes)
-    if urls:
-        session.execute(url_insert_stmt, urls)
+    for lower_pid, upper_pid in claim_pid_ranges(pid_ranges, next_range):
+        for post in iter_posts(session, lower_pid, upper_pid, itersize, unanalyzed=True):
+            num_contents = len(search_contents)
+            analyze_post(post, pids, quotes, urls, search_contents)
+            if search_rows is not None:
+                search_rows.extend((body['pid'], body['content']) for body in search_contents[num_contents:])
+                del search_contents[num_contents:]
+            elif index_docs is not None:
+                index_docs.extend((body['pid'], body['poster_uid'], body['bid'], body['timestamp'], search_text(body))
+                                  for body in search_contents[num_contents:])
+                if send_deletes and len(search_contents) == num_contents:
+                    index_docs.append((post.pid, post.poster_uid, post.bid, post.timestamp, None))
+                del search_contents[num_contents:]
+            elif send_deletes and len(search_contents) == num_contents:
+                # Nothing (left) to search, e.g. an edit removed everything but quotes.
+                search_contents.append(dict(_op_type='delete', _id=post.pid))
+            analyzed.append((post.pid, post.edit_count))
+            n += 1
+
+            if n > 2000:
+                os.write(progress_fd, n.to_bytes(4, byteorder='little'))
+                n = 0
+
+            if len(search_contents) > 10000:
+                elasticsearch_queue.put(search_contents)
+                search_contents = []
+
+        rows = aggregate_quotes(quotes), aggregate_urls(urls), analyzed, search_rows or []
+        for (staging_table, table, columns), table_rows in zip(STAGING_TABLES, rows):
+            copy_rows(session, staging_table, columns, table_rows)
+        quotes.clear()
+        urls.clear()
+        analyzed.clear()
+        if search_rows:
+            search_rows.clear()
+        if index_docs:
+            inverted_index.write_segment(inverted_index.default_path(), '%s-%d' % (index_run, lower_pid), index_docs)
+            index_docs.clear()
+        # Each range is committed on its own, so the staged results of an interrupted run are merged by the next.
+        session.commit()
+
     if search_contents:
         elasticsearch_queue.put(search_contents)
-    quotes.clear()
-    urls.clear()
-    session.commit()
     elasticsearch_queue.put(ESP_POISON)
     elasticsearch_thread.join()
 
     os.write(progress_fd, n.to_bytes(4, byteorder='little'))
-    os.write(progress_fd, b'\xff' * 4)
 
 
-def read_state_file(state_file):
-    try:
-        with open(state_file, 'r') as fd:
-            return json.load(fd)
-    except (FileNotFoundError, TypeError):
-        print('State file %s does not exist, starting from scratch' % state_file)
-        return {
-            'last_pid': 0,
-        }
+def search_text(body):
+    """Text of a search document (from analyze_post) for the inverted index: the title and the content."""
+    return '\n'.join(text for text in (body['title'], body['content']) if text)
 
 
-def write_state_file(state_file, last_pid):
-    if not state_file:
-        return
-    with open(state_file, 'w') as fd:
-        json.dump({
-            'last_pid': last_pid,
-        }, fd)
-
-
-def analyze_posts(session, state_file):
+def query_pid_bitmap(query):
+    """Collect the pids of a query on Post.pid into a BitMap."""
     pids = BitMap()
     last_pid = None
     while True:
-        query = session.query(Post.pid)
+        chunk_query = query
         if last_pid:
-            query = query.filter(Post.pid > last_pid)
-        chunk = query.order_by(Post.pid).limit(100000).from_self(func.array_agg(Post.pid)).all()[0][0]
+            chunk_query = chunk_query.filter(Post.pid > last_pid)
+        chunk = chunk_query.order_by(Post.pid).limit(100000).from_self(func.array_agg(Post.pid)).all()[0][0]
         if not chunk:
             break
         last_pid = chunk[-1]
         pids.update(chunk)
+    return pids
 
-    bitmap_size = len(pids.serialize())
-    print('PID bitmap size %d bytes, %d entries, %.2f bits per entry' % (bitmap_size, len(pids), bitmap_size / len(pids) * 8))
 
-    state = read_state_file(state_file)
-    pids_to_process = pids.to_array()
-    try:
-        slice_index = pids_to_process.index(state['last_pid'])
-    except ValueError:
-        slice_index = 0
-    pids_to_process = pids_to_process[slice_index:]
-    pids_to_process = BitMap(pids_to_process)
+def pid_bitmap_path():
+    return os.path.join(os.path.expanduser(config.get('CACHE_DIR')), 'pids.roaring')
 
-    num_posts = len(pids_to_process)
-    continuing = bool(slice_index)
+
+def load_pid_bitmap(session, unanalyzed, path=None):
+    """
+    Return a FrozenBitMap of all pids in posts.
+
+    The bitmap is cached in *path*, its number of pids and largest pid in *path*.json. Posts are only ever
+    added and stay in *unanalyzed* (the pids of unanalyzed_posts) until they are analyzed, so the cached pids,
+    the pids above the largest one and *unanalyzed* are all of them, whichever order posts were added in.
+    Validating the cache only takes the largest pid in the database: if it is smaller than the cached one (e.g.
+    the cache belongs to another database) or the cache can't be read, all pids are queried again.
+
+    Forked workers share the (immutable) bitmap.
+    """
+    path = path or pid_bitmap_path()
+    max_pid = session.query(func.max(Post.pid)).scalar()
+    try:
+        with open(path + '.json', 'r') as fd:
+            header = json.load(fd)
+        if max_pid is None or header['max_pid'] > max_pid:
+            raise ValueError('Cached pids do not match the posts')
+        with open(path, 'rb') as fd:
+            cached = FrozenBitMap.deserialize(fd.read())
+        if len(cached) != header['count'] or cached.max() != header['max_pid']:
+            raise ValueError('Cached pids do not match their header')
+    except (FileNotFoundError, KeyError, ValueError):
+        # ValueError: empty, corrupt or outdated cache
+        cached = FrozenBitMap()
+
+    if cached:
+        pids = cached | query_pid_bitmap(session.query(Post.pid).filter(Post.pid > cached.max())) | unanalyzed
+        print('Loaded {} cached pids, {} new.'.format(len(cached), len(pids) - len(cached)))
+    else:
+        pids = query_pid_bitmap(session.query(Post.pid))
+
+    if pids != cached:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        bitmap = BitMap(pids)
+        bitmap.run_optimize()
+        with open(path + '.tmp', 'wb') as fd:
+            fd.write(bitmap.serialize())
+        os.rename(path + '.tmp', path)
+        with open(path + '.json.tmp', 'w') as fd:
+            json.dump(dict(count=len(pids), max_pid=pids.max() if pids else None), fd)
+        os.rename(path + '.json.tmp', path + '.json')
+    return FrozenBitMap(pids)
+
+
+def analyze_posts(session, itersize=10000, workers=4, range_size=20000, reanalyze=False):
+    """
+    Analyze posts which were not analyzed yet or were edited since they were last analyzed.
+
+    With *reanalyze*, all posts are analyzed again (e.g. after changes to analyze_post). Search documents of
+    new and edited posts are sent to the post index, a reanalysis builds a new one (see search_index); with the
+    local search backend, they are written into new segments of the inverted index instead.
+    """
     es = config.elasticsearch_client()
-    if not continuing:
-        session.query(PostQuotes).delete()
-        session.query(PostLinks).delete()
+    if es and not reanalyze and session.query(AnalyzedPost).first():
+        if not search_index.index_exists(es, 'post'):
+            print('The post index does not exist, analyzing all posts again.')
+            reanalyze = True
+        elif search_index.mapping_outdated(es, 'post'):
+            print('The post index lacks fields, analyzing all posts again.')
+            reanalyze = True
+
+    if config.search_backend() == 'postgres' and not reanalyze and session.query(AnalyzedPost).first():
+        if not session.query(PostSearch.pid).first():
+            print('The post_search table is empty, analyzing all posts again.')
+            reanalyze = True
+
+    index_run = None
+    if config.search_backend() == 'local':
+        if not reanalyze and not inverted_index.index_exists() and session.query(AnalyzedPost).first():
+            print('The search index does not exist (or is outdated), analyzing all posts again.')
+            reanalyze = True
+        index_run = inverted_index.new_run_id()
+
+    if staging_tables_exist(session):
+        print('Merging results of an interrupted analysis.')
+        merge_analysis(session)
+    if reanalyze:
+        session.query(AnalyzedPost).delete()
         session.commit()
-        if es:
-            es.indices.delete('post', ignore=[404])
-            es.indices.create('post', body={
-                'settings': {
-                    'refresh_interval': '300s',
-                    'number_of_shards': 1,
-                },
-                'mappings': {
-                    'properties': {
-                        'content': {
-                            'type': 'text',
-                            'analyzer': 'german',
-                        },
-                        'title': {
-                            'type': 'text',
-                            'analyzer': 'german',
-                        },
-                        'poster_uid': {
-                            'type': 'integer',
-                        },
-                        'pid': {
-                            'type': 'integer',
-                        }
-                    }
-                }
-            })
+    pids_to_process = query_pid_bitmap(unanalyzed_posts(session.query(Post.pid)))
+    num_posts = len(pids_to_process)
+    print('%d posts are new or were edited since they were analyzed.' % num_posts)
+    if not num_posts:
+        return
+
+    pids = load_pid_bitmap(session, pids_to_process)
+
+    bitmap_size = len(pids.serialize())
+    print('PID bitmap size %d bytes, %d entries, %.2f bits per entry' % (bitmap_size, len(pids), bitmap_size / len(pids) * 8))
+
+    es_index = 'post'
     if es:
-        es.indices.put_settings({
-            'index': {
-                'refresh_interval': -1,
-            }
-        }, 'post')
+        if reanalyze:
+            # All posts are indexed again, into a new index which replaces the current one when it is complete.
+            es_index = search_index.create_index(es, 'post')
+        else:
+            search_index.ensure_index(es, 'post')
+        search_index.suspend_refresh(es, es_index)
 
+    create_staging_tables(session)
+    session.commit()
     session.invalidate()
     session.bind.dispose()
 
+    pid_ranges = split_pid_ranges(pids_to_process, range_size)
+    next_range = multiprocessing.Value('l', 0)
+
     children = {}
-    for nchild in range(4):
+    for nchild in range(workers):
         p, c = os.pipe()
         child_pid = os.fork()
         if not child_pid:
-            progress_fd = c
-            analyze_posts_process(nchild, progress_fd, pids, pids_to_process)
-            sys.exit(0)
+            os.close(p)
+            status = 0
+            try:
+                with profiling.section('analyze_posts worker %d' % nchild):
+                    analyze_posts_process(c, pids, pid_ranges, next_range, itersize, es_index, not reanalyze,
+                                          index_run)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        # Only the child holds the write end now, so the pipe reaches EOF when it exits (for whatever reason).
+        os.close(c)
         children[p] = child_pid
 
+    failed = 0
     with ElapsedProgressBar(length=num_posts, label='Analyzing posts') as bar:
         while children:
             r, w, x = select.select(list(children), [], [])
             for fd in r:
                 v = os.read(fd, 4)
-                if v == b'\xff' * 4:
-                    pid = children.pop(fd)
-                    os.kill(pid, signal.SIGKILL)
-                    os.waitpid(pid, 0)
-                else:
+                if v:
                     bar.update(int.from_bytes(v, byteorder='little'))
+                    continue
+                os.close(fd)
+                pid, status = os.waitpid(children.pop(fd), 0)
+                if status and not failed:
+                    # The ranges claimed by the failed worker would be missing, stop the others as well.
+                    for other_pid in children.values():
+                        os.kill(other_pid, signal.SIGTERM)
+                failed += bool(status)
+
+    if failed:
+        # Ranges committed before the failure stay staged; they are merged by the next run,
+        # which analyzes the remaining posts again.
+        if es and es_index != 'post':
+            es.indices.delete(index=es_index, ignore=[404])
+        elif es:
+            search_index.resume_refresh(es, es_index, 'post')
+        if index_run and reanalyze:
+            inverted_index.discard_segments(run_id=index_run)
+        elif index_run:
+            inverted_index.register_segments()
+        raise click.ClickException('Post analysis failed ({} of {} workers).'.format(failed, workers))
 
     if es:
-        es.indices.refresh('post')
-        es.indices.put_settings({
-            'index': {
-                'refresh_interval': '300s',
-            }
-        }, 'post')
+        search_index.resume_refresh(es, es_index, 'post')
+        if es_index != 'post':
+            search_index.swap_index(es, 'post', es_index)
+    if index_run:
+        # A reanalysis replaces all segments.
+        inverted_index.register_segments(run_id=index_run if reanalyze else None)
+        inverted_index.merge_segments()
 
     print('Analyzed {} posts in {:.1f} s ({:.0f} posts/s).'.format(bar.pos, bar.elapsed, num_posts / bar.elapsed))
+    merge_analysis(session)
 
-    write_state_file(state_file, pids_to_process.max())
 
+def index_threads(session, chunk_size=5000):
+    """
+    Send new and changed threads to the thread index and delete threads which no longer exist from it.
 
-def index_threads(session):
+    If the index does not exist, all threads are indexed into a new one.
+    """
     es = config.elasticsearch_client()
     if not es:
         return
 
-    es.indices.delete('thread', ignore=[404])
-    es.indices.create('thread', body={
-        'settings': {
-            'refresh_interval': '300s',
-            'number_of_shards': 1,
-        },
-        'mappings': {
-            'properties': {
-                'title': {
-                    'type': 'text',
-                    'analyzer': 'german',
-                },
-                'subtitle': {
-                    'type': 'text',
-                    'analyzer': 'german',
-                },
-                'tid': {
-                    'type': 'integer',
-                }
-            }
-        }
-    })
-
     t0 = perf_counter()
-    threads = session.query(Thread.tid, Thread.title, Thread.subtitle).all()
-    actions = [dict(_index='thread', _id=thread.tid, _source=thread._asdict()) for thread in threads]
-    elasticsearch.helpers.bulk(es, actions, chunk_size=200000, max_chunk_bytes=100 * 1024 * 1024)
-    es.indices.refresh('thread')
+    rebuild = not search_index.index_exists(es, 'thread')
+    if rebuild:
+        session.query(IndexedThread).delete()
+    current_md5 = IndexedThread.current_md5().label('md5')
+    changed = (
+        session
+        .query(Thread.tid, Thread.title, Thread.subtitle, current_md5)
+        .outerjoin(IndexedThread, IndexedThread.tid == Thread.tid)
+        .filter(IndexedThread.md5.is_distinct_from(current_md5))
+    )
+    deleted = session.query(IndexedThread.tid).filter(~session.query(Thread).filter_by(tid=IndexedThread.tid).exists())
+
+    def actions():
+        # Recorded as they are sent; if sending fails, the whole transaction is rolled back.
+        for chunk in chunk_query(changed, Thread.tid, chunk_size):
+            if not chunk:
+                break
+            upsert = insert(IndexedThread).values([dict(tid=tid, md5=md5) for tid, _, _, md5 in chunk])
+            session.execute(upsert.on_conflict_do_update(index_elements=['tid'], set_=dict(md5=upsert.excluded.md5)))
+            for tid, title, subtitle, md5 in chunk:
+                yield dict(_id=tid, _source=dict(tid=tid, title=title, subtitle=subtitle))
+        for chunk in chunk_query(deleted, IndexedThread.tid, chunk_size):
+            if not chunk:
+                break
+            tids = [tid for tid, in chunk]
+            session.query(IndexedThread).filter(IndexedThread.tid.in_(tids)).delete(synchronize_session=False)
+            for tid in tids:
+                yield dict(_op_type='delete', _id=tid)
+
+    if rebuild:
+        count = search_index.rebuild_index(es, 'thread', actions(), chunk_size=chunk_size)
+    else:
+        count = search_index.bulk_index(es, 'thread', actions(), chunk_size=chunk_size)
+        es.indices.refresh(index='thread')
     elapsed = perf_counter() - t0
-    print('Indexed {} threads in {:.1f} s.'.format(len(threads), elapsed))
+    print('Sent {} new, changed or deleted threads to the index in {:.1f} s.'.format(count, elapsed))
 
 
 def aggregate_post_links(session):
@@ -342,16 +605,51 @@ def bake_poster_stats(session):
     print('Baked poster stats ({} rows) in {:.1f} s.'.format(session.query(PosterStats).count(), elapsed))
 
 
+def merge_active_users(day_stats, active_users):
+    """
+    Join rows of dal.daily_post_stats_agg with a BitMap of the users in dal.daily_active_users.
+
+    Both are streams ordered by (year, day_of_year, bid), so the bitmaps are built one day and board at a time.
+    """
+    active_users = itertools.groupby(active_users, key=lambda row: row[:3])
+    users_key, users = next(active_users, (None, ()))
+    for day in day_stats:
+        key = tuple(day[:3])
+        while users_key is not None and users_key < key:
+            users_key, users = next(active_users, (None, ()))
+        bitmap = BitMap()
+        if users_key == key:
+            bitmap.update(row[3] for row in users)
+        yield tuple(day) + (bitmap,)
+
+
 def bake_daily_stats(session):
     t0 = perf_counter()
     session.query(DailyStats).delete()
-    for day in dal.daily_statistics_agg(session).all():
-        day = day._asdict()
-        day['active_users'] = BitMap(day['active_users']).serialize()
-        day.pop('active_threads')
-        session.add(DailyStats(**day))
+    day_stats = stream_query(dal.daily_post_stats_agg(session))
+    active_users = stream_query(dal.daily_active_users(session), itersize=100000)
+    rollups = facts.ActiveUserRollups()
+
+    def rows():
+        for day in merge_active_users(day_stats, active_users):
+            rollups.add(*day[:3], day[-1])
+            yield day[:-1] + (day[-1].serialize(),)
+    rows = rows()
+    columns = ('year', 'day_of_year', 'bid', 'post_count', 'edit_count', 'posts_length', 'threads_created',
+               'cumulative_post_count', 'cumulative_edit_count', 'cumulative_posts_length',
+               'cumulative_threads_created', 'active_users')
+    num_rows = 0
+    # The connection can't fetch from the streams while a COPY is in progress, hence one COPY per chunk.
+    while True:
+        chunk = list(itertools.islice(rows, 10000))
+        if not chunk:
+            break
+        num_rows += copy_rows(session, DailyStats.__tablename__, columns, chunk)
+    num_rollups = facts.load_active_user_rollups(session, rollups)
     elapsed = perf_counter() - t0
-    print('Baked daily stats ({} rows) in {:.1f} s.'.format(session.query(DailyStats).count(), elapsed))
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('Baked daily stats ({} rows, {} active user rollups) in {:.1f} s, peak memory {:.0f} MB.'.format(
+        num_rows, num_rollups, elapsed, peak_memory))
 
 
 def bake_quote_relation(session):
@@ -361,12 +659,64 @@ def bake_quote_relation(session):
     print('Baked quote relation ({} rows) in {:.1f} s.'.format(session.query(QuoteRelation).count(), elapsed))
 
 
+TEXT_END = re.compile(r'[\[\]]')
+TAG_END = re.compile(r'[\[\]"]')
+
+
+def tokenize_bbcode(content):
+    """
+    Split BBCode *content* into text and tags.
+
+    Yields (False, text) for text between tags and (True, tag) for each tag,
+    with tag being everything between the brackets.
+
+    Brackets within double quotes are part of the tag, e.g. [url="http://example.com/[1]"].
+    An opening bracket within a tag starts a new tag, a tag which is not closed is dropped.
+    A stray closing bracket outside of a tag yields the preceding tag again.
+    """
+    pos = 0
+    end = len(content)
+    current_tag = ''
+    while pos < end:
+        match = TEXT_END.search(content, pos)
+        if not match:
+            yield False, content[pos:]
+            return
+        start = match.start()
+        if start > pos:
+            yield False, content[pos:start]
+        pos = start + 1
+        if match.group() == ']':
+            yield True, current_tag
+            continue
+
+        tag = []
+        while True:
+            match = TAG_END.search(content, pos)
+            if not match:
+                return
+            char = match.group()
+            if char == '[':
+                tag.clear()
+                pos = match.end()
+                continue
+            tag.append(content[pos:match.start()])
+            pos = match.end()
+            if char == ']':
+                break
+            closing_quote = content.find('"', pos)
+            if closing_quote == -1:
+                return
+            tag.append('"')
+            tag.append(content[pos:closing_quote + 1])
+            pos = closing_quote + 1
+        current_tag = ''.join(tag)
+        yield True, current_tag
+
+
 def analyze_post(post, pids, quotes, urls, search_contents=None):
-    in_tag = False
-    in_quoted_string = False
     capture_contents = False
-    current_tag = ''
-    tag_contents = ''
+    captured = []
     quote_level = 0
 
     def update_edge(quote_tag, post):
@@ -416,6 +766,8 @@ def analyze_post(post, pids, quotes, urls, search_contents=None):
             search_contents.append(dict(
                 pid=post.pid,
                 poster_uid=post.poster_uid,
+                bid=post.bid,
+                timestamp=post.timestamp,
                 content=original_content,
                 title=post.title,
             ))
@@ -423,15 +775,16 @@ def analyze_post(post, pids, quotes, urls, search_contents=None):
     if not post.content:
         return
 
-    original_content = ''
-
-    for char in post.content:
-        if not in_quoted_string and char == '[':
-            in_tag = True
-            current_tag = ''
-        elif not in_quoted_string and char == ']':
-            in_tag = False
+    original_content = []
 
+    for is_tag, token in tokenize_bbcode(post.content):
+        if not is_tag:
+            if capture_contents:
+                captured.append(token)
+            if quote_level == 0:
+                original_content.append(token)
+        else:
+            current_tag = token
             if current_tag.startswith('quote'):
                 quote_level += 1
             elif current_tag == '/quote':
@@ -446,51 +799,91 @@ def analyze_post(post, pids, quotes, urls, search_contents=None):
                 elif current_tag == 'url':
                     capture_contents = True
                 elif current_tag == '/url' and capture_contents:
-                    update_url(tag_contents, LinkType.link, post)
+                    update_url(''.join(captured), LinkType.link, post)
                     capture_contents = False
-                    tag_contents = ''
+                    captured.clear()
                 elif current_tag == 'img':
                     capture_contents = True
                 elif current_tag == '/img' and capture_contents:
-                    update_url(tag_contents, LinkType.image, post)
+                    update_url(''.join(captured), LinkType.image, post)
                     capture_contents = False
-                    tag_contents = ''
+                    captured.clear()
                 elif current_tag in ('video', 'video play', 'video autoplay'):
                     capture_contents = True
                 elif current_tag == '/video' and capture_contents:
-                    update_url(tag_contents, LinkType.video, post)
+                    update_url(''.join(captured), LinkType.video, post)
                     capture_contents = False
-                    tag_contents = ''
-        elif in_tag:
-            current_tag += char
-            if char == '"':
-                in_quoted_string = not in_quoted_string
-        elif capture_contents:
-            tag_contents += char
-        if quote_level == 0 and not in_tag and char not in ('[', ']'):
-            original_content += char
+                    captured.clear()
 
     if original_content:
-        index_for_search(post, original_content)
+        index_for_search(post, ''.join(original_content))
+
 
+# Compiled to XPath once, instead of on each cssselect() call.
+SELECT_BARS = CSSSelector('td.vam.avatar img[alt="*"]')
+SELECT_RANK = CSSSelector('span.rang')
+SELECT_ATTRIBUTES = CSSSelector('#content tr:not(.bar)')
+SELECT_KEY = CSSSelector('.attrn')
+SELECT_VALUE = CSSSelector('.attrv')
+SELECT_NAME = CSSSelector('.attrv div')
+SELECT_PRIVATE = CSSSelector('.attrv em')
 
-def parse_user_profiles(session):
-    with ElapsedProgressBar(session.query(MyModsUserStaging).all(), label='Parsing user profiles', show_pos=True) as bar:
-        for mmu in bar:
-            page = html.fromstring(mmu.html)
-            parse_user_profile(session, mmu.user, page)
 
+def parse_user_profiles(session, reparse=False, chunk_size=1000):
+    """
+    Parse the my.mods.de profile pages into their users (and user tiers), in a process pool.
 
-def get_user_tier(session, user, page):
+    Pages which did not change since they were last parsed are skipped, unless *reparse*.
+    """
+    t0 = perf_counter()
+    query = session.query(MyModsUserStaging.uid, MyModsUserStaging.html)
+    if not reparse:
+        query = query.filter(MyModsUserStaging.parsed_html_md5.is_distinct_from(MyModsUserStaging.html_md5))
+    tiers = {(tier.name, tier.bars, tier.type): tier for tier in session.query(UserTier)}
+
+    num_profiles = 0
+    with multiprocessing.Pool() as pool:
+        for chunk in chunk_query(query, MyModsUserStaging.uid, chunk_size):
+            if not chunk:
+                break
+            users = {user.uid: user for user in session.query(User).filter(User.uid.in_([uid for uid, _ in chunk]))}
+            parsed = []
+            for uid, html_md5, tier_key, attributes in pool.imap(parse_user_profile, chunk, chunksize=16):
+                apply_user_profile(session, users[uid], tiers, tier_key, attributes)
+                parsed.append(dict(uid=uid, parsed_html_md5=html_md5))
+            session.bulk_update_mappings(MyModsUserStaging, parsed)
+            num_profiles += len(chunk)
+    elapsed = perf_counter() - t0
+    print('Parsed {} user profiles in {:.1f} s ({:.0f} profiles/s).'.format(
+        num_profiles, elapsed, num_profiles / elapsed))
+
+
+def apply_user_profile(session, user, tiers, tier_key, attributes):
+    """Update *user* with a profile from parse_user_profile, *tiers* maps tier keys to (known) UserTiers."""
+    if tier_key is None:
+        user.tier = None
+    else:
+        if tier_key not in tiers:
+            name, bars, type = tier_key
+            tiers[tier_key] = UserTier(name=name, bars=bars, type=type)
+            session.add(tiers[tier_key])
+        user.tier = tiers[tier_key]
+    for attribute, value in attributes.items():
+        setattr(user, attribute, value)
+    user.user_profile_exists = True
+
+
+def parse_user_tier(uid, page):
+    """Tier of a profile page as a key (name, bars, type), None if it has none."""
     def strip_extra_url_stuff(src):
         prefix = 'http://forum.mods.de/bb/img/rank/'
         assert src.startswith(prefix)
         assert src.endswith('.gif')
         return src[len(prefix):-len('.gif')]
 
-    bars_img = page.cssselect('td.vam.avatar img[alt="*"]')
-    tier_name = page.cssselect('span.rang')[0].text
-    if user.uid == 28377:
+    bars_img = SELECT_BARS(page)
+    tier_name = SELECT_RANK(page)[0].text
+    if uid == 28377:
         assert not tier_name
         tier_name = 'enos'
     else:
@@ -544,56 +937,62 @@ def get_user_tier(session, user, page):
             tier_bar = ''.join(bars)
             tier_type = TierType.special
 
-    return session.query(UserTier).filter_by(name=tier_name, bars=tier_bar, type=tier_type).one_or_none() \
-           or UserTier(name=tier_name, bars=tier_bar, type=tier_type)
+    return tier_name, tier_bar, tier_type
 
 
-def parse_user_profile(session, user, page):
-    user.tier = get_user_tier(session, user, page)
+def parse_user_profile(row):
+    """
+    Parse the profile page of a (uid, page HTML) row, in a worker process.
 
-    kv_trs = page.cssselect('#content tr:not(.bar)')[:5]
+    Returns uid, the MD5 of the page, the tier key (see parse_user_tier) and a dict of User attributes.
+    """
+    uid, text = row
+    page = html.fromstring(text)
+    attributes = {}
+
+    kv_trs = SELECT_ATTRIBUTES(page)[:5]
     for key_value_tr in kv_trs:
-        key = key_value_tr.cssselect('.attrn')[0].text
-        value = key_value_tr.cssselect('.attrv')[0].text
+        key = SELECT_KEY(key_value_tr)[0].text
+        value = SELECT_VALUE(key_value_tr)[0].text
 
-        if user.uid == 1 and key in ('Dabei seit:', 'Zuletzt im Board:'):
+        if uid == 1 and key in ('Dabei seit:', 'Zuletzt im Board:'):
             # <!-- seit grauer Vorzeit. -->
             # <!-- genau jetzt. -->
-            user.registered = None
-            user.last_seen = None
+            attributes['registered'] = None
+            attributes['last_seen'] = None
             continue
 
         if key == 'Benutzername:':
-            value = key_value_tr.cssselect('.attrv div')[0].tail.strip()
-            if value != user.name:
-                assert value
-                user.name = value
+            value = SELECT_NAME(key_value_tr)[0].tail.strip()
+            assert value
+            attributes['name'] = value
         elif key == 'Dabei seit:':
             date = ' '.join(value.split(' ')[:2])
-            user.registered = datetime.datetime.strptime(date, FORUM_DATETIME_FORMAT_NO_SECONDS)
+            attributes['registered'] = datetime.datetime.strptime(date, FORUM_DATETIME_FORMAT_NO_SECONDS)
         elif key == 'Zuletzt im Board:':
-            maybe_private = key_value_tr.cssselect('.attrv em')
+            maybe_private = SELECT_PRIVATE(key_value_tr)
             if maybe_private:
                 assert maybe_private[0].text == 'privat'
-                user.last_seen = None
+                attributes['last_seen'] = None
             else:
-                user.last_seen = datetime.datetime.strptime(value, FORUM_DATETIME_FORMAT_NO_SECONDS)
+                attributes['last_seen'] = datetime.datetime.strptime(value, FORUM_DATETIME_FORMAT_NO_SECONDS)
         elif key == 'Status:':
-            user.online_status = value
+            attributes['online_status'] = value
         elif key == 'Accountstatus:':
             if value.startswith('gesperrt bis'):
                 value = value[len('gesperrt bis '):]
-                user.account_state = AccountState.locked_temp
-                user.locked_until = datetime.datetime.strptime(value, FORUM_DATE_FORMAT)
+                attributes['account_state'] = AccountState.locked_temp
+                attributes['locked_until'] = datetime.datetime.strptime(value, FORUM_DATE_FORMAT)
             else:
-                user.account_state = {
+                attributes['account_state'] = {
                     'aktiv': AccountState.active,
                     'gesperrt': AccountState.locked,
                     'noch nicht freigeschaltet': AccountState.not_unlocked,
                 }[value]
-                user.locked_until = None
+                attributes['locked_until'] = None
+
+    return uid, hashlib.md5(text.encode()).hexdigest(), parse_user_tier(uid, page), attributes
 
-    user.user_profile_exists = True
 
 FORUM_DATETIME_FORMAT_NO_SECONDS = '%d.%m.%Y %H:%M'
 FORUM_DATE_FORMAT = '%d.%m.%Y'
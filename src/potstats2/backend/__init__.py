@@ -1,6 +1,9 @@
+import base64
+import concurrent.futures
 import configparser
 import csv
 import datetime
+import functools
 import io
 import json
 import os.path
@@ -9,12 +12,12 @@ import time
 from flask import Flask, request, Response, url_for, g, send_file
 from sqlalchemy import func, desc, tuple_, column
 from sqlalchemy.exc import InvalidRequestError
-from sqlalchemy.orm import joinedload
 from sqlalchemy.util import KeyedTuple
 
-from ..db import Post, User, LinkType, Thread
-from .. import db, dal, config
-from .cache import cache_api_view, get_stats
+from ..db import Post, User, LinkType, Thread, Board
+from .. import db, dal, config, inverted_index
+from .cache import cache_api_view, get_stats, LRUCache
+from .cube import current_cube, STATISTICS
 
 app = Flask(__name__)
 no_default = object()
@@ -108,14 +111,19 @@ def backend_stats():
 def boards():
     session = get_session()
     year = request_arg('year', int, default=None)
+    start, end = request_date_range()
+    cube = current_cube(session)
     rows = []
-    for row in dal.boards(session, year).all():
+    for bid, stats in cube.board_stats(year, start, end):
+        if bid not in cube.boards:
+            continue
+        name, description = cube.boards[bid]
         rows.append({
-            'bid': row.Board.bid,
-            'name': row.Board.name,
-            'description': row.Board.description,
-            'thread_count': row.thread_count,
-            'post_count': int(row.post_count),
+            'bid': bid,
+            'name': name,
+            'description': description,
+            'thread_count': stats['threads_created'],
+            'post_count': stats['post_count'],
         })
     return json_response({'rows': rows})
 
@@ -138,6 +146,17 @@ def social_graph():
     return json_response({'rows': rows})
 
 
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def request_date_range():
+    """The optional from and to (inclusive) dates (YYYY-MM-DD) of the stats endpoints."""
+    start = request_arg('from', parse_date, default=None)
+    end = request_arg('to', parse_date, default=None)
+    return start, end
+
+
 def request_link_type():
     name = request_arg('type', str, default=None)
     if not name:
@@ -286,14 +305,12 @@ def weekday_stats():
     session = get_session()
     year = request_arg('year', int, default=None)
     bid = request_arg('bid', int, default=None)
-
-    query = dal.weekday_stats(session, year, bid)
+    start, end = request_date_range()
 
     rows = []
-    for row in query.all():
-        result = row.stats
-        result['weekday'] = row.weekday
-        rows.append(result)
+    for weekday, stats in current_cube(session).weekday_stats(year, bid, start, end):
+        stats['weekday'] = str(weekday)
+        rows.append(stats)
 
     return json_response({'rows': rows})
 
@@ -304,14 +321,12 @@ def year_over_year_stats():
     session = get_session()
     year = request_arg('year', int, default=None)
     bid = request_arg('bid', int, default=None)
-
-    query = dal.yearly_stats(session, year, bid)
+    start, end = request_date_range()
 
     rows = []
-    for row in query.all():
-        result = row.stats
-        result['year'] = row.year
-        rows.append(result)
+    for row_year, stats in current_cube(session).yearly_stats(year, bid, start, end):
+        stats['year'] = row_year
+        rows.append(stats)
 
     return json_response({'rows': rows})
 
@@ -328,13 +343,12 @@ def daily_stats():
     year = request_arg('year', int)
     bid = request_arg('bid', int, default=None)
     statistic = request_arg('statistic', str)
+    start, end = request_date_range()
 
-    try:
-        query = dal.daily_statistic(session, statistic, year, bid)
-    except dal.DalParameterError as dpe:
-        raise APIError(str(dpe))
+    if statistic not in STATISTICS:
+        raise APIError('Invalid statistic %r, choose from: %s' % (statistic, ', '.join(STATISTICS)))
 
-    rows = query.all()
+    rows = list(current_cube(session).daily_stats(year, bid, start, end))
 
     start_date = datetime.date(year, 1, 1)
     actual_start_date = None
@@ -347,8 +361,8 @@ def daily_stats():
     series = [
     ]
 
-    for row in rows:
-        day_of_year = row.day_of_year - 1  # Postgres doy is 1-365/366 (leap years have 366 days)
+    for day_of_year, stats in rows:
+        day_of_year -= 1  # Postgres doy is 1-365/366 (leap years have 366 days)
         date = start_date + day_of_year * day
         if not actual_start_date:
             actual_start_date = date
@@ -356,7 +370,7 @@ def daily_stats():
         if not series or week_of_the_year != series[-1]['name']:
             series.append(dict(name=week_of_the_year, series=week()))
 
-        series[-1]['series'][date.weekday()]['value'] = row.stats[statistic]
+        series[-1]['series'][date.weekday()]['value'] = stats[statistic]
 
     if rows:
         # Trim first week to actual week length
@@ -455,38 +469,110 @@ def parse_textual_query(textual_query: str, fields, default_slop=0):
     return {'bool': bool_query}
 
 
-@app.route('/api/search')
-@cache_api_view
-def search():
-    content = request_arg('content', str)
-    type = request_arg('type', str)
-    sort = request_arg('sort', str, default='score')
-    offset = request_arg('offset', int, default=0)
-    if type not in ('post', 'thread'):
-        raise APIError('Invalid value for type: %r' % type)
+def parse_textual_tsquery(textual_query: str):
+    """
+    Full-text search (tsquery) equivalent of parse_textual_query for the postgres search backend:
+    "phrases" and +terms must match, -terms must not, and at least one of the other terms must match.
+    """
+    must = []
+    must_not = []
+    stray = []
+    for token in tokenize_query(textual_query):
+        token_type = token[0]
+        token_value = token[1:]
+        if token_type == '"':
+            must.append(func.phraseto_tsquery('german', token_value))
+        elif token_type == '+':
+            must.append(func.plainto_tsquery('german', token_value))
+        elif token_type == '-':
+            must_not.append(func.tsquery_not(func.plainto_tsquery('german', token_value)))
+        else:
+            stray.append(func.plainto_tsquery('german', token))
+    if stray:
+        must.append(functools.reduce(func.tsquery_or, stray))
+    if not must and not must_not:
+        # Like for elasticsearch, an empty query matches nothing.
+        must.append(func.plainto_tsquery('german', ''))
+    return functools.reduce(func.tsquery_and, must + must_not)
 
-    oid = 'pid' if type == 'post' else 'tid'
 
-    # sue me, mccabe
+def parse_textual_index_query(textual_query: str):
+    """
+    inverted_index.Query equivalent of parse_textual_query for the local search backend,
+    with the same semantics as parse_textual_tsquery.
+    """
+    query = inverted_index.Query(phrases=[], required=[], excluded=[], optional=[])
+    for token in tokenize_query(textual_query):
+        token_type = token[0]
+        token_value = token[1:]
+        if token_type == '"':
+            clauses, terms = query.phrases, inverted_index.tokenize(token_value)
+        elif token_type == '+':
+            clauses, terms = query.required, inverted_index.tokenize(token_value)
+        elif token_type == '-':
+            clauses, terms = query.excluded, inverted_index.tokenize(token_value)
+        else:
+            clauses, terms = query.optional, inverted_index.tokenize(token)
+        if terms:
+            clauses.append(terms)
+    return query
+
+
+# Hits per page of /api/search.
+SEARCH_PAGE_SIZE = 30
+
+# Elasticsearch queries run here, so the request thread can do other work meanwhile.
+search_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='search')
+
+# For hydrating post hits: pid -> (tid, poster_uid, timestamp), which never changes,
+# and uid -> (name, aliases) / tid -> (title, subtitle), which are looked up again after ten minutes.
+post_hit_cache = LRUCache(maxsize=100000)
+user_name_cache = LRUCache(maxsize=20000, ttl=600)
+thread_title_cache = LRUCache(maxsize=20000, ttl=600)
 
+
+@functools.lru_cache(maxsize=None)
+def search_client():
+    # One client (and connection pool) per process.
+    return config.elasticsearch_client()
+
+
+def encode_search_cursor(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode()
+
+
+def decode_search_cursor(cursor, sort):
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise APIError('Malformed cursor')
+    if (not isinstance(sort_values, list) or len(sort_values) != (2 if sort == 'score' else 1)
+            or not all(isinstance(value, (int, float)) for value in sort_values)):
+        raise APIError('Malformed cursor')
+    return sort_values
+
+
+def search_elasticsearch(type, content, sort, after, size, facets=False):
+    oid = 'pid' if type == 'post' else 'tid'
+
+    # The id makes the sort values of each hit unique, as search_after requires.
     if sort == 'score':
-        sorting = ['_score']
+        sorting = [
+            '_score',
+            {oid: {'order': 'asc'}},
+        ]
     elif sort == 'date-asc':
         sorting = [
             {oid: {'order': 'asc'}},
-            '_score',
         ]
-    elif sort == 'date-desc':
+    else:
         sorting = [
             {oid: {'order': 'desc'}},
-            '_score',
         ]
-    else:
-        raise APIError('Invalid value for sort: %r' % sort)
 
-    session = get_session()
-    t0 = time.perf_counter()
-    es = config.elasticsearch_client()
+    es = search_client()
+    if not es:
+        raise APIError('Search is not available.', status_code=503)
 
     if type == 'post':
         parser_kwargs = dict(
@@ -500,9 +586,8 @@ def search():
 
     query = parse_textual_query(content, **parser_kwargs)
 
-    es_result = es.search(index=type, body={
-        'from': offset,
-        'size': 30,
+    body = {
+        'size': size,
         'query': query,
         'highlight': {
             'encoder': 'html',
@@ -514,7 +599,26 @@ def search():
             },
         },
         'sort': sorting,
-    })
+        # Scores are returned when sorting by date, too.
+        'track_scores': True,
+    }
+    if after:
+        body['search_after'] = after
+    if facets:
+        # Counted over all hits in the same request, not only over this page.
+        body['aggs'] = {
+            'years': {
+                'date_histogram': {
+                    'field': 'timestamp',
+                    'calendar_interval': 'year',
+                    'format': 'yyyy',
+                    'min_doc_count': 1,
+                },
+            },
+            'boards': {'terms': {'field': 'bid', 'size': 1000}},
+            'posters': {'terms': {'field': 'poster_uid', 'size': inverted_index.TOP_POSTERS}},
+        }
+    es_result = es.search(index=type, body=body)
     count = es_result['hits']['total']['value']
 
     if type == 'post':
@@ -524,19 +628,6 @@ def search():
             poster_uid=r['_source']['poster_uid'],
             snippet=' … '.join(r['highlight']['content']),
         ) for r in es_result['hits']['hits']]
-
-        posts = dict(
-            session
-            .query(db.Post.pid, db.Post)
-            .options(joinedload('poster'), joinedload('thread'))
-            .filter(db.Post.pid.in_([result['pid'] for result in results]))
-            .all()
-        )
-        for result in results:
-            post = posts[result['pid']]
-            result['user'] = post.poster
-            result['thread'] = post.thread
-            result['timestamp'] = post.timestamp.timestamp()
     else:
         results = [dict(
             score=r['_score'],
@@ -545,13 +636,195 @@ def search():
             tid=int(r['_id']),
         ) for r in es_result['hits']['hits']]
 
-    td = time.perf_counter() - t0
-    return json_response({
+    facet_counts = None
+    if facets:
+        aggregations = es_result['aggregations']
+        facet_counts = dict(
+            years=sorted((int(bucket['key_as_string']), bucket['doc_count'])
+                         for bucket in aggregations['years']['buckets']),
+            boards=[(bucket['key'], bucket['doc_count']) for bucket in aggregations['boards']['buckets']],
+            posters=[(bucket['key'], bucket['doc_count']) for bucket in aggregations['posters']['buckets']],
+        )
+    return count, results, facet_counts
+
+
+def search_postgres(session, type, content, sort, after, size, facets=False):
+    tsquery = parse_textual_tsquery(content)
+    facet_counts = None
+    if type == 'post':
+        count, rows = dal.search_posts(session, tsquery, sort, after, size)
+        if facets:
+            facet_counts = dal.search_post_facets(session, tsquery, inverted_index.TOP_POSTERS)
+        results = [dict(
+            score=row.score,
+            pid=row.pid,
+            poster_uid=row.poster_uid,
+            snippet=row.snippet,
+        ) for row in rows]
+    else:
+        count, rows = dal.search_threads(session, tsquery, sort, after, size)
+        results = [dict(
+            score=row.score,
+            title=row.title,
+            subtitle=row.subtitle,
+            tid=row.tid,
+        ) for row in rows]
+    return count, results, facet_counts
+
+
+def search_local(session, type, content, sort, after, size, facets=False):
+    if type == 'thread':
+        # Only posts are in the inverted index, thread titles are searched in the database.
+        return search_postgres(session, type, content, sort, after, size)
+    index = inverted_index.current_index()
+    if not index:
+        raise APIError('Search is not available.', status_code=503)
+    count, hits, facet_counts = index.search(parse_textual_index_query(content), sort, after, size, facets)
+    results = [dict(
+        score=hit.score,
+        pid=hit.pid,
+        poster_uid=hit.poster_uid,
+        snippet=hit.snippet,
+    ) for hit in hits]
+    return count, results, facet_counts
+
+
+@app.route('/api/search')
+@cache_api_view
+def search():
+    """
+    Full-text search of posts or threads
+
+    Query parameters:
+    - content: the query, see tokenize_query
+    - type: post or thread
+    - sort: score (default), date-asc or date-desc
+    - facets: 1 to also count all post hits per year, per board and of the top posters ("facets")
+
+    Pages have 30 hits. If there are more, the response has a "next" URL for the next page
+    (with an opaque "after" cursor). The Server-Timing header has the time spent in the search backend
+    ("search"), on loading users and threads of post hits ("hydration") and on serializing the response.
+    """
+    content = request_arg('content', str)
+    type = request_arg('type', str)
+    sort = request_arg('sort', str, default='score')
+    cursor = request_arg('after', str, default=None)
+    facets = bool(request_arg('facets', int, default=0))
+    if type not in ('post', 'thread'):
+        raise APIError('Invalid value for type: %r' % type)
+    if facets and type != 'post':
+        raise APIError('Facets are only available for posts')
+    if sort not in ('score', 'date-asc', 'date-desc'):
+        raise APIError('Invalid value for sort: %r' % sort)
+    after = decode_search_cursor(cursor, sort) if cursor else None
+
+    session = get_session()
+    t0 = time.perf_counter()
+
+    # One more than a page, to know whether there is a next one.
+    backend = config.search_backend()
+    if backend == 'postgres':
+        count, results, facet_counts = search_postgres(session, type, content, sort, after, SEARCH_PAGE_SIZE + 1,
+                                                       facets)
+    elif backend == 'local':
+        count, results, facet_counts = search_local(session, type, content, sort, after, SEARCH_PAGE_SIZE + 1,
+                                                    facets)
+    else:
+        hits = search_executor.submit(search_elasticsearch, type, content, sort, after, SEARCH_PAGE_SIZE + 1,
+                                      facets)
+        # Independent of the hits: check out a database connection while Elasticsearch is busy.
+        session.connection()
+        count, results, facet_counts = hits.result()
+    t1 = time.perf_counter()
+
+    next_url = None
+    if len(results) > SEARCH_PAGE_SIZE:
+        del results[SEARCH_PAGE_SIZE:]
+        oid = 'pid' if type == 'post' else 'tid'
+        sort_values = dal.search_sort_values(sort, results[-1]['score'], results[-1][oid])
+        next_url = url_for('search', content=content, type=type, sort=sort, after=encode_search_cursor(sort_values),
+                           facets=int(facets) if facets else None)
+
+    if type == 'post':
+        results = hydrate_post_hits(session, results)
+    if facets:
+        facet_counts = hydrate_search_facets(session, facet_counts)
+    t2 = time.perf_counter()
+
+    response = {
         'count': count,
         'type': type,
         'results': results,
-        'elapsed': td
-    })
+    }
+    if next_url:
+        response['next'] = next_url
+    if facets:
+        response['facets'] = facet_counts
+    data = json.dumps(response, cls=DatabaseAwareJsonEncoder)
+    t3 = time.perf_counter()
+    timing = ', '.join('%s;dur=%.1f' % (name, elapsed * 1000) for name, elapsed in (
+        ('search', t1 - t0),
+        ('hydration', t2 - t1),
+        ('serialization', t3 - t2),
+    ))
+    return Response(data, mimetype='application/json', headers={'Server-Timing': timing})
+
+
+def hydrate_post_hits(session, results):
+    """
+    Add user, thread and timestamp to post hits.
+
+    Only the needed columns are selected, and only for pids, users and threads not in the LRU caches.
+    Hits of posts which are not in the database (anymore) are dropped.
+    """
+    posts = post_hit_cache.get_many([result['pid'] for result in results],
+                                    functools.partial(dal.post_hits, session))
+    results = [result for result in results if result['pid'] in posts]
+    users = user_name_cache.get_many({posts[result['pid']][1] for result in results},
+                                     functools.partial(dal.user_names, session))
+    threads = thread_title_cache.get_many({posts[result['pid']][0] for result in results},
+                                          functools.partial(dal.thread_titles, session))
+    for result in results:
+        tid, uid, timestamp = posts[result['pid']]
+        name, aliases = users.get(uid, (None, []))
+        title, subtitle = threads.get(tid, (None, None))
+        result['user'] = {
+            'name': name,
+            'uid': uid,
+            'aliases': aliases,
+        }
+        result['thread'] = {
+            'tid': tid,
+            'title': title,
+            'subtitle': subtitle,
+        }
+        result['timestamp'] = timestamp.timestamp()
+    return results
+
+
+def hydrate_search_facets(session, facets):
+    """
+    Add board and user names to the (key, count) lists of search facets.
+    """
+    boards = dict(session.query(Board.bid, Board.name).filter(Board.bid.in_([bid for bid, _ in facets['boards']])))
+    users = user_name_cache.get_many({uid for uid, _ in facets['posters']},
+                                     functools.partial(dal.user_names, session))
+    posters = []
+    for uid, count in facets['posters']:
+        name, aliases = users.get(uid, (None, []))
+        posters.append({
+            'user': {
+                'name': name,
+                'uid': uid,
+                'aliases': aliases,
+            },
+            'count': count,
+        })
+    return {
+        'years': [{'year': year, 'count': count} for year, count in facets['years']],
+        'boards': [{'bid': bid, 'name': boards.get(bid), 'count': count} for bid, count in facets['boards']],
+        'posters': posters,
+    }
 
 
 @app.route('/api/')
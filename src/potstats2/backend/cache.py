@@ -3,6 +3,8 @@ import marshal
 import functools
 import hashlib
 import gzip
+import threading
+import time
 
 try:
     import redis
@@ -137,6 +139,54 @@ def get_stats():
     return stats
 
 
+class LRUCache:
+    """
+    Small in-process LRU cache of database lookups, filled in batches. Thread-safe.
+
+    Entries older than *ttl* seconds (if given) are looked up again.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys, load):
+        """
+        Values of *keys* as a dict. Missing keys are looked up in one go by load(missing_keys),
+        which returns a dict as well; keys it doesn't return are left out.
+        """
+        now = time.monotonic()
+        values = {}
+        with self.lock:
+            for key in keys:
+                try:
+                    value, loaded = self.entries[key]
+                except KeyError:
+                    continue
+                if self.ttl is not None and now - loaded > self.ttl:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                values[key] = value
+        missing = set(keys) - values.keys()
+        if missing:
+            loaded_values = load(missing)
+            with self.lock:
+                for key, value in loaded_values.items():
+                    self.entries[key] = value, now
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            values.update(loaded_values)
+        return values
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 def invalidate():
     if cache_db:
         cache_db.flushdb()
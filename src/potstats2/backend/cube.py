@@ -0,0 +1,286 @@
+import threading
+from time import perf_counter
+
+import numpy as np
+from pyroaring import BitMap
+
+from ..db import Board, DailyStats, DataVersion, ActiveUserRollup
+
+# Summed columns of DailyStats.
+SUM_COLUMNS = ('post_count', 'edit_count', 'posts_length', 'threads_created')
+# Statistics of each row of the stats endpoints.
+STATISTICS = ('post_count', 'edit_count', 'threads_created', 'avg_post_length', 'active_users')
+DAYS = 366
+
+
+def date_dimension(years):
+    """
+    Month and ISO weekday (1 = Monday) of each day of *years*, two arrays of shape (len(years), 366).
+    Day 366 of years with only 365 days has month and weekday 0.
+    """
+    first_days = np.array(['%d-01-01' % year for year in years], dtype='datetime64[D]')
+    days = first_days[:, np.newaxis] + np.arange(DAYS)
+    # Day 0 (1970-01-01) was a Thursday.
+    weekday = (days.astype(np.int64) + 3) % 7 + 1
+    month = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    other_year = days.astype('datetime64[Y]') != first_days.astype('datetime64[Y]')[:, np.newaxis]
+    weekday[other_year] = month[other_year] = 0
+    return month, weekday
+
+
+def calculate_stats(sums):
+    post_count = sums['post_count']
+    return {
+        'post_count': post_count,
+        'edit_count': sums['edit_count'],
+        'threads_created': sums['threads_created'],
+        # Integer division, like in the database.
+        'avg_post_length': sums['posts_length'] // post_count if post_count else None,
+    }
+
+
+class DailyStatsCube:
+    """
+    DailyStats in memory, for the stats endpoints.
+
+    Sums are NumPy arrays of shape (years, 366, boards), the active users of each cell are deserialized
+    bitmaps in an object array of the same shape. *present* marks the cells which have a row.
+    Active users of years and weekdays come from the ActiveUserRollup bitmaps instead of the cells.
+
+    Days are also numbered consecutively (year index * 366 + day of year - 1). *cumulative* has the prefix sums
+    of each board by that number (shape (years * 366, boards)), so the sums of any range of days are the
+    difference of two rows.
+    """
+
+    def __init__(self, session):
+        t0 = perf_counter()
+        rows = session.query(DailyStats.year, DailyStats.day_of_year, DailyStats.bid,
+                             *[getattr(DailyStats, name) for name in SUM_COLUMNS],
+                             *[getattr(DailyStats, 'cumulative_' + name) for name in SUM_COLUMNS],
+                             DailyStats.active_users).all()
+        self.boards = {row.bid: (row.name, row.description)
+                       for row in session.query(Board.bid, Board.name, Board.description)}
+
+        columns = list(zip(*rows)) or [()] * (4 + 2 * len(SUM_COLUMNS))
+        year, day_of_year, bid = (np.array(column, dtype=np.int64) for column in columns[:3])
+        self.first_year = year.min() if len(year) else 0
+        self.years = np.arange(self.first_year, year.max() + 1 if len(year) else 0)
+        self.bids = np.unique(bid)
+        shape = len(self.years), DAYS, len(self.bids)
+        cells = year - self.first_year, day_of_year - 1, np.searchsorted(self.bids, bid)
+
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[cells] = True
+        self.sums = {}
+        for name, column in zip(SUM_COLUMNS, columns[3:]):
+            self.sums[name] = np.zeros(shape, dtype=np.int64)
+            self.sums[name][cells] = [value or 0 for value in column]
+        self.active_users = np.empty(shape, dtype=object)
+        self.active_users[cells] = [BitMap.deserialize(value) for value in columns[-1]]
+        self.month, self.weekday = date_dimension(self.years)
+        self.month_lengths = np.stack([(self.month == month).sum(axis=1) for month in range(13)], axis=1)
+        self.year_lengths = self.month_lengths[:, 1:].sum(axis=1)
+
+        # Days without a row have the prefix sums of the last day with one before them (0 before the first).
+        day = cells[0] * DAYS + cells[1]
+        board = np.arange(len(self.bids))
+        last_day = np.full((len(self.years) * DAYS, len(self.bids)), -1)
+        last_day[day, cells[2]] = day
+        last_day = np.maximum.accumulate(last_day, axis=0)
+        self.cumulative = {}
+        for name, column in zip(SUM_COLUMNS, columns[3 + len(SUM_COLUMNS):]):
+            values = np.zeros(last_day.shape, dtype=np.int64)
+            values[day, cells[2]] = column
+            self.cumulative[name] = np.where(last_day >= 0, values[last_day, board], 0)
+
+        self.rollups = {}
+        for row in session.query(ActiveUserRollup):
+            key = row.year, row.month, row.weekday, row.bid
+            self.rollups[key] = row.user_count, BitMap.deserialize(row.active_users)
+        print('Loaded {} daily stats and {} active user rollups in {:.1f} s.'.format(
+            len(rows), len(self.rollups), perf_counter() - t0))
+
+    def select(self, year=None, bid=None):
+        """Index of the cells of *year* and board *bid* (or all of them), keeping all three axes."""
+        years = boards = slice(None)
+        if year:
+            index = year - self.first_year
+            years = slice(index, index + 1) if 0 <= index < len(self.years) else slice(0, 0)
+        if bid:
+            index = np.searchsorted(self.bids, bid)
+            boards = slice(index, index + 1) if index < len(self.bids) and self.bids[index] == bid else slice(0, 0)
+        return years, slice(None), boards
+
+    def day_number(self, date):
+        return (date.year - self.first_year) * DAYS + date.timetuple().tm_yday - 1
+
+    def day_range(self, year=None, start=None, end=None):
+        """First and last day number of *year* and the dates *start* to *end* (inclusive), within the cube."""
+        first, last = 0, len(self.years) * DAYS - 1
+        if year:
+            first = max(first, (year - self.first_year) * DAYS)
+            last = min(last, (year - self.first_year + 1) * DAYS - 1)
+        if start:
+            first = max(first, self.day_number(start))
+        if end:
+            last = min(last, self.day_number(end))
+        return first, last
+
+    def range_sums(self, first, last, boards):
+        """Sums of days *first* to *last* of *boards*: two lookups per board in the prefix sums."""
+        return {name: values[last, boards] - (values[first - 1, boards] if first else 0)
+                for name, values in self.cumulative.items()}
+
+    def range_user_count(self, first, last, bid=None):
+        """
+        Number of active users on days *first* to *last* of board *bid* (or all boards).
+
+        Whole years and months within the range are taken from the rollups, only the days of partial months
+        at its ends (and of years and months without a rollup) are unioned from the cells.
+        """
+        boards = self.select(bid=bid)[2]
+        rollups = []
+        bitmaps = []
+        day = first
+        while day <= last:
+            year_index, day_of_year = divmod(day, DAYS)
+            year, month = int(self.years[year_index]), int(self.month[year_index, day_of_year])
+            month_start = month and (not day_of_year or self.month[year_index, day_of_year - 1] != month)
+            if not day_of_year and day + self.year_lengths[year_index] - 1 <= last:
+                key, length = (year, 0, 0, bid or 0), DAYS
+            elif month_start and day + self.month_lengths[year_index, month] - 1 <= last:
+                key, length = (year, month, 0, bid or 0), self.month_lengths[year_index, month]
+            else:
+                key, length = None, 1
+            if key in self.rollups:
+                rollups.append(self.rollups[key])
+            else:
+                days = slice(day_of_year, day_of_year + length)
+                present = self.present[year_index, days, boards]
+                bitmaps.extend(self.active_users[year_index, days, boards][present])
+            day += length
+        if len(rollups) == 1 and not bitmaps:
+            return rollups[0][0]
+        bitmaps += [users for count, users in rollups]
+        return len(BitMap.union(*bitmaps)) if bitmaps else 0
+
+    def aggregate(self, cells, labels, active_users=True, mask=None):
+        """
+        Group the rows in *cells* (and *mask*) by *labels* (both broadcast to the shape of the cells) and sum
+        them up, like dal._daily_stats_agg_query. Yields (label, stats) in the order of the labels.
+        """
+        present = self.present[cells]
+        if mask is not None:
+            present = present & mask
+        rows = np.flatnonzero(present)
+        if not len(rows):
+            return
+        labels = np.broadcast_to(labels, present.shape).ravel()[rows]
+        order = np.argsort(labels, kind='stable')
+        rows, labels = rows[order], labels[order]
+        starts = np.flatnonzero(np.diff(labels, prepend=labels[0] - 1))
+        ends = np.append(starts[1:], len(rows))
+        sums = {name: np.add.reduceat(values[cells].ravel()[rows], starts).tolist()
+                for name, values in self.sums.items()}
+        bitmaps = self.active_users[cells].ravel()[rows] if active_users else None
+
+        for group, (start, end) in enumerate(zip(starts, ends)):
+            stats = calculate_stats({name: values[group] for name, values in sums.items()})
+            if active_users:
+                stats['active_users'] = len(BitMap.union(*bitmaps[start:end]))
+            yield labels[start].item(), stats
+
+    def day_users(self, year, weekday=0, bid=None):
+        """Active user bitmaps of each day of *year* (with *weekday*) and board *bid* (or all boards)."""
+        index = year - self.first_year
+        boards = self.select(bid=bid)[2]
+        present = self.present[index, :, boards]
+        if weekday:
+            present = present & (self.weekday[index] == weekday)[:, np.newaxis]
+        return self.active_users[index, :, boards][present]
+
+    def rollup_user_count(self, years, weekday=0, bid=None):
+        """
+        Number of active users in the union of the rollups of *years* for *weekday* and *bid*.
+
+        Years without a rollup (e.g. baked before there were any) are unioned from their days instead.
+        """
+        rollups = []
+        bitmaps = []
+        for year in years:
+            key = year, 0, weekday, bid or 0
+            if key in self.rollups:
+                rollups.append(self.rollups[key])
+            else:
+                bitmaps.extend(self.day_users(year, weekday, bid))
+        if len(rollups) == 1 and not bitmaps:
+            return rollups[0][0]
+        bitmaps += [users for count, users in rollups]
+        return len(BitMap.union(*bitmaps)) if bitmaps else 0
+
+    def yearly_stats(self, year=None, bid=None, start=None, end=None):
+        """(year, stats) of each year, or only of *year*, counting only the days from *start* to *end*."""
+        boards = self.select(bid=bid)[2]
+        first, last = self.day_range(year, start, end)
+        if first > last:
+            return
+        for year_index in range(first // DAYS, last // DAYS + 1):
+            year_first, year_last = max(first, year_index * DAYS), min(last, (year_index + 1) * DAYS - 1)
+            sums = self.range_sums(year_first, year_last, boards)
+            stats = calculate_stats({name: int(values.sum()) for name, values in sums.items()})
+            if not stats['post_count']:
+                continue
+            stats['active_users'] = self.range_user_count(year_first, year_last, bid)
+            yield int(self.years[year_index]), stats
+
+    def day_mask(self, years, year=None, start=None, end=None):
+        """Mask of the days of *years* (a slice) from *start* to *end*, shaped like cells."""
+        first, last = self.day_range(year, start, end)
+        day = np.arange(len(self.years) * DAYS).reshape(len(self.years), DAYS)[years]
+        return ((day >= first) & (day <= last))[:, :, np.newaxis]
+
+    def daily_stats(self, year, bid=None, start=None, end=None):
+        """(day of year, stats) of each day of *year* with posts, from *start* to *end*."""
+        years, days, boards = self.select(year, bid)
+        mask = self.day_mask(years, year, start, end) if start or end else None
+        return self.aggregate((years, days, boards), np.arange(1, DAYS + 1)[:, np.newaxis], mask=mask)
+
+    def weekday_stats(self, year=None, bid=None, start=None, end=None):
+        """(ISO weekday, stats) of each weekday, counting only the days from *start* to *end*."""
+        years, days, boards = self.select(year, bid)
+        labels = self.weekday[years][:, :, np.newaxis]
+        if start or end:
+            # Active users of parts of years can't be taken from the rollups.
+            yield from self.aggregate((years, days, boards), labels, mask=self.day_mask(years, year, start, end))
+            return
+        for weekday, stats in self.aggregate((years, days, boards), labels, active_users=False):
+            stats['active_users'] = self.rollup_user_count(self.years[years].tolist(), weekday=weekday, bid=bid)
+            yield weekday, stats
+
+    def board_stats(self, year=None, start=None, end=None):
+        """(bid, stats without active users) of each board with posts in *year* and from *start* to *end*."""
+        first, last = self.day_range(year, start, end)
+        if first > last:
+            return
+        sums = self.range_sums(first, last, slice(None))
+        for index in np.flatnonzero(sums['post_count']):
+            yield int(self.bids[index]), calculate_stats({name: int(values[index]) for name, values in sums.items()})
+
+
+_current_cube = None
+_cube_lock = threading.Lock()
+
+
+def current_cube(session):
+    """The cube of the current data version, loaded again once the data changed."""
+    global _current_cube
+    version = DataVersion.get(session)
+    cube = _current_cube
+    if not cube or cube[0] != version:
+        # Loading takes a while, only one thread does it.
+        with _cube_lock:
+            cube = _current_cube
+            if not cube or cube[0] != version:
+                cube = version, DailyStatsCube(session)
+                _current_cube = cube
+    return cube[1]
@@ -22,6 +22,11 @@ SETTINGS = {
                   'postgresql://localhost/potstats2'),
     'REQUEST_DELAY': Setting('Delay between requests, not including request processing time.', '0.1'),
     'DEBUG': Setting('Enable post-mortem debugging', 'True'),
+    'CACHE_DIR': Setting('Directory for on-disk extracts and caches (e.g. the post facts used by the bakes).',
+                         '~/.cache/potstats2'),
+    'SEARCH_BACKEND': Setting('Search backend: "elasticsearch", "postgres" (full-text search in the database) '
+                              'or "local" (an inverted index in CACHE_DIR). '
+                              'Defaults to elasticsearch if it is installed.', None),
     'REDIS_URL': Setting('URL for accessing a Redis cache server, '
                          'see http://redis-py.readthedocs.io/en/latest/index.html?highlight=from_url#redis.ConnectionPool.from_url', None),
 }
@@ -86,6 +91,13 @@ def setup_debugger():
     faulthandler.register(signal.SIGUSR1)
 
 
+def search_backend():
+    backend = get('SEARCH_BACKEND') or ('elasticsearch' if elasticsearch else 'postgres')
+    if backend not in ('elasticsearch', 'postgres', 'local'):
+        raise ConfigurationError('Unknown SEARCH_BACKEND %r (elasticsearch, postgres or local)' % backend)
+    return backend
+
+
 def elasticsearch_client():
-    if elasticsearch:
+    if elasticsearch and search_backend() == 'elasticsearch':
         return elasticsearch.Elasticsearch(timeout=None)
@@ -1,11 +1,13 @@
+import html
+from collections import namedtuple
 from datetime import datetime
 from functools import partial
-from sqlalchemy import func, cast, Float, desc, column, tuple_, Integer, and_, Date, text, Interval
+from sqlalchemy import func, cast, Float, desc, column, tuple_, Integer, and_, or_, Date, text, Interval
 from sqlalchemy.orm import aliased, Bundle
 from sqlalchemy.util import lightweight_named_tuple
 
 from .db import User, Board, Thread, Post
-from .db import PostQuotes
+from .db import PostQuotes, PostSearch
 from .db import LinkRelation
 from .db import PosterStats, DailyStats, QuoteRelation
 
@@ -33,7 +35,7 @@ def apply_year_filter(query, year=None):
 def apply_board_filter(query, bid=None):
 
     if bid:
-        query = query.filter(Post.thread.has(Thread.bid == bid))
+        query = query.filter(Post.bid == bid)
     return query
 
 
@@ -54,54 +56,51 @@ def poster_stats_agg(session, post_count_cutoff=25):
 
     Note: total length of all posts is post_count * avg_post_length.
     """
-    year = func.extract('year', Post.timestamp).label('year')
+    year = Post.year
     threads_opened = (
         session
         .query(
             Post.poster_uid,
-            Thread.bid,
+            Post.bid,
             year,
             func.count(Thread.tid).label('threads_created'),
         )
         .join(Thread, Thread.first_pid == Post.pid)
-    ).group_by(year, Thread.bid, Post.poster_uid).subquery('threads_opened')
+    ).group_by(year, Post.bid, Post.poster_uid).subquery('threads_opened')
 
     post_stats = (
         session
         .query(
-            Thread.bid,
+            Post.bid,
             year,
             Post.poster_uid,
             func.count(Post.pid).label('post_count'),
             func.sum(Post.edit_count).label('edit_count'),
             cast(func.avg(Post.content_length), Integer).label('avg_post_length'),
         )
-        .join(Post.thread)
-    ).group_by(year, Thread.bid, Post.poster_uid).subquery('post_stats')
+    ).group_by(year, Post.bid, Post.poster_uid).subquery('post_stats')
 
     quoted_stats = (
         session
         .query(
-            Thread.bid,
+            Post.bid,
             year,
             Post.poster_uid,
             func.count(PostQuotes.count).label('quoted_count'),
         )
-        .join(Post.thread)
         .join(PostQuotes, PostQuotes.quoted_pid == Post.pid)
-    ).group_by(year, Thread.bid, Post.poster_uid).subquery('quoted_stats')
+    ).group_by(year, Post.bid, Post.poster_uid).subquery('quoted_stats')
 
     quotes_stats = (
         session
         .query(
-            Thread.bid,
+            Post.bid,
             year,
             Post.poster_uid,
             func.count(PostQuotes.count).label('quotes_count'),
         )
-        .join(Post.thread)
         .join(PostQuotes, PostQuotes.pid == Post.pid)
-    ).group_by(year, Thread.bid, Post.poster_uid).subquery('quotes_stats')
+    ).group_by(year, Post.bid, Post.poster_uid).subquery('quotes_stats')
 
     query = (
         session
@@ -197,16 +196,17 @@ def poster_developmental_issues(session, uid, bid=None):
     return query.from_self()
 
 
-def aggregate_stats_segregated_by_time(session, time_column_expression, time_column_name):
+def aggregate_stats_segregated_by_time(session, time_column_expression, time_column_name, with_active_users=True):
     """
     Aggregate (across all users) statistics on posts and threads, grouped by time_column_expression.
 
     Result columns:
     time (=time_column_expression),
-    post_count, edit_count, avg_post_length, threads_created
+    post_count, edit_count, avg_post_length, threads_created,
+    active_users (array of uids, only if with_active_users)
 
-    time_column_expression is suggested to be something like ``func.to_char(Post.timestamp, 'ID')``
-    or ``func.extract('year', Post.timestamp)`` but could in fact be pretty much any column expression.
+    time_column_expression is suggested to be one of the precomputed time columns of Post
+    (``Post.year``, ``Post.day_of_year``) but could in fact be pretty much any column expression.
 
     Note that time_column_expression is used in two slightly different contexts:
     For post statistics it applies to each post individually, while for thread statistics
@@ -216,7 +216,7 @@ def aggregate_stats_segregated_by_time(session, time_column_expression, time_col
     - https://www.postgresql.org/docs/current/static/functions-formatting.html
     - https://www.postgresql.org/docs/10/static/functions-datetime.html
     """
-    year = func.extract('year', Post.timestamp).label('year')
+    year = Post.year
     post_query = (
         session
         .query(
@@ -225,10 +225,9 @@ def aggregate_stats_segregated_by_time(session, time_column_expression, time_col
             func.sum(Post.edit_count).label('edit_count'),
             func.sum(Post.content_length).label('posts_length'),
             time_column_expression.label('time'),
-            Board.bid
+            Post.bid
         )
-        .join('thread', 'board')
-        .group_by('time', 'year', Board.bid)
+        .group_by('time', 'year', Post.bid)
     ).subquery()
     threads_query = (
         session
@@ -241,17 +240,33 @@ def aggregate_stats_segregated_by_time(session, time_column_expression, time_col
         .join(Thread.first_post)
         .group_by('time', 'year', Thread.bid)
     ).subquery()
+    query = (
+        session
+        .query('post_count', 'edit_count', 'posts_length',
+               # We don't need to COALESCE the post stats,
+               # because a created thread implies at least one post.
+               func.coalesce(threads_query.c.threads_created, 0).label('threads_created'),
+               post_query.c.time.label(time_column_name), post_query.c.year, post_query.c.bid)
+        .select_from(post_query)
+        .outerjoin(threads_query,
+                   and_(post_query.c.time == threads_query.c.time,
+                   post_query.c.year == threads_query.c.year,
+                   post_query.c.bid == threads_query.c.bid), full=True)
+        .order_by(post_query.c.time)
+    )
+    if not with_active_users:
+        return query
+
     user_sq = (
         session
         .query(
-            Thread.bid,
+            Post.bid,
             year,
             User.uid,
             time_column_expression.label('time'),
         )
         .join(Post.poster)
-        .join(Post.thread)
-        .group_by('time', 'year', Thread.bid, User.uid)
+        .group_by('time', 'year', Post.bid, User.uid)
     ).subquery()
     active_users_query = (
         session.query(
@@ -265,23 +280,12 @@ def aggregate_stats_segregated_by_time(session, time_column_expression, time_col
     ).subquery()
 
     query = (
-        session
-        .query('post_count', 'edit_count', 'posts_length',
-               # We don't need to COALESCE the post stats,
-               # because a created thread implies at least one post.
-               func.coalesce(threads_query.c.threads_created, 0).label('threads_created'),
-               'active_users',
-               post_query.c.time.label(time_column_name), post_query.c.year, post_query.c.bid)
-        .select_from(post_query)
-        .outerjoin(threads_query,
-                   and_(post_query.c.time == threads_query.c.time,
-                   post_query.c.year == threads_query.c.year,
-                   post_query.c.bid == threads_query.c.bid), full=True)
+        query
+        .add_columns(active_users_query.c.active_users)
         .outerjoin(active_users_query,
                    and_(post_query.c.time == active_users_query.c.time,
                    post_query.c.year == active_users_query.c.year,
                    post_query.c.bid == active_users_query.c.bid), full=True)
-        .order_by(post_query.c.time)
     )
     return query
 
@@ -297,8 +301,8 @@ def daily_statistics_agg(session):
     - active_threads: list of dicts of the most active threads (w.r.t. post count) of the day.
       Each dict consists of json_thread_columns (tid, [sub]title) plus "thread_post_count".
     """
-    year = func.extract('year', Post.timestamp).label('year')
-    cte = aggregate_stats_segregated_by_time(session, func.extract('doy', Post.timestamp), 'day_of_year').subquery()
+    year = Post.year
+    cte = aggregate_stats_segregated_by_time(session, Post.day_of_year, 'day_of_year').subquery()
 
     json_thread_columns = (Thread.tid, Thread.title, Thread.subtitle)
 
@@ -306,11 +310,11 @@ def daily_statistics_agg(session):
         session
             .query(*json_thread_columns,
                    func.count(Post.pid).label('thread_post_count'),
-                   func.extract('doy', Post.timestamp).label('doy'),
+                   Post.day_of_year.label('doy'),
                    year,
                    Thread.bid,
                    func.row_number().over(
-                       partition_by=tuple_(year, Thread.bid, func.extract('doy', Post.timestamp)),
+                       partition_by=tuple_(year, Thread.bid, Post.day_of_year),
                        order_by=tuple_(desc(func.count(Post.pid)), Thread.tid)
                    ).label('rank'))
             .join(Post.thread)
@@ -340,6 +344,49 @@ def daily_statistics_agg(session):
     )
 
 
+def daily_post_stats_agg(session):
+    """
+    Aggregate post and thread statistics for each day in each year, ordered by (year, day_of_year, bid).
+
+    Unlike daily_statistics_agg this computes neither active users (see daily_active_users) nor active threads.
+
+    Result columns:
+    - year, day_of_year, bid
+    - post_count, edit_count, posts_length, threads_created
+    - cumulative_post_count, cumulative_edit_count, cumulative_posts_length, cumulative_threads_created:
+      sums over all days of the board up to this one
+    """
+    cte = aggregate_stats_segregated_by_time(session, Post.day_of_year, 'day_of_year', with_active_users=False)
+    cte = cte.order_by(None).subquery()
+    columns = (cte.c.post_count, cte.c.edit_count, cte.c.posts_length, cte.c.threads_created)
+    cumulative_columns = [
+        func.sum(func.coalesce(column, 0))
+        .over(partition_by=cte.c.bid, order_by=(cte.c.year, cte.c.day_of_year))
+        .label('cumulative_' + column.name)
+        for column in columns
+    ]
+    return (
+        session
+        .query(cte.c.year, cte.c.day_of_year, cte.c.bid, *columns, *cumulative_columns)
+        .order_by(cte.c.year, cte.c.day_of_year, cte.c.bid)
+    )
+
+
+def daily_active_users(session):
+    """
+    Users who posted on each day in each year and board, ordered by (year, day_of_year, bid, uid).
+
+    Result columns: year, day_of_year, bid, uid
+    """
+    return (
+        session
+        .query(Post.year, Post.day_of_year, Post.bid, Post.poster_uid.label('uid'))
+        .filter(Post.poster_uid.isnot(None))
+        .distinct()
+        .order_by(Post.year, Post.day_of_year, Post.bid, Post.poster_uid)
+    )
+
+
 def _daily_stats_agg_query(session):
     agg = lambda f, c: f(c).label(c.name)
 
@@ -481,14 +528,13 @@ def social_graph_agg(session, count_cutoff=10):
     return (
         session
         .query(
-            func.extract('year', Post.timestamp).label('year'), Thread.bid,
+            Post.year, Post.bid,
             quoter.uid.label('quoter_uid'), quoted.uid.label('quoted_uid'), count)
         .join(Post, PostQuotes.post)
-        .join(Post.thread)
         .join(quoted_post, PostQuotes.quoted_post)
         .join(quoter, Post.poster)
         .join(quoted, quoted_post.poster)
-        .group_by('year', Thread.bid, quoter.uid, quoted.uid)
+        .group_by(Post.year, Post.bid, quoter.uid, quoted.uid)
         .having(count > count_cutoff)
     )
 
@@ -549,3 +595,143 @@ def domains(session, year=None, link_type=None):
     if link_type:
         query = query.filter(LinkRelation.type == link_type)
     return query
+
+
+# Fragments of the same post are joined like the highlights of elasticsearch. The selection markers are
+# private use characters, so that the content can be HTML-escaped around them (see search_snippet).
+HEADLINE_START, HEADLINE_STOP = '\ue000', '\ue001'
+HEADLINE_OPTIONS = 'StartSel={}, StopSel={}, MaxFragments=3, MinWords=10, MaxWords=25, FragmentDelimiter=" … "'.format(
+    HEADLINE_START, HEADLINE_STOP)
+# Like elasticsearch, count hits only up to this number.
+SEARCH_COUNT_LIMIT = 10000
+
+
+def search_snippet(headline):
+    """HTML snippet with <strong> highlights from a ts_headline with HEADLINE_OPTIONS."""
+    return html.escape(headline, quote=False).replace(HEADLINE_START, '<strong>').replace(HEADLINE_STOP, '</strong>')
+
+
+def apply_search_order(query, score, id_column, sort, after=None):
+    """
+    Order search hits by *sort* (score, date-asc or date-desc) and, for keyset pagination, restrict them
+    to those after the sort values (see search_sort_values) of the last hit of the previous page.
+    """
+    if sort == 'score':
+        query = query.order_by(desc(score), id_column)
+        if after:
+            after_score, after_id = after
+            query = query.filter(or_(score < after_score, and_(score == after_score, id_column > after_id)))
+    elif sort == 'date-asc':
+        query = query.order_by(id_column)
+        if after:
+            query = query.filter(id_column > after[0])
+    elif sort == 'date-desc':
+        query = query.order_by(desc(id_column))
+        if after:
+            query = query.filter(id_column < after[0])
+    else:
+        raise DalParameterError('Invalid sort: %r' % sort)
+    return query
+
+
+def search_sort_values(sort, score, id):
+    """Sort values of a search hit, which identify its position in the results for apply_search_order."""
+    return [score, id] if sort == 'score' else [id]
+
+
+SearchPostRow = namedtuple('SearchPostRow', 'pid poster_uid score snippet')
+
+
+def search_posts(session, tsquery, sort='score', after=None, limit=30):
+    """
+    Full-text search of posts (PostSearch) matching *tsquery*, sorted by *sort* (score, date-asc or date-desc),
+    starting after the hit with the sort values *after*.
+
+    Returns the number of hits (up to SEARCH_COUNT_LIMIT) and a page of rows:
+    pid, poster_uid, score, snippet (HTML).
+    """
+    matches = PostSearch.document.op('@@')(tsquery)
+    count = session.query(PostSearch.pid).filter(matches).limit(SEARCH_COUNT_LIMIT).count()
+
+    # As double precision: a real would be returned rounded, so the cursor of a hit wouldn't compare equal to it.
+    score = cast(func.ts_rank_cd(PostSearch.document, tsquery), Float)
+    # Computed only for the rows of the page, since the planner postpones expensive output columns past the LIMIT.
+    headline = func.ts_headline('german', PostSearch.content, tsquery, HEADLINE_OPTIONS).label('headline')
+    query = (
+        session
+        .query(PostSearch.pid, Post.poster_uid, score.label('score'), headline)
+        .join(Post, Post.pid == PostSearch.pid)
+        .filter(matches)
+    )
+    rows = apply_search_order(query, score, PostSearch.pid, sort, after).limit(limit).all()
+    return count, [SearchPostRow(row.pid, row.poster_uid, row.score, search_snippet(row.headline)) for row in rows]
+
+
+def search_threads(session, tsquery, sort='score', after=None, limit=30):
+    """
+    Full-text search of thread titles and subtitles matching *tsquery*, see search_posts.
+
+    Returns the number of hits and a page of rows: tid, title, subtitle, score.
+    """
+    matches = Thread.search_document.op('@@')(tsquery)
+    count = session.query(Thread.tid).filter(matches).limit(SEARCH_COUNT_LIMIT).count()
+
+    score = cast(func.ts_rank_cd(Thread.search_document, tsquery), Float)
+    query = session.query(Thread.tid, Thread.title, Thread.subtitle, score.label('score')).filter(matches)
+    return count, apply_search_order(query, score, Thread.tid, sort, after).limit(limit).all()
+
+
+def post_hits(session, pids):
+    """
+    Thread, poster and time of the posts *pids*.
+
+    Returns a dict: pid -> (tid, poster_uid, timestamp)
+    """
+    query = session.query(Post.pid, Post.tid, Post.poster_uid, Post.timestamp).filter(Post.pid.in_(pids))
+    return {row.pid: (row.tid, row.poster_uid, row.timestamp) for row in query}
+
+
+def user_names(session, uids):
+    """
+    Names of the users *uids*.
+
+    Returns a dict: uid -> (name, aliases)
+    """
+    query = session.query(User.uid, User.name, User.aliases).filter(User.uid.in_(uids))
+    return {row.uid: (row.name, row.aliases) for row in query}
+
+
+def thread_titles(session, tids):
+    """
+    Titles of the threads *tids*.
+
+    Returns a dict: tid -> (title, subtitle)
+    """
+    query = session.query(Thread.tid, Thread.title, Thread.subtitle).filter(Thread.tid.in_(tids))
+    return {row.tid: (row.title, row.subtitle) for row in query}
+
+
+def search_post_facets(session, tsquery, top_posters=10):
+    """
+    Number of posts matching *tsquery* per year, per board and of the *top_posters* posters with the most of them,
+    counted in one pass (grouping sets).
+
+    Returns a dict of lists of (year/bid/uid, count): years ordered by year, boards and posters by count.
+    """
+    grouping = func.grouping(Post.year, Post.bid, Post.poster_uid).label('grouping')
+    rows = (
+        session
+        .query(Post.year, Post.bid, Post.poster_uid, grouping, func.count().label('count'))
+        .join(PostSearch, PostSearch.pid == Post.pid)
+        .filter(PostSearch.document.op('@@')(tsquery))
+        .group_by(func.grouping_sets(tuple_(Post.year), tuple_(Post.bid), tuple_(Post.poster_uid)))
+        .all()
+    )
+    # grouping() has a bit set for each column which is not part of the grouping set, the first being the highest.
+    years = sorted((row.year, row.count) for row in rows if row.grouping == 0b011 and row.year is not None)
+    boards = sorted(((row.bid, row.count) for row in rows if row.grouping == 0b101 and row.bid is not None),
+                    key=lambda board: (-board[1], board[0]))
+    posters = sorted(((row.poster_uid, row.count) for row in rows
+                      if row.grouping == 0b110 and row.poster_uid is not None),
+                     key=lambda poster: (-poster[1], poster[0]))
+    return dict(years=years, boards=boards, posters=posters[:top_posters])
@@ -4,10 +4,10 @@ import sys
 import os
 
 from sqlalchemy import create_engine, Column, ForeignKey, Integer, Unicode, UnicodeText, Boolean, TIMESTAMP, \
-    CheckConstraint, func, Enum, Index, Binary, MetaData
+    CheckConstraint, func, Enum, Index, Binary, MetaData, Computed, BigInteger
 from sqlalchemy.orm import sessionmaker, relationship, Query, Session, query_expression, backref
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import insert, JSONB, ARRAY
+from sqlalchemy.dialects.postgresql import insert, JSONB, ARRAY, TSVECTOR
 
 import click
 from sqlalchemy.orm.attributes import flag_modified
@@ -53,6 +53,46 @@ def shell():
                                        '>>> from potstats2.db import *', exitmsg='')
 
 
+@main.command()
+@click.option('--vacuum/--no-vacuum', default=True, help='VACUUM in addition to ANALYZE.')
+@click.option('--create-indexes', is_flag=True, default=False, help='Concurrently create indexes missing from the database.')
+@click.argument('tables', nargs=-1)
+def maintain(vacuum, create_indexes, tables):
+    """
+    Refresh statistics of TABLES (default: all tables modified since last analyzed) and report bloat.
+    """
+    from .maintenance import maintain
+    maintain(get_engine(), tables or None, vacuum=vacuum, create_indexes=create_indexes)
+
+
+@main.group()
+def snapshot():
+    """
+    Compact binary copy of the database for provisioning other nodes.
+    """
+
+
+@snapshot.command(name='export')
+@click.option('--posts', is_flag=True, default=False, help='Include posts, quotes, links and analysis state.')
+@click.option('--contents', is_flag=True, default=False, help='Include post contents (implies --posts).')
+@click.option('--chunk-size', type=click.IntRange(1), default=1000000, help='Number of posts per chunk.')
+@click.argument('path', type=click.Path(file_okay=False))
+def snapshot_export(posts, contents, chunk_size, path):
+    from .snapshot import export_snapshot
+    export_snapshot(get_engine(), path, posts=posts or contents, contents=contents, chunk_size=chunk_size)
+
+
+@snapshot.command(name='import')
+@click.option('--jobs', default=4, help='Number of post chunks imported in parallel.')
+@click.argument('path', type=click.Path(file_okay=False, exists=True))
+def snapshot_import(jobs, path):
+    from .snapshot import import_snapshot, SnapshotError
+    try:
+        import_snapshot(get_engine(), path, jobs=jobs)
+    except SnapshotError as se:
+        raise click.ClickException(str(se))
+
+
 @main.command()
 @click.argument('cmdline', nargs=-1)
 def alembic(cmdline):
@@ -192,6 +232,10 @@ class MyModsUserStaging(Base):
 
     uid = Column(Integer, ForeignKey('users.uid'), primary_key=True)
     html = Column(UnicodeText)
+    # Stored, so that unchanged profiles are found without reading (or hashing) the pages.
+    html_md5 = Column(Unicode, Computed('md5(html)'))
+    # html_md5 of the page when it was last parsed into the user.
+    parsed_html_md5 = Column(Unicode)
 
     user = relationship('User', backref=backref('my_mods', uselist=False), lazy='joined')
 
@@ -222,6 +266,7 @@ class Thread(Base):
     __tablename__ = 'threads'
     __table_args__ = (
         CheckConstraint('(is_closed and not is_sticky and not is_global) or not is_complete', name='complete_requires_closed'),
+        Index('ix_threads_search_document', 'search_document', postgresql_using='gin'),
     )
 
     tid = bb_id_column()
@@ -229,6 +274,9 @@ class Thread(Base):
 
     title = Column(Unicode)
     subtitle = Column(Unicode)
+    # For full-text search in the database (SEARCH_BACKEND=postgres), see dal.search_threads.
+    search_document = Column(TSVECTOR, Computed("to_tsvector('german', coalesce(title, '') || ' ' || "
+                                                "coalesce(subtitle, ''))"))
 
     # Thread flags
     is_closed = Column(Boolean)
@@ -268,13 +316,22 @@ class Post(Base):
         # it is used by the query populating Thread.first_post. Actually no query would be necessary for that,
         # but oh well I'm lazy.
         Index('tid_pid', 'tid', 'pid'),
+        # For board-filtered queries, which are usually also restricted to a time range.
+        Index('bid_timestamp', 'bid', 'timestamp'),
+        # Posts are appended in timestamp order, so a BRIN index is tiny and still good for time ranges.
+        Index('timestamp_brin', 'timestamp', postgresql_using='brin'),
     )
 
     pid = bb_id_column()
     poster_uid = Column(Integer, ForeignKey('users.uid'), index=True)
     tid = Column(Integer, ForeignKey('threads.tid'))
+    # Denormalized from Thread.bid, so that filtering or grouping by board needs no join.
+    bid = Column(Integer, ForeignKey('boards.bid'))
 
-    timestamp = Column(TIMESTAMP, index=True)
+    timestamp = Column(TIMESTAMP)
+    # Precomputed for the bakes, which group by these a lot.
+    year = Column(Integer, Computed('CAST(extract(year FROM timestamp) AS integer)'))
+    day_of_year = Column(Integer, Computed('CAST(extract(doy FROM timestamp) AS integer)'))
     edit_count = Column(Integer)
     # NULL iff edit_count=0
     last_edit_uid = Column(Integer, ForeignKey('users.uid'), nullable=True)
@@ -288,6 +345,7 @@ class Post(Base):
     poster = relationship('User', foreign_keys=poster_uid)
     last_edit_user = relationship('User', foreign_keys=last_edit_uid)
     thread = relationship('Thread', foreign_keys=tid, backref='posts')
+    board = relationship('Board')
 
 
 class PostContent(Base):
@@ -353,6 +411,44 @@ class WorldeaterState(Base):
         return state
 
 
+class AnalyticsStageState(Base):
+    """Fingerprint of the inputs of each analytics stage when it last ran, see stages.run_stages."""
+    __tablename__ = 'analytics_stage_state'
+
+    stage = Column(Unicode, primary_key=True)
+    fingerprint = Column(JSONB)
+    completed = Column(TIMESTAMP)
+
+
+class DataVersion(Base):
+    """
+    Incremented whenever the data changes (analytics, worldeater, snapshot import), together with the API cache
+    invalidation. In-process caches of the backend are rebuilt when it changes.
+    """
+    __tablename__ = 'data_version'
+    __table_args__ = (
+        CheckConstraint('singleton = 0', name='ensure_single_version'),
+    )
+
+    singleton = Column(Integer, primary_key=True)
+
+    version = Column(Integer, nullable=False)
+    changed = Column(TIMESTAMP)
+
+    @staticmethod
+    def get(session):
+        """The current version, 0 if the data never changed."""
+        return session.query(DataVersion.version).scalar() or 0
+
+    @staticmethod
+    def bump(bind):
+        """Increment the version, through *bind* (a session, connection or engine)."""
+        bind.execute(insert(DataVersion.__table__)
+                     .values(singleton=0, version=1, changed=func.now())
+                     .on_conflict_do_update(index_elements=['singleton'],
+                                            set_=dict(version=DataVersion.version + 1, changed=func.now())))
+
+
 class WorldeaterThreadsNeedingUpdate(Base):
     __tablename__ = 'worldeater_tnu'
 
@@ -374,6 +470,50 @@ class PostQuotes(Base):
     quoted_post = relationship('Post', foreign_keys=quoted_pid)
 
 
+class AnalyzedPost(Base):
+    """
+    Analysis state of a post (see analytics.analyze_posts).
+
+    A post is analyzed again if its edit_count differs from the one recorded here.
+    """
+    __tablename__ = 'analyzed_posts'
+
+    pid = Column(Integer, ForeignKey('posts.pid'), primary_key=True)
+    edit_count = Column(Integer)
+
+
+class PostSearch(Base):
+    """
+    Searchable text of a post (its content without quotes) for full-text search in the database,
+    written by analytics.analyze_posts if SEARCH_BACKEND=postgres. See dal.search_posts.
+    """
+    __tablename__ = 'post_search'
+    __table_args__ = (
+        Index('ix_post_search_document', 'document', postgresql_using='gin'),
+    )
+
+    pid = Column(Integer, ForeignKey('posts.pid'), primary_key=True)
+    content = Column(UnicodeText)
+    document = Column(TSVECTOR, Computed("to_tsvector('german', content)"))
+
+
+class IndexedThread(Base):
+    """
+    Search index state of a thread (see analytics.index_threads).
+
+    A thread is indexed again if the MD5 of its title and subtitle differs from the one recorded here.
+    No foreign key, so that threads which no longer exist can be deleted from the index.
+    """
+    __tablename__ = 'indexed_threads'
+
+    tid = Column(Integer, primary_key=True)
+    md5 = Column(Unicode)
+
+    @staticmethod
+    def current_md5():
+        return func.md5(func.concat(Thread.title, '\x1f', Thread.subtitle))
+
+
 class LinkType(enum.Enum):
     link = 1
     image = 2
@@ -398,9 +538,9 @@ class LinkRelation(PseudoMaterializedView):
     query = (
         Query((PostLinks.domain, User.uid, PostLinks.type,
                func.sum(PostLinks.count).label('count'),
-               func.extract('year', Post.timestamp).label('year')))
+               Post.year))
         .join('post', 'poster')
-        .group_by(PostLinks.domain, User.uid, PostLinks.type, 'year')
+        .group_by(PostLinks.domain, User.uid, PostLinks.type, Post.year)
         .having(func.sum(PostLinks.count) >= 10)
     )
 
@@ -457,6 +597,27 @@ class DailyStats(Base):
     edit_count = Column(Integer)
     posts_length = Column(Integer)
     threads_created = Column(Integer)
+    # Prefix sums: the sums over all days of the board up to this one (inclusive).
+    cumulative_post_count = Column(BigInteger, nullable=False)
+    cumulative_edit_count = Column(BigInteger, nullable=False)
+    cumulative_posts_length = Column(BigInteger, nullable=False)
+    cumulative_threads_created = Column(BigInteger, nullable=False)
     active_users = Column(Binary)
 
     board = relationship('Board')
+
+
+class ActiveUserRollup(Base):
+    """
+    Union of the DailyStats.active_users of a month (1-12), an ISO weekday (1-7) or a whole year (both 0),
+    of one board or of all boards (bid 0). Run-optimized, baked along with DailyStats.
+    """
+    __tablename__ = 'baked_active_users'
+
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    weekday = Column(Integer, primary_key=True)
+    bid = Column(Integer, primary_key=True)
+
+    user_count = Column(Integer)
+    active_users = Column(Binary)
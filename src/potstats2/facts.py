@@ -0,0 +1,344 @@
+import collections
+import datetime
+import itertools
+import json
+import os
+import os.path
+import shutil
+from time import perf_counter
+
+import numpy as np
+from pyroaring import BitMap
+from sqlalchemy import func, cast, BigInteger
+
+from . import config
+from .db import Post, PostQuotes, Thread, PosterStats, DailyStats, QuoteRelation, ActiveUserRollup
+from .stages import fingerprint_of
+from .util import stream_query, copy_rows
+
+FACTS_VERSION = 1
+META = 'meta.json'
+# NULL timestamps are stored as NaT (which is the smallest int64).
+NAT = np.iinfo(np.int64).min
+
+# table => column => (dtype, column expression)
+# NULLs are replaced by -1 (ids), NAT (timestamp) or 0 (counts, which the crawler always sets anyway).
+COLUMNS = {
+    'posts': {
+        'pid': (np.int32, Post.pid),
+        'tid': (np.int32, func.coalesce(Post.tid, -1)),
+        'bid': (np.int32, func.coalesce(Post.bid, -1)),
+        'poster_uid': (np.int32, func.coalesce(Post.poster_uid, -1)),
+        'timestamp': (np.int64, func.coalesce(cast(func.floor(func.extract('epoch', Post.timestamp)), BigInteger), NAT)),
+        'edit_count': (np.int32, func.coalesce(Post.edit_count, 0)),
+        'content_length': (np.int32, func.coalesce(Post.content_length, 0)),
+    },
+    'quotes': {
+        'pid': (np.int32, PostQuotes.pid),
+        'quoted_pid': (np.int32, PostQuotes.quoted_pid),
+        'count': (np.int32, func.coalesce(PostQuotes.count, 0)),
+    },
+    'threads': {
+        'tid': (np.int32, Thread.tid),
+        'first_pid': (np.int32, func.coalesce(Thread.first_pid, -1)),
+    },
+}
+ORDER_BY = {
+    'posts': (Post.pid,),
+    'quotes': (PostQuotes.pid, PostQuotes.quoted_pid),
+    'threads': (Thread.tid,),
+}
+
+
+def default_path():
+    return os.path.join(os.path.expanduser(config.get('CACHE_DIR')), 'facts')
+
+
+def extract(session, path=None, chunk_size=100000):
+    """
+    Dump the facts the bakes need from posts, post_quotes and threads into *path*, one file per column.
+
+    Each table is read once, in one sequential pass. The previous extract in *path* (if any) is replaced.
+    """
+    path = path or default_path()
+    t0 = perf_counter()
+    session.flush()
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    counts = {}
+    for table, columns in COLUMNS.items():
+        query = session.query(*(expression for dtype, expression in columns.values())).order_by(*ORDER_BY[table])
+        rows = stream_query(query, itersize=chunk_size)
+        files = [open(os.path.join(tmp_path, '%s.%s' % (table, name)), 'wb') for name in columns]
+        counts[table] = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                chunk = np.array(chunk, dtype=np.int64).reshape(len(chunk), len(columns))
+                for (dtype, expression), fd, values in zip(columns.values(), files, chunk.T):
+                    values.astype(dtype).tofile(fd)
+                counts[table] += len(chunk)
+        finally:
+            for fd in files:
+                fd.close()
+
+    with open(os.path.join(tmp_path, META), 'w') as fd:
+        json.dump(dict(version=FACTS_VERSION, created=datetime.datetime.utcnow().isoformat(), counts=counts), fd)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    print('Extracted post facts ({posts} posts, {quotes} quotes, {threads} threads) in {elapsed:.1f} s.'.format(
+        elapsed=perf_counter() - t0, **counts))
+    return PostFacts(path)
+
+
+@fingerprint_of('post_facts')
+def fingerprint(session, path=None):
+    """The creation time of the extract, which changes each time it is extracted."""
+    try:
+        with open(os.path.join(path or default_path(), META), 'r') as fd:
+            return json.load(fd)['created']
+    except FileNotFoundError:
+        return None
+
+
+class PostFacts:
+    """
+    Columnar extract written by extract(), each column memory-mapped as a NumPy array.
+
+    - posts: pid, tid, bid, poster_uid, timestamp (seconds since the epoch), edit_count, content_length
+      (ordered by pid)
+    - quotes: pid, quoted_pid, count
+    - threads: tid, first_pid
+    """
+
+    def __init__(self, path=None):
+        path = path or default_path()
+        with open(os.path.join(path, META), 'r') as fd:
+            meta = json.load(fd)
+        if meta['version'] != FACTS_VERSION:
+            raise ValueError('Post facts in %s have version %d, expected %d' % (path, meta['version'], FACTS_VERSION))
+        self.path = path
+        self.created = meta['created']
+        for table, columns in COLUMNS.items():
+            arrays = {}
+            for name, (dtype, expression) in columns.items():
+                file = os.path.join(path, '%s.%s' % (table, name))
+                if meta['counts'][table]:
+                    arrays[name] = np.memmap(file, dtype=dtype, mode='r')
+                else:
+                    # mmap can't map empty files
+                    arrays[name] = np.empty(0, dtype=dtype)
+            setattr(self, table, arrays)
+
+        timestamp = self.posts['timestamp'].view('datetime64[s]')
+        self.has_timestamp = ~np.isnat(timestamp)
+        years = timestamp.astype('datetime64[Y]')
+        self.year = (years.astype(np.int64) + 1970).astype(np.int32)
+        self.day_of_year = ((timestamp.astype('datetime64[D]') - years).astype(np.int64) + 1).astype(np.int32)
+
+    def __len__(self):
+        return len(self.posts['pid'])
+
+    def post_index(self, pids):
+        """Return the index of each of *pids* in posts, and a mask of the pids which were found at all."""
+        index = np.searchsorted(self.posts['pid'], pids)
+        found = index < len(self)
+        index[~found] = 0
+        found[found] = self.posts['pid'][index[found]] == pids[found]
+        return index, found
+
+    def post_counts(self, pids):
+        """Count occurrences of each post in *pids*, e.g. the number of quotes of each post."""
+        index, found = self.post_index(pids)
+        return np.bincount(index[found], minlength=len(self))
+
+
+def group_rows(*keys):
+    """
+    Group rows by the key columns *keys*.
+
+    Returns the permutation sorting the rows by key, the start of each group (in sorted rows)
+    and the key columns of the groups.
+    """
+    order = np.lexsort(keys[::-1])
+    sorted_keys = [key[order] for key in keys]
+    change = np.zeros(len(order), dtype=bool)
+    change[:1] = True
+    for key in sorted_keys:
+        change[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(change)
+    return order, starts, [key[starts] for key in sorted_keys]
+
+
+def group_sum(values, starts):
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    return np.add.reduceat(values.astype(np.int64), starts)
+
+
+def group_cumsum(values, starts):
+    """Running sum of *values* (grouped, see group_rows), starting again at each group."""
+    sums = np.cumsum(values, dtype=np.int64)
+    group_totals = np.append(0, sums[starts[1:] - 1]) if len(starts) else starts
+    return sums - np.repeat(group_totals, group_sizes(starts, len(values)))
+
+
+def group_sizes(starts, num_rows):
+    return np.diff(np.append(starts, num_rows))
+
+
+def load(session, table, columns):
+    """Replace the contents of *table* by the NumPy arrays *columns* (name => array), using COPY."""
+    session.flush()
+    session.query(table).delete()
+    rows = zip(*(values.tolist() for values in columns.values()))
+    return copy_rows(session, table.__tablename__, list(columns), rows)
+
+
+class ActiveUserRollups:
+    """
+    Unions of the active users of each day and board (added in any order) per month, weekday and year,
+    for each board and for all boards (bid 0); the rows of ActiveUserRollup.
+    """
+
+    def __init__(self):
+        self.bitmaps = collections.defaultdict(BitMap)
+
+    def add(self, year, day_of_year, bid, users):
+        date = datetime.date(year, 1, 1) + datetime.timedelta(days=day_of_year - 1)
+        for key in ((year, date.month, 0), (year, 0, date.isoweekday())):
+            self.bitmaps[key + (bid,)] |= users
+            self.bitmaps[key + (0,)] |= users
+
+    def rows(self):
+        """(year, month, weekday, bid, user_count, active_users) of each rollup, bitmaps serialized."""
+        bitmaps = dict(self.bitmaps)
+        # A year is the union of its months.
+        for (year, month, weekday, bid), users in self.bitmaps.items():
+            if month:
+                bitmaps.setdefault((year, 0, 0, bid), BitMap()).update(users)
+        for key in sorted(bitmaps):
+            users = bitmaps[key]
+            users.run_optimize()
+            yield key + (len(users), users.serialize())
+
+
+def load_active_user_rollups(session, rollups):
+    session.flush()
+    session.query(ActiveUserRollup).delete()
+    columns = ('year', 'month', 'weekday', 'bid', 'user_count', 'active_users')
+    return copy_rows(session, ActiveUserRollup.__tablename__, columns, rollups.rows())
+
+
+def bake_poster_stats(session, facts=None, post_count_cutoff=25):
+    """PosterStats from post facts, equivalent to dal.poster_stats_agg."""
+    t0 = perf_counter()
+    if facts is None:
+        facts = PostFacts()
+    posts = facts.posts
+    threads_created = facts.post_counts(facts.threads['first_pid'])
+    quoted_count = facts.post_counts(facts.quotes['quoted_pid'])
+    quotes_count = facts.post_counts(facts.quotes['pid'])
+
+    rows = np.flatnonzero(facts.has_timestamp & (posts['bid'] >= 0) & (posts['poster_uid'] >= 0))
+    order, starts, (year, bid, uid) = group_rows(facts.year[rows], posts['bid'][rows], posts['poster_uid'][rows])
+    rows = rows[order]
+    post_count = group_sizes(starts, len(rows))
+    # Like CAST(avg(...) AS integer), i.e. rounded half up.
+    avg_post_length = (2 * group_sum(posts['content_length'][rows], starts) + post_count) // (2 * post_count)
+    keep = post_count >= post_count_cutoff
+
+    num_rows = load(session, PosterStats, dict(
+        year=year[keep],
+        bid=bid[keep],
+        uid=uid[keep],
+        post_count=post_count[keep],
+        edit_count=group_sum(posts['edit_count'][rows], starts)[keep],
+        avg_post_length=avg_post_length[keep],
+        threads_created=group_sum(threads_created[rows], starts)[keep],
+        quoted_count=group_sum(quoted_count[rows], starts)[keep],
+        quotes_count=group_sum(quotes_count[rows], starts)[keep],
+    ))
+    elapsed = perf_counter() - t0
+    print('Baked poster stats ({} rows) in {:.1f} s.'.format(num_rows, elapsed))
+
+
+def bake_daily_stats(session, facts=None):
+    """
+    DailyStats from post facts, equivalent to dal.daily_post_stats_agg and dal.daily_active_users,
+    and the ActiveUserRollup of them.
+    """
+    t0 = perf_counter()
+    if facts is None:
+        facts = PostFacts()
+    posts = facts.posts
+    threads_created = facts.post_counts(facts.threads['first_pid'])
+
+    rows = np.flatnonzero(facts.has_timestamp & (posts['bid'] >= 0))
+    # Grouping by uid as well sorts the users of each day, which makes building the bitmaps cheap.
+    order, user_starts, (year, day_of_year, bid, uid) = group_rows(
+        facts.year[rows], facts.day_of_year[rows], posts['bid'][rows], posts['poster_uid'][rows])
+    rows = rows[order]
+    day_change = np.ones(len(user_starts), dtype=bool)
+    day_change[1:] = ((year[1:] != year[:-1]) | (day_of_year[1:] != day_of_year[:-1]) | (bid[1:] != bid[:-1]))
+    starts = user_starts[day_change]
+
+    day_users = np.split(uid, np.flatnonzero(day_change)[1:])
+    active_users = [BitMap(users[users >= 0].tolist()) for users in day_users]
+    year, day_of_year, bid = year[day_change], day_of_year[day_change], bid[day_change]
+    rollups = ActiveUserRollups()
+    for day, users in zip(zip(year.tolist(), day_of_year.tolist(), bid.tolist()), active_users):
+        rollups.add(*day, users)
+
+    sums = dict(
+        post_count=group_sizes(starts, len(rows)),
+        edit_count=group_sum(posts['edit_count'][rows], starts),
+        posts_length=group_sum(posts['content_length'][rows], starts),
+        threads_created=group_sum(threads_created[rows], starts),
+    )
+    columns = dict(year=year, day_of_year=day_of_year, bid=bid, **sums)
+    # Days are ordered by date already, a stable sort keeps that order within each board.
+    board_order = np.argsort(bid, kind='stable')
+    board_starts = np.flatnonzero(np.diff(bid[board_order], prepend=-2))
+    for name, values in sums.items():
+        columns['cumulative_' + name] = np.empty_like(values)
+        columns['cumulative_' + name][board_order] = group_cumsum(values[board_order], board_starts)
+    columns['active_users'] = np.array([users.serialize() for users in active_users], dtype=object)
+    num_rows = load(session, DailyStats, columns)
+    num_rollups = load_active_user_rollups(session, rollups)
+    elapsed = perf_counter() - t0
+    print('Baked daily stats ({} rows, {} active user rollups) in {:.1f} s.'.format(num_rows, num_rollups, elapsed))
+
+
+def bake_quote_relation(session, facts=None, count_cutoff=10):
+    """QuoteRelation from post facts, equivalent to dal.social_graph_agg."""
+    t0 = perf_counter()
+    if facts is None:
+        facts = PostFacts()
+    posts = facts.posts
+    quoter, quoter_found = facts.post_index(facts.quotes['pid'])
+    quoted, quoted_found = facts.post_index(facts.quotes['quoted_pid'])
+    edges = np.flatnonzero(quoter_found & quoted_found)
+    quoter, quoted = quoter[edges], quoted[edges]
+    valid = (facts.has_timestamp[quoter] & (posts['bid'][quoter] >= 0) &
+             (posts['poster_uid'][quoter] >= 0) & (posts['poster_uid'][quoted] >= 0))
+    edges, quoter, quoted = edges[valid], quoter[valid], quoted[valid]
+
+    order, starts, (year, bid, quoter_uid, quoted_uid) = group_rows(
+        facts.year[quoter], posts['bid'][quoter], posts['poster_uid'][quoter], posts['poster_uid'][quoted])
+    count = group_sum(facts.quotes['count'][edges[order]], starts)
+    keep = count > count_cutoff
+
+    num_rows = load(session, QuoteRelation, dict(
+        year=year[keep],
+        bid=bid[keep],
+        quoter_uid=quoter_uid[keep],
+        quoted_uid=quoted_uid[keep],
+        count=count[keep],
+    ))
+    elapsed = perf_counter() - t0
+    print('Baked quote relation ({} rows) in {:.1f} s.'.format(num_rows, elapsed))
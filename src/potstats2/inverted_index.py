@@ -0,0 +1,665 @@
+import datetime
+import html
+import json
+import math
+import os
+import os.path
+import re
+import shutil
+import zlib
+from collections import namedtuple
+from time import perf_counter
+
+import numpy as np
+
+from . import config
+
+INDEX_VERSION = 2
+MANIFEST = 'segments.json'
+META = 'meta.json'
+TOKEN = re.compile(r'\w+')
+
+# BM25 parameters, the defaults of Elasticsearch.
+K1 = 1.2
+B = 0.75
+
+# Once there are more segments, the newest ones are merged (see merge_segments).
+MAX_SEGMENTS = 16
+
+# Lengths of deleted documents, which only shadow older versions of their post.
+DELETED = -1
+# Missing timestamps are stored as NaT (the smallest int64), missing ids as -1.
+NAT = np.iinfo(np.int64).min
+
+# Per-document columns of a segment (ordered by pid)
+DOCUMENT_COLUMNS = ('pids', 'poster_uids', 'bids', 'timestamps', 'lengths')
+
+# Number of top posters in the facets of a search.
+TOP_POSTERS = 10
+
+# A parsed search query, see parse_textual_index_query in the backend. Each clause is a list of terms
+# (as produced by tokenize):
+# - phrases: list of clauses whose terms must occur in this order
+# - required: list of clauses whose terms must all occur
+# - excluded: list of clauses whose terms must not all occur
+# - optional: list of clauses, at least one of which must match (if there are any)
+Query = namedtuple('Query', 'phrases required excluded optional')
+
+Hit = namedtuple('Hit', 'pid poster_uid score snippet')
+
+# count: number of hits, hits: a page of Hits,
+# facets: None, or a dict with the number of hits per year, per board and of the TOP_POSTERS posters
+# (lists of (year/bid/uid, count), years ordered by year, the others by count).
+SearchResult = namedtuple('SearchResult', 'count hits facets')
+
+
+def default_path():
+    return os.path.join(os.path.expanduser(config.get('CACHE_DIR')), 'search')
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def encode_varints(values):
+    """
+    Encode unsigned integers as LEB128 varints (seven bits per byte, least significant first, the high bit
+    set on all but the last byte of each value).
+
+    Returns the encoded bytes and the number of bytes of each value.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b'', np.zeros(0, dtype=np.int64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    value_index = np.repeat(np.arange(len(values)), nbytes)
+    byte_index = np.arange(len(value_index)) - np.repeat(np.cumsum(nbytes) - nbytes, nbytes)
+    encoded = ((values[value_index] >> (byte_index * 7).astype(np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    encoded[byte_index < nbytes[value_index] - 1] |= 0x80
+    return encoded.tobytes(), nbytes
+
+
+def decode_varints(data):
+    """Decode LEB128 varints (see encode_varints) into an int64 array."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    last = data < 0x80
+    starts = np.concatenate(([0], np.flatnonzero(last)[:-1] + 1))
+    value_index = np.concatenate(([0], np.cumsum(last[:-1])))
+    shift = (np.arange(len(data)) - starts[value_index]) * 7
+    parts = (data & 0x7f).astype(np.int64) << shift
+    return np.add.reduceat(parts, starts)
+
+
+def reset_cumsum(deltas, counts):
+    """Cumulative sums of *deltas*, restarting with each group of *counts* values."""
+    sums = np.cumsum(deltas)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    bases = np.zeros(len(counts), dtype=np.int64)
+    nonempty = counts > 0
+    bases[nonempty] = sums[starts[nonempty]] - deltas[starts[nonempty]]
+    return sums - np.repeat(bases, counts)
+
+
+def group_offsets(nbytes, group_starts):
+    """Byte offsets of groups of varints, given the size of each varint and the first varint of each group."""
+    ends = np.concatenate(([0], np.cumsum(nbytes)))
+    return ends[np.append(group_starts, len(nbytes))]
+
+
+def write_segment(path, name, docs):
+    """
+    Write the search documents *docs* into the segment *name* in the index *path*.
+
+    *docs* is a list of (pid, poster_uid, bid, timestamp, text) tuples, with the text None for posts without
+    anything searchable (left), which are deleted from older segments.
+    """
+    docs = sorted(docs, key=lambda doc: doc[0])
+    term_ids = {}
+    token_terms = []
+    token_pids = []
+    token_positions = []
+    lengths = []
+    texts = []
+    for pid, poster_uid, bid, timestamp, text in docs:
+        if text is None:
+            lengths.append(DELETED)
+            texts.append(b'')
+            continue
+        tokens = tokenize(text)
+        token_terms.extend(term_ids.setdefault(token, len(term_ids)) for token in tokens)
+        token_pids.extend([pid] * len(tokens))
+        token_positions.extend(range(len(tokens)))
+        lengths.append(len(tokens))
+        texts.append(zlib.compress(text.encode()))
+
+    columns = dict(
+        pids=np.array([doc[0] for doc in docs], dtype=np.int32),
+        poster_uids=np.array([-1 if doc[1] is None else doc[1] for doc in docs], dtype=np.int32),
+        bids=np.array([-1 if doc[2] is None else doc[2] for doc in docs], dtype=np.int32),
+        timestamps=np.array([NAT if doc[3] is None else epoch_seconds(doc[3]) for doc in docs], dtype=np.int64),
+        lengths=np.array(lengths, dtype=np.int32),
+    )
+    tokens = (np.array(token_terms, dtype=np.int64),
+              np.array(token_pids, dtype=np.int64),
+              np.array(token_positions, dtype=np.int64))
+    write_segment_arrays(path, name, columns, texts, list(term_ids), *tokens)
+
+
+def epoch_seconds(timestamp):
+    return int((timestamp - EPOCH).total_seconds())
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def write_segment_arrays(path, name, columns, texts, terms, token_terms, token_pids, token_positions):
+    """
+    Write a segment from the DOCUMENT_COLUMNS *columns* (ordered by pid), the compressed
+    *texts* of the documents and their tokens: the index of their term in *terms*, their pid and position.
+
+    The segment is written into a temporary directory which is then renamed, so it appears complete or not at all.
+    """
+    # Terms are stored in order, and only those which occur at all.
+    used_terms, token_terms = np.unique(token_terms, return_inverse=True)
+    terms = [terms[term] for term in used_terms]
+    order = np.argsort(terms, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    terms = [terms[term] for term in order]
+    token_terms = rank[token_terms]
+
+    order = np.lexsort((token_positions, token_pids, token_terms))
+    token_terms, token_pids, token_positions = token_terms[order], token_pids[order], token_positions[order]
+
+    # A posting is a (term, pid) pair, with the positions of the term in the document.
+    new_posting = np.ones(len(order), dtype=bool)
+    new_posting[1:] = (token_terms[1:] != token_terms[:-1]) | (token_pids[1:] != token_pids[:-1])
+    posting_starts = np.flatnonzero(new_posting)
+    term_frequencies = np.diff(np.append(posting_starts, len(order)))
+    posting_terms = token_terms[posting_starts]
+    posting_pids = token_pids[posting_starts]
+    new_term = np.ones(len(posting_starts), dtype=bool)
+    new_term[1:] = posting_terms[1:] != posting_terms[:-1]
+    term_starts = np.flatnonzero(new_term)
+
+    # pids are delta-encoded per term, positions per posting.
+    pid_deltas = posting_pids.copy()
+    pid_deltas[1:] -= posting_pids[:-1]
+    pid_deltas[term_starts] = posting_pids[term_starts]
+    position_deltas = token_positions.copy()
+    position_deltas[1:] -= token_positions[:-1]
+    position_deltas[posting_starts] = token_positions[posting_starts]
+
+    docs_data, docs_nbytes = encode_varints(pid_deltas)
+    tfs_data, tfs_nbytes = encode_varints(term_frequencies)
+    positions_data, positions_nbytes = encode_varints(position_deltas)
+
+    segment_path = os.path.join(path, name)
+    tmp_path = segment_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    arrays = dict(
+        columns,
+        text_offsets=np.concatenate(([0], np.cumsum([len(text) for text in texts]))).astype(np.int64),
+        document_frequencies=np.diff(np.append(term_starts, len(posting_starts))).astype(np.int32),
+        docs_offsets=group_offsets(docs_nbytes, term_starts),
+        tfs_offsets=group_offsets(tfs_nbytes, term_starts),
+        positions_offsets=group_offsets(positions_nbytes, posting_starts[term_starts]),
+    )
+    for array_name, array in arrays.items():
+        np.save(os.path.join(tmp_path, array_name + '.npy'), array)
+    for file_name, data in (('texts', b''.join(texts)), ('docs', docs_data), ('tfs', tfs_data),
+                            ('positions', positions_data)):
+        with open(os.path.join(tmp_path, file_name + '.bin'), 'wb') as fd:
+            fd.write(data)
+    with open(os.path.join(tmp_path, 'terms.txt'), 'w') as fd:
+        fd.write('\n'.join(terms))
+    with open(os.path.join(tmp_path, META), 'w') as fd:
+        json.dump(dict(version=INDEX_VERSION, docs=len(columns['pids']), terms=len(terms), tokens=len(order)), fd)
+    os.rename(tmp_path, segment_path)
+
+
+def map_file(path):
+    if not os.path.getsize(path):
+        # mmap can't map empty files
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+class Segment:
+    """
+    A memory-mapped segment of the index, written by write_segment.
+
+    The term dictionary is held in memory, postings and texts are read from the mapped files.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, META), 'r') as fd:
+            meta = json.load(fd)
+        if meta['version'] != INDEX_VERSION:
+            raise ValueError('Index segment %s has version %d, expected %d' % (path, meta['version'], INDEX_VERSION))
+        self.path = path
+        self.name = os.path.basename(path)
+        for name in DOCUMENT_COLUMNS + ('text_offsets', 'document_frequencies',
+                                        'docs_offsets', 'tfs_offsets', 'positions_offsets'):
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        for name in ('texts', 'docs', 'tfs', 'positions'):
+            setattr(self, name, map_file(os.path.join(path, name + '.bin')))
+        with open(os.path.join(path, 'terms.txt'), 'r') as fd:
+            self.terms = fd.read().split('\n') if meta['terms'] else []
+        self.term_index = {term: index for index, term in enumerate(self.terms)}
+        # Set by InvertedIndex: documents not shadowed by newer segments (or deleted).
+        self.live = self.lengths != DELETED
+
+    def __len__(self):
+        return len(self.pids)
+
+    def document_frequency(self, term):
+        index = self.term_index.get(term)
+        return 0 if index is None else int(self.document_frequencies[index])
+
+    def postings(self, term):
+        """pids of the documents containing *term*, and how often it occurs in each of them."""
+        index = self.term_index.get(term)
+        if index is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pids = np.cumsum(decode_varints(self.docs[self.docs_offsets[index]:self.docs_offsets[index + 1]]))
+        tfs = decode_varints(self.tfs[self.tfs_offsets[index]:self.tfs_offsets[index + 1]])
+        return pids, tfs
+
+    def positions_of(self, term):
+        """(pid, position) of each occurrence of *term*."""
+        index = self.term_index.get(term)
+        pids, tfs = self.postings(term)
+        if index is None:
+            return pids, pids
+        deltas = decode_varints(self.positions[self.positions_offsets[index]:self.positions_offsets[index + 1]])
+        return np.repeat(pids, tfs), reset_cumsum(deltas, tfs)
+
+    def doc_index(self, pids):
+        return np.searchsorted(self.pids, pids)
+
+    def text(self, index):
+        data = self.texts[self.text_offsets[index]:self.text_offsets[index + 1]]
+        return zlib.decompress(data.tobytes()).decode() if self.lengths[index] != DELETED else None
+
+    def tokens(self):
+        """All tokens of the segment: the index of their term, their pid and position."""
+        tfs = decode_varints(self.tfs)
+        posting_terms = np.repeat(np.arange(len(self.terms)), self.document_frequencies)
+        posting_pids = reset_cumsum(decode_varints(self.docs), self.document_frequencies.astype(np.int64))
+        positions = reset_cumsum(decode_varints(self.positions), tfs)
+        return np.repeat(posting_terms, tfs), np.repeat(posting_pids, tfs), positions
+
+
+def read_manifest(path):
+    """The segments in the manifest of the index *path*, or None if there is none (of the current version)."""
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as fd:
+            manifest = json.load(fd)
+    except FileNotFoundError:
+        return None
+    return manifest['segments'] if manifest['version'] == INDEX_VERSION else None
+
+
+def write_manifest(path, segments):
+    tmp_path = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as fd:
+        json.dump(dict(version=INDEX_VERSION, segments=segments), fd)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def index_exists(path=None):
+    return read_manifest(path or default_path()) is not None
+
+
+class InvertedIndex:
+    """
+    The segments listed in the manifest of the index *path*, oldest first.
+
+    A post may be in several segments (once per analysis); only its newest version is live.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        names = read_manifest(self.path)
+        if names is None:
+            raise FileNotFoundError('No search index in %s' % self.path)
+        self.segments = [Segment(os.path.join(self.path, name)) for name in names]
+        for segment, newest in zip(self.segments, newest_versions(self.segments)):
+            segment.live = newest & (segment.lengths != DELETED)
+        self.num_docs = sum(int(segment.live.sum()) for segment in self.segments)
+        num_tokens = sum(int(segment.lengths[segment.live].sum()) for segment in self.segments)
+        self.average_length = num_tokens / self.num_docs if num_tokens else 1
+
+    def idf(self, term):
+        # Document frequencies include shadowed documents, like deleted documents count in Lucene until merged.
+        df = sum(segment.document_frequency(term) for segment in self.segments)
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query, sort='score', after=None, limit=30, facets=False):
+        """
+        Search for *query* (a Query), sorted by *sort* (score, date-asc or date-desc) and starting after the hit
+        with the sort values *after* (see dal.search_sort_values).
+
+        Returns a SearchResult, with HTML snippets in the Hits and, with *facets*, facet counts of all hits.
+        """
+        positive_terms = sorted({term for clauses in (query.phrases, query.required, query.optional)
+                                 for clause in clauses for term in clause})
+        idfs = {term: self.idf(term) for term in positive_terms}
+        all_pids, all_scores, all_segments = [], [], []
+        facet_columns = []
+        for number, segment in enumerate(self.segments):
+            pids = self.match(segment, query)
+            index = segment.doc_index(pids)
+            pids = pids[segment.live[index]]
+            index = index[segment.live[index]]
+            lengths = segment.lengths[index]
+            scores = np.zeros(len(pids))
+            for term in positive_terms:
+                term_pids, tfs = segment.postings(term)
+                position = np.minimum(np.searchsorted(term_pids, pids), max(len(term_pids) - 1, 0))
+                tf = np.where(term_pids[position] == pids, tfs[position], 0) if len(term_pids) else 0
+                norm = K1 * (1 - B + B * lengths / self.average_length)
+                scores += idfs[term] * tf * (K1 + 1) / (tf + norm)
+            all_pids.append(pids)
+            all_scores.append(scores)
+            all_segments.append(np.full(len(pids), number))
+            if facets:
+                facet_columns.append((segment.timestamps[index], segment.bids[index], segment.poster_uids[index]))
+        if not all_pids:
+            return SearchResult(0, [], facet_counts([], [], []) if facets else None)
+        pids = np.concatenate(all_pids)
+        scores = np.concatenate(all_scores)
+        segments = np.concatenate(all_segments)
+        count = len(pids)
+
+        if sort == 'score':
+            order = np.lexsort((pids, -scores))
+            if after:
+                after_score, after_pid = after
+                order = order[(scores[order] < after_score) |
+                              ((scores[order] == after_score) & (pids[order] > after_pid))]
+        elif sort == 'date-asc':
+            order = np.argsort(pids)
+            if after:
+                order = order[pids[order] > after[0]]
+        elif sort == 'date-desc':
+            order = np.argsort(pids)[::-1]
+            if after:
+                order = order[pids[order] < after[0]]
+        else:
+            raise ValueError('Invalid sort: %r' % sort)
+
+        hits = []
+        for i in order[:limit]:
+            segment = self.segments[segments[i]]
+            index = segment.doc_index(pids[i])
+            poster_uid = int(segment.poster_uids[index])
+            hits.append(Hit(int(pids[i]), None if poster_uid == -1 else poster_uid, float(scores[i]),
+                            snippet(segment.text(index), set(positive_terms))))
+        facet_result = None
+        if facets:
+            facet_result = facet_counts(*(np.concatenate(column) for column in zip(*facet_columns)))
+        return SearchResult(count, hits, facet_result)
+
+    def match(self, segment, query):
+        """Sorted pids of the documents in *segment* matching *query* (including those which are not live)."""
+        def all_of(terms):
+            return intersect([segment.postings(term)[0] for term in terms])
+
+        required = [all_of(clause) for clause in query.required]
+        required += [self.match_phrase(segment, clause) for clause in query.phrases]
+        if query.optional:
+            required.append(union([all_of(clause) for clause in query.optional]))
+        if not required and not query.excluded:
+            return np.zeros(0, dtype=np.int64)
+        pids = intersect(required) if required else np.asarray(segment.pids, dtype=np.int64)
+        for clause in query.excluded:
+            pids = np.setdiff1d(pids, all_of(clause), assume_unique=True)
+        return pids
+
+    def match_phrase(self, segment, terms):
+        """Sorted pids of the documents in *segment* containing *terms* in this order."""
+        candidates = intersect([segment.postings(term)[0] for term in terms])
+        if len(terms) < 2 or not len(candidates):
+            return candidates
+        # An occurrence of the i-th term at position p is a match of the phrase starting at p - i.
+        # Occurrences are ordered by pid and position, so these (pid, start) keys are sorted and unique.
+        starts = []
+        for offset, term in enumerate(terms):
+            pids, positions = segment.positions_of(term)
+            keep = contains(candidates, pids) & (positions >= offset)
+            starts.append((pids[keep] << 32) | (positions[keep] - offset))
+        return deduplicate(intersect(starts) >> 32)
+
+    def merge(self, start, name):
+        """
+        Merge the segments from *start* on into a new segment *name*, which replaces them.
+
+        Deleted documents are only kept if there are older segments in which they shadow a post.
+        """
+        t0 = perf_counter()
+        segments = self.segments[start:]
+        terms = {}
+        tokens = []
+        columns = []
+        texts = []
+        for segment, keep in zip(segments, newest_versions(segments)):
+            if not start:
+                keep &= segment.lengths != DELETED
+            term_map = np.array([terms.setdefault(term, len(terms)) for term in segment.terms], dtype=np.int64)
+            token_terms, token_pids, token_positions = segment.tokens()
+            live_tokens = keep[segment.doc_index(token_pids)] if len(token_pids) else np.zeros(0, dtype=bool)
+            tokens.append((term_map[token_terms[live_tokens]], token_pids[live_tokens], token_positions[live_tokens]))
+            columns.append([getattr(segment, column)[keep] for column in DOCUMENT_COLUMNS])
+            data = segment.texts.tobytes()
+            offsets = segment.text_offsets.tolist()
+            texts.extend(data[offsets[i]:offsets[i + 1]] for i in np.flatnonzero(keep).tolist())
+
+        columns = {name: np.concatenate(column) for name, column in zip(DOCUMENT_COLUMNS, zip(*columns))}
+        pids = columns['pids']
+        order = np.argsort(pids)
+        write_segment_arrays(
+            self.path, name,
+            {name: column[order] for name, column in columns.items()},
+            [texts[i] for i in order.tolist()],
+            list(terms),
+            *(np.concatenate(column) for column in zip(*tokens))
+        )
+        print('Merged {} search index segments ({} documents) in {:.1f} s.'.format(
+            len(segments), len(pids), perf_counter() - t0))
+
+
+def newest_versions(segments):
+    """For each of *segments* (oldest first), the mask of its documents which are not in a newer one."""
+    pids = np.concatenate([segment.pids for segment in segments] + [np.zeros(0, dtype=np.int32)])
+    numbers = np.repeat(np.arange(len(segments)), [len(segment) for segment in segments])
+    order = np.lexsort((numbers, pids))
+    newest = np.ones(len(pids), dtype=bool)
+    newest[order[:-1]] = pids[order[1:]] != pids[order[:-1]]
+    return np.split(newest, np.cumsum([len(segment) for segment in segments])[:-1])
+
+
+def facet_counts(timestamps, bids, poster_uids):
+    """Facets (see SearchResult) of hits with *timestamps*, *bids* and *poster_uids*."""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    timestamps = timestamps[timestamps != NAT]
+    years = timestamps.astype('datetime64[s]').astype('datetime64[Y]').astype(np.int64) + 1970
+
+    def counts(values, order_by_count=True, missing=-1):
+        values, value_counts = np.unique(np.asarray(values, dtype=np.int64), return_counts=True)
+        if missing is not None:
+            keep = values != missing
+            values, value_counts = values[keep], value_counts[keep]
+        if order_by_count:
+            order = np.lexsort((values, -value_counts))
+            values, value_counts = values[order], value_counts[order]
+        return list(zip(values.tolist(), value_counts.tolist()))
+
+    return dict(
+        years=counts(years, order_by_count=False, missing=None),
+        boards=counts(bids),
+        posters=counts(poster_uids)[:TOP_POSTERS],
+    )
+
+
+def intersect(arrays):
+    arrays = sorted(arrays, key=len)
+    result = arrays[0]
+    for array in arrays[1:]:
+        result = np.intersect1d(result, array, assume_unique=True)
+    return result
+
+
+def union(arrays):
+    if len(arrays) == 1:
+        return arrays[0]
+    return deduplicate(np.sort(np.concatenate(arrays)))
+
+
+def deduplicate(sorted_array):
+    keep = np.ones(len(sorted_array), dtype=bool)
+    keep[1:] = sorted_array[1:] != sorted_array[:-1]
+    return sorted_array[keep]
+
+
+def contains(sorted_array, values):
+    """Mask of *values* which are in *sorted_array*."""
+    if not len(sorted_array):
+        return np.zeros(len(values), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_array, values), len(sorted_array) - 1)
+    return sorted_array[index] == values
+
+
+def snippet(text, terms, fragments=3, context=5):
+    """
+    HTML snippet of *text*: up to *fragments* passages with occurrences of *terms* (and *context* words around
+    them), which are highlighted like by Elasticsearch.
+    """
+    words = list(TOKEN.finditer(text))
+    matches = [index for index, word in enumerate(words) if word.group().lower() in terms]
+    if not matches:
+        return html.escape(' '.join(word.group() for word in words[:2 * context]))
+    passages = []
+    for index in matches:
+        first, last = max(index - context, 0), min(index + context, len(words) - 1)
+        if passages and first <= passages[-1][1] + 1:
+            passages[-1][1] = last
+        elif len(passages) < fragments:
+            passages.append([first, last])
+    matched = set(matches)
+    parts = []
+    for first, last in passages:
+        passage = []
+        pos = words[first].start()
+        for index in range(first, last + 1):
+            word = words[index]
+            passage.append(html.escape(text[pos:word.start()]))
+            if index in matched:
+                passage.append('<strong>%s</strong>' % html.escape(word.group()))
+            else:
+                passage.append(html.escape(word.group()))
+            pos = word.end()
+        parts.append(''.join(passage))
+    return ' … '.join(parts)
+
+
+def new_run_id():
+    """Prefix of the names of the segments written by one run of post analysis (they sort by creation)."""
+    return datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+
+
+def unregistered_segments(path, names):
+    """Complete segments in *path* which are not in the manifest *names*."""
+    try:
+        entries = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(entry for entry in entries
+                  if entry not in names and os.path.isfile(os.path.join(path, entry, META)))
+
+
+def register_segments(path=None, run_id=None):
+    """
+    Add the segments written by post analysis to the manifest, after those already in it.
+
+    With *run_id*, the segments of that run replace all others (the index was rebuilt).
+    """
+    path = path or default_path()
+    os.makedirs(path, exist_ok=True)
+    names = read_manifest(path) or []
+    new_names = unregistered_segments(path, names)
+    if run_id:
+        names = [name for name in new_names if name.startswith(run_id)]
+    else:
+        names = names + new_names
+    write_manifest(path, names)
+    remove_unused_segments(path, names)
+
+
+def discard_segments(path=None, run_id=None):
+    """Remove the segments of the failed rebuild *run_id*, which were never registered."""
+    path = path or default_path()
+    names = read_manifest(path) or []
+    for name in unregistered_segments(path, names):
+        if name.startswith(run_id):
+            shutil.rmtree(os.path.join(path, name))
+
+
+def remove_unused_segments(path, names):
+    for entry in os.listdir(path):
+        if entry not in names and os.path.isdir(os.path.join(path, entry)):
+            # The backend may still have them mapped, which is fine, since the files are only unlinked.
+            shutil.rmtree(os.path.join(path, entry))
+
+
+def merge_segments(path=None, max_segments=MAX_SEGMENTS):
+    """
+    Merge the newest segments if there are more than *max_segments*.
+
+    Older segments are included as long as the newer ones add up to at least their size, so large segments
+    are rewritten rarely.
+    """
+    path = path or default_path()
+    index = InvertedIndex(path)
+    sizes = [len(segment) for segment in index.segments]
+    if len(sizes) <= max_segments:
+        return
+    start = max_segments - 1
+    while start and sum(sizes[start:]) >= sizes[start - 1]:
+        start -= 1
+    name = '%s-merged' % new_run_id()
+    index.merge(start, name)
+    names = [segment.name for segment in index.segments[:start]] + [name]
+    write_manifest(path, names)
+    remove_unused_segments(path, names)
+
+
+_current_index = None
+
+
+def current_index(path=None):
+    """The index in *path*, opened again when post analysis changed it."""
+    global _current_index
+    path = path or default_path()
+    try:
+        version = os.stat(os.path.join(path, MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    index = _current_index
+    if not index or index[0] != (path, version):
+        try:
+            index = (path, version), InvertedIndex(path)
+        except FileNotFoundError:
+            # Written by an older version, until post analysis rebuilds it.
+            return None
+        _current_index = index
+    return index[1]
@@ -0,0 +1,133 @@
+from time import perf_counter
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from .db import Base
+
+
+def autocommit(engine):
+    # VACUUM and CREATE INDEX CONCURRENTLY refuse to run inside a transaction block.
+    return engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def touched_tables(engine):
+    """Return names of tables with rows modified since they were last analyzed."""
+    with engine.connect() as conn:
+        return [name for name, in conn.execute(text(
+            'SELECT relname FROM pg_stat_user_tables WHERE n_mod_since_analyze > 0 ORDER BY relname'
+        ))]
+
+
+def vacuum_analyze(engine, tables, vacuum=True):
+    command = 'VACUUM (ANALYZE) ' if vacuum else 'ANALYZE '
+    preparer = engine.dialect.identifier_preparer
+    with autocommit(engine) as conn:
+        for table in tables:
+            t0 = perf_counter()
+            conn.execute(command + preparer.quote(table))
+            print('{}{} in {:.1f} s.'.format(command, table, perf_counter() - t0))
+
+
+def table_bloat(engine):
+    """
+    Dead tuple ratio and on-disk size of each table.
+
+    Result columns: table, live_tuples, dead_tuples, table_size, indexes_size
+    """
+    with engine.connect() as conn:
+        return conn.execute(text('''
+            SELECT relname AS table,
+                   n_live_tup AS live_tuples,
+                   n_dead_tup AS dead_tuples,
+                   pg_table_size(relid) AS table_size,
+                   pg_indexes_size(relid) AS indexes_size
+            FROM pg_stat_user_tables
+            ORDER BY n_dead_tup DESC, relname
+        ''')).fetchall()
+
+
+def unused_indexes(engine):
+    """
+    Indexes which were never used for a scan since statistics were last reset.
+
+    Primary key and unique indexes are never reported, since they enforce constraints.
+
+    Result columns: table, index, index_size, valid
+    """
+    with engine.connect() as conn:
+        return conn.execute(text('''
+            SELECT s.relname AS table,
+                   s.indexrelname AS index,
+                   pg_relation_size(s.indexrelid) AS index_size,
+                   i.indisvalid AS valid
+            FROM pg_stat_user_indexes s
+            JOIN pg_index i ON i.indexrelid = s.indexrelid
+            WHERE s.idx_scan = 0 AND NOT i.indisunique AND NOT i.indisprimary
+            ORDER BY pg_relation_size(s.indexrelid) DESC
+        ''')).fetchall()
+
+
+def missing_indexes(engine):
+    """Return indexes declared in the schema which do not exist in the database."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.tables.values():
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing_indexes)
+    return missing
+
+
+def create_missing_indexes(engine):
+    with autocommit(engine) as conn:
+        for index in missing_indexes(engine):
+            statement = str(CreateIndex(index).compile(dialect=engine.dialect))
+            statement = statement.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+            t0 = perf_counter()
+            conn.execute(statement)
+            print('Created index {} on {} in {:.1f} s.'.format(index.name, index.table.name, perf_counter() - t0))
+
+
+def format_size(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return '{:.0f} {}'.format(size, unit)
+
+
+def print_report(engine):
+    print('Table                           live tuples   dead tuples      table size    index size')
+    for row in table_bloat(engine):
+        print('{:30s} {:12d}  {:12d}  {:>14s}  {:>12s}'.format(
+            row.table, row.live_tuples, row.dead_tuples, format_size(row.table_size), format_size(row.indexes_size)))
+    print()
+
+    unused = unused_indexes(engine)
+    print('Unused indexes (%d):' % len(unused))
+    for row in unused:
+        print('  {} on {} ({}){}'.format(row.index, row.table, format_size(row.index_size),
+                                         '' if row.valid else ', INVALID'))
+
+    missing = missing_indexes(engine)
+    print('Missing indexes (%d):' % len(missing))
+    for index in missing:
+        print('  {} on {}'.format(index.name, index.table.name))
+
+
+def maintain(engine, tables=None, vacuum=True, create_indexes=False, report=True):
+    """
+    Refresh planner statistics (and vacuum) *tables*, or all tables modified since they were last analyzed.
+
+    Optionally create indexes missing from the database, concurrently (i.e. without locking out writes).
+    """
+    if tables is None:
+        tables = touched_tables(engine)
+    if create_indexes:
+        create_missing_indexes(engine)
+    vacuum_analyze(engine, tables, vacuum)
+    if report:
+        print_report(engine)
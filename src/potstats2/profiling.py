@@ -0,0 +1,165 @@
+import contextlib
+import cProfile
+import datetime
+import glob
+import json
+import os
+import os.path
+import pstats
+import re
+import resource
+import sys
+import tracemalloc
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REPORT = 'report.json'
+# Number of functions and allocation sites listed per section (the .pstats files have everything).
+TOP = 25
+
+# Directory the sections and the report are written to, None if profiling is disabled.
+_directory = None
+# The section active in this process, see section(). Forked processes inherit the section of their parent.
+_active = None
+
+
+def enable(directory):
+    """Profile the sections of this process (and of processes forked from it) into *directory*."""
+    global _directory
+    os.makedirs(directory, exist_ok=True)
+    for file in glob.glob(os.path.join(directory, '*.section.json')):
+        os.unlink(file)
+    _directory = directory
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def disable():
+    global _directory
+    if _directory is None:
+        return
+    _directory = None
+    event.remove(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.remove(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def enabled():
+    return _directory is not None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profiling_t0', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['profiling_t0'].pop()
+    if _active is None or _active.pid != os.getpid():
+        return
+    stats = _active.sql.setdefault(statement, dict(count=0, total=0.0, max=0.0))
+    stats['count'] += 1
+    stats['total'] += elapsed
+    stats['max'] = max(stats['max'], elapsed)
+
+
+def file_name(name, suffix):
+    return re.sub(r'[^\w.-]+', '-', name) + suffix
+
+
+class Section:
+    def __init__(self, name):
+        self.name = name
+        self.pid = os.getpid()
+        self.sql = {}
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # Python < 3.9: clearing the traces also resets the peak.
+            tracemalloc.clear_traces()
+        self.rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self.t0 = perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        elapsed = perf_counter() - self.t0
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        current, peak = tracemalloc.get_traced_memory()
+        allocations = tracemalloc.take_snapshot().statistics('lineno')[:TOP]
+
+        pstats_file = file_name(self.name, '.pstats')
+        self.profile.dump_stats(os.path.join(_directory, pstats_file))
+        stats = pstats.Stats(self.profile).stats
+        functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP]
+
+        result = dict(
+            name=self.name,
+            pid=self.pid,
+            elapsed=elapsed,
+            cpu_time=(rusage.ru_utime - self.rusage.ru_utime) + (rusage.ru_stime - self.rusage.ru_stime),
+            # Of the whole process, in kB on Linux.
+            max_rss=rusage.ru_maxrss,
+            tracemalloc_peak=peak,
+            top_allocations=[dict(location='%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                                  size=stat.size, count=stat.count) for stat in allocations],
+            pstats=pstats_file,
+            top_functions=[dict(function='%s:%d(%s)' % function, calls=calls, primitive_calls=primitive_calls,
+                                tottime=tottime, cumtime=cumtime)
+                           for function, (primitive_calls, calls, tottime, cumtime, callers) in functions],
+            sql=sorted((dict(statement=statement, **stats) for statement, stats in self.sql.items()),
+                       key=lambda stats: stats['total'], reverse=True),
+        )
+        with open(os.path.join(_directory, file_name(self.name, '.section.json')), 'w') as fd:
+            json.dump(result, fd)
+
+
+@contextlib.contextmanager
+def section(name):
+    """
+    Profile the code in the with block as the section *name*, if profiling is enabled.
+
+    Recorded are the cProfile stats (written to a .pstats file, the top functions are in the report),
+    the tracemalloc peak and top allocation sites, and the time spent in each SQL statement executed
+    through SQLAlchemy.
+
+    Sections don't nest: a section in a forked process replaces the one inherited from its parent.
+    """
+    global _active
+    if _directory is None:
+        yield
+        return
+    if _active is not None:
+        if _active.pid == os.getpid():
+            raise RuntimeError('Profiling section %s started within section %s' % (name, _active.name))
+        # Inherited through fork, only the parent will report it.
+        _active.profile.disable()
+    _active = Section(name)
+    _active.start()
+    try:
+        yield
+    finally:
+        _active.stop()
+        _active = None
+
+
+def write_report(argv=None):
+    """Combine the sections written so far (by any process) into report.json, returns its path."""
+    sections = []
+    for file in sorted(glob.glob(os.path.join(_directory, '*.section.json'))):
+        with open(file, 'r') as fd:
+            sections.append(json.load(fd))
+    report = dict(
+        created=datetime.datetime.utcnow().isoformat(),
+        argv=sys.argv if argv is None else argv,
+        sections=sorted(sections, key=lambda section: section['name']),
+    )
+    path = os.path.join(_directory, REPORT)
+    with open(path, 'w') as fd:
+        json.dump(report, fd, indent=1)
+    return path
@@ -0,0 +1,164 @@
+import datetime
+import fnmatch
+
+try:
+    import elasticsearch.helpers
+except ImportError:
+    pass
+
+# Index settings and mappings by alias. The indices themselves are named <alias>-<creation time>,
+# so that a rebuilt index can replace the old one atomically (see rebuild_index).
+INDICES = {
+    'post': {
+        'settings': {
+            'refresh_interval': '300s',
+            'number_of_shards': 1,
+        },
+        'mappings': {
+            'properties': {
+                'content': {
+                    'type': 'text',
+                    'analyzer': 'german',
+                },
+                'title': {
+                    'type': 'text',
+                    'analyzer': 'german',
+                },
+                'poster_uid': {
+                    'type': 'integer',
+                },
+                'bid': {
+                    'type': 'integer',
+                },
+                'timestamp': {
+                    'type': 'date',
+                },
+                'pid': {
+                    'type': 'integer',
+                }
+            }
+        }
+    },
+    'thread': {
+        'settings': {
+            'refresh_interval': '300s',
+            'number_of_shards': 1,
+        },
+        'mappings': {
+            'properties': {
+                'title': {
+                    'type': 'text',
+                    'analyzer': 'german',
+                },
+                'subtitle': {
+                    'type': 'text',
+                    'analyzer': 'german',
+                },
+                'tid': {
+                    'type': 'integer',
+                }
+            }
+        }
+    },
+}
+
+
+def index_exists(es, alias):
+    """True if *alias* exists (or, for indices created before aliases were used, an index of that name)."""
+    return es.indices.exists_alias(name=alias) or es.indices.exists(index=alias)
+
+
+def create_index(es, alias):
+    """Create a new, empty index for *alias* without pointing the alias at it, returns its name."""
+    index = '%s-%s' % (alias, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+    es.indices.create(index=index, body=INDICES[alias])
+    return index
+
+
+def ensure_index(es, alias):
+    """Create an index behind *alias* if it doesn't exist."""
+    if not index_exists(es, alias):
+        es.indices.update_aliases(body={'actions': [{'add': {'index': create_index(es, alias), 'alias': alias}}]})
+
+
+def mapping_outdated(es, alias):
+    """True if the index of *alias* lacks fields of its mapping in INDICES, i.e. was created by an older version."""
+    fields = set(INDICES[alias]['mappings']['properties'])
+    for index in es.indices.get(index=alias).values():
+        if fields - set(index['mappings'].get('properties', {})):
+            return True
+    return False
+
+
+def suspend_refresh(es, index):
+    """Disable periodic refreshes of *index* (an index or alias) during bulk indexing, see resume_refresh."""
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': -1}})
+
+
+def resume_refresh(es, index, alias):
+    """Refresh *index* and restore the refresh interval of *alias*."""
+    es.indices.refresh(index=index)
+    refresh_interval = INDICES[alias]['settings']['refresh_interval']
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': refresh_interval}})
+
+
+def swap_index(es, alias, index):
+    """
+    Point *alias* at *index* in one atomic step, then delete the index it pointed to before
+    and any leftovers of earlier rebuilds (or an index named like the alias).
+    """
+    old_indices = [name for name in es.indices.get(index=alias + '*', ignore_unavailable=True)
+                   if name != index and (name == alias or fnmatch.fnmatch(name, alias + '-*'))]
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    for name in old_indices:
+        if name == alias:
+            # A plain index named like the alias has to go in the same step, or the alias can't be added.
+            actions.append({'remove_index': {'index': name}})
+    es.indices.update_aliases(body={'actions': actions})
+    for name in old_indices:
+        if name != alias:
+            es.indices.delete(index=name, ignore=[404])
+
+
+def bulk_index(es, index, actions, threads=1, chunk_size=1000, queue_size=4):
+    """
+    Send bulk *actions* (index or delete, without _index) to *index*, returns the number of actions.
+
+    *actions* may be any iterable and is consumed lazily: at most about (*threads* + *queue_size*) × *chunk_size*
+    actions are held in memory at a time. With more than one thread, requests are sent concurrently with
+    parallel_bulk, which consumes *actions* in a background thread.
+
+    Deleting documents which don't exist is not an error. Other failed actions raise a BulkIndexError.
+    """
+    if threads > 1:
+        results = elasticsearch.helpers.parallel_bulk(es, actions, thread_count=threads, chunk_size=chunk_size,
+                                                      queue_size=queue_size, raise_on_error=False, index=index)
+    else:
+        results = elasticsearch.helpers.streaming_bulk(es, actions, chunk_size=chunk_size, raise_on_error=False,
+                                                       index=index)
+    count = 0
+    errors = []
+    for ok, item in results:
+        count += 1
+        if not ok and not ('delete' in item and item['delete'].get('status') == 404):
+            errors.append(item)
+    if errors:
+        raise elasticsearch.helpers.BulkIndexError('%d document(s) failed to index.' % len(errors), errors)
+    return count
+
+
+def rebuild_index(es, alias, actions, **kwargs):
+    """
+    Build a new index for *alias* from *actions* (see bulk_index) and switch the alias over to it once
+    it is complete, so that searches never see a partial index. Returns the number of actions.
+    """
+    index = create_index(es, alias)
+    try:
+        suspend_refresh(es, index)
+        count = bulk_index(es, index, actions, **kwargs)
+        resume_refresh(es, index, alias)
+    except BaseException:
+        es.indices.delete(index=index, ignore=[404])
+        raise
+    swap_index(es, alias, index)
+    return count
@@ -0,0 +1,207 @@
+import datetime
+import gzip
+import json
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from .db import Base, DataVersion
+from .maintenance import vacuum_analyze
+
+FORMAT = 'potstats2-snapshot'
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+COMPRESSLEVEL = 6
+
+# In import order, respecting foreign keys (except Thread.first_pid/last_pid, see import_snapshot).
+DIMENSION_TABLES = ('categories', 'boards', 'user_tiers', 'avatars', 'users', 'threads')
+BAKED_TABLES = ('baked_poster_stats', 'baked_daily_stats', 'baked_active_users', 'baked_quote_stats', 'link_relation')
+# These are exported in chunks of pid ranges. posts must be imported completely before the others,
+# since quotes may refer to posts in any chunk.
+POST_TABLES = ('posts', 'post_contents', 'post_search', 'post_quotes', 'post_links', 'analyzed_posts')
+# Only exported with contents.
+CONTENT_TABLES = ('post_contents', 'post_search')
+THREAD_POST_COLUMNS = ('first_pid', 'last_pid')
+
+
+class SnapshotError(RuntimeError):
+    pass
+
+
+def copy_columns(table):
+    """Columns of *table* which can be COPYed, i.e. all except generated ones."""
+    return [column.name for column in Base.metadata.tables[table].columns if column.computed is None]
+
+
+def quoted(engine, names):
+    return ', '.join(map(engine.dialect.identifier_preparer.quote, names))
+
+
+def alembic_revision(cursor):
+    cursor.execute("SELECT to_regclass('alembic_version') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return None
+    cursor.execute('SELECT version_num FROM alembic_version')
+    row = cursor.fetchone()
+    return row and row[0]
+
+
+def pid_ranges(cursor, chunk_size):
+    """Split the pid space into [lower, upper) ranges of *chunk_size* posts each; the last range is open."""
+    cursor.execute('SELECT pid FROM (SELECT pid, row_number() OVER (ORDER BY pid) AS n FROM posts) AS p '
+                   'WHERE (n - 1) %% %s = 0 ORDER BY pid', (chunk_size,))
+    lower_pids = [pid for pid, in cursor.fetchall()]
+    return list(zip(lower_pids, lower_pids[1:] + [None]))
+
+
+def export_table(engine, cursor, path, table, file_name, pid_range=None):
+    columns = copy_columns(table)
+    query = 'SELECT {} FROM {}'.format(quoted(engine, columns), table)
+    if pid_range:
+        lower_pid, upper_pid = pid_range
+        query += ' WHERE pid >= %d' % lower_pid
+        if upper_pid is not None:
+            query += ' AND pid < %d' % upper_pid
+    with gzip.open(os.path.join(path, file_name), 'wb', compresslevel=COMPRESSLEVEL) as fd:
+        cursor.copy_expert('COPY ({}) TO STDOUT (FORMAT binary)'.format(query), fd)
+    return dict(table=table, file=file_name, columns=columns, rows=cursor.rowcount)
+
+
+def export_snapshot(engine, path, posts=False, contents=False, chunk_size=1000000):
+    """
+    Write a snapshot of the database to the directory *path*.
+
+    The snapshot always contains the dimension (users, boards, threads, ...) and baked tables.
+    With *posts* it also contains posts, quotes, links and which posts were analyzed, and with *contents* the post contents
+    (and their full-text search documents), split into chunks of *chunk_size* posts.
+
+    Each table (chunk) is a gzip-compressed binary COPY; manifest.json lists them.
+    """
+    os.makedirs(path, exist_ok=True)
+    t0 = perf_counter()
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        # All tables are exported from the same snapshot, so the result is consistent.
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        manifest = dict(
+            format=FORMAT,
+            version=FORMAT_VERSION,
+            revision=alembic_revision(cursor),
+            created=datetime.datetime.utcnow().isoformat(),
+            tables=[],
+            post_chunks=[],
+        )
+        for table in DIMENSION_TABLES + BAKED_TABLES:
+            entry = export_table(engine, cursor, path, table, table + '.copy.gz')
+            manifest['tables'].append(entry)
+            print('Exported {} ({} rows).'.format(table, entry['rows']))
+
+        if posts:
+            post_tables = [table for table in POST_TABLES if contents or table not in CONTENT_TABLES]
+            for pid_range in pid_ranges(cursor, chunk_size):
+                chunk = dict(lower_pid=pid_range[0], upper_pid=pid_range[1], tables=[])
+                for table in post_tables:
+                    file_name = '{}.{}.copy.gz'.format(table, pid_range[0])
+                    chunk['tables'].append(export_table(engine, cursor, path, table, file_name, pid_range))
+                manifest['post_chunks'].append(chunk)
+                print('Exported posts from PID {} ({} posts).'.format(pid_range[0], chunk['tables'][0]['rows']))
+        conn.rollback()
+    finally:
+        conn.close()
+
+    with open(os.path.join(path, MANIFEST), 'w') as fd:
+        json.dump(manifest, fd, indent=4)
+    print('Exported snapshot to {} in {:.1f} s.'.format(path, perf_counter() - t0))
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as fd:
+            manifest = json.load(fd)
+    except FileNotFoundError:
+        raise SnapshotError('%s is not a snapshot (no %s)' % (path, MANIFEST))
+    if manifest.get('format') != FORMAT:
+        raise SnapshotError('%s is not a snapshot (unknown format %r)' % (path, manifest.get('format')))
+    if manifest['version'] > FORMAT_VERSION:
+        raise SnapshotError('Snapshot format version %d is not supported (expected at most %d)'
+                            % (manifest['version'], FORMAT_VERSION))
+    return manifest
+
+
+def import_table(engine, cursor, path, entry, into=None):
+    with gzip.open(os.path.join(path, entry['file']), 'rb') as fd:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN (FORMAT binary)'
+                           .format(into or entry['table'], quoted(engine, entry['columns'])), fd)
+
+
+def import_table_parallel(engine, path, entry):
+    conn = engine.raw_connection()
+    try:
+        import_table(engine, conn.cursor(), path, entry)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def import_snapshot(engine, path, jobs=4):
+    """
+    Load a snapshot written by export_snapshot into the (empty) database.
+
+    Post chunks are loaded by *jobs* parallel connections.
+    """
+    manifest = read_manifest(path)
+    t0 = perf_counter()
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        revision = alembic_revision(cursor)
+        if revision and manifest['revision'] and revision != manifest['revision']:
+            raise SnapshotError('Snapshot has schema revision %s, but the database is at %s'
+                                % (manifest['revision'], revision))
+        for table in DIMENSION_TABLES + BAKED_TABLES + POST_TABLES:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM %s)' % table)
+            if cursor.fetchone()[0]:
+                raise SnapshotError('Table %s is not empty, refusing to import' % table)
+
+        for entry in manifest['tables']:
+            if entry['table'] == 'threads':
+                # Threads and posts refer to each other, so the first/last posts can only be set after posts
+                # are imported (if they are imported at all).
+                cursor.execute('CREATE TEMPORARY TABLE snapshot_threads (LIKE threads)')
+                import_table(engine, cursor, path, entry, into='snapshot_threads')
+                columns = quoted(engine, [c for c in entry['columns'] if c not in THREAD_POST_COLUMNS])
+                cursor.execute('INSERT INTO threads ({0}) SELECT {0} FROM snapshot_threads'.format(columns))
+            else:
+                import_table(engine, cursor, path, entry)
+            print('Imported {} ({} rows).'.format(entry['table'], entry['rows']))
+        conn.commit()
+
+        chunk_tables = [chunk['tables'] for chunk in manifest['post_chunks']]
+        with ThreadPoolExecutor(jobs) as executor:
+            for phase in (lambda e: e['table'] == 'posts', lambda e: e['table'] != 'posts'):
+                entries = [entry for tables in chunk_tables for entry in tables if phase(entry)]
+                for _ in executor.map(lambda entry: import_table_parallel(engine, path, entry), entries):
+                    pass
+                if entries:
+                    print('Imported {} ({} rows).'.format(', '.join(sorted({e['table'] for e in entries})),
+                                                          sum(e['rows'] for e in entries)))
+
+        if manifest['post_chunks']:
+            cursor.execute('UPDATE threads SET first_pid = s.first_pid, last_pid = s.last_pid '
+                           'FROM snapshot_threads AS s WHERE threads.tid = s.tid')
+        cursor.execute("SELECT setval(pg_get_serial_sequence('user_tiers', 'tied'), "
+                       "coalesce(max(tied), 0) + 1, false) FROM user_tiers")
+        conn.commit()
+    finally:
+        conn.close()
+
+    imported_tables = [entry['table'] for entry in manifest['tables']]
+    if manifest['post_chunks']:
+        imported_tables.extend(entry['table'] for entry in manifest['post_chunks'][0]['tables'])
+    vacuum_analyze(engine, imported_tables, vacuum=False)
+
+    DataVersion.bump(engine)
+    from .backend import cache
+    cache.invalidate()
+    print('Imported snapshot from {} in {:.1f} s.'.format(path, perf_counter() - t0))
@@ -0,0 +1,327 @@
+import datetime
+import itertools
+import os
+import sys
+import traceback
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from . import profiling
+from .db import Base, AnalyticsStageState
+from .maintenance import autocommit
+
+# Tables written by isolated stages are redirected into a schema with this prefix (through the search_path),
+# and moved into the real tables in the final transaction. Each run has its own schema.
+STAGE_SCHEMA = 'potstats2_stage'
+RUN_IDS = itertools.count()
+
+
+# Input name => function(session) returning a fingerprint of that input, see fingerprint().
+FINGERPRINTS = {}
+
+
+class StageError(RuntimeError):
+    pass
+
+
+def fingerprint_of(name):
+    """Decorator registering a fingerprint function for the stage input *name*."""
+    def decorator(function):
+        FINGERPRINTS[name] = function
+        return function
+    return decorator
+
+
+def query_fingerprint(session, sql):
+    session.flush()
+    return [None if value is None else str(value) for value in session.execute(sql).first()]
+
+
+@fingerprint_of('posts')
+def posts_fingerprint(session):
+    # New posts raise the count and max(pid), edits the sum of edit counts, moved threads the sum of boards.
+    return query_fingerprint(session, 'SELECT count(*), max(pid), sum(edit_count), max(last_edit_timestamp), '
+                                      'sum(bid) FROM posts')
+
+
+@fingerprint_of('post_quotes')
+def post_quotes_fingerprint(session):
+    return query_fingerprint(session, 'SELECT count(*), sum(count), sum(pid), sum(quoted_pid) FROM post_quotes')
+
+
+@fingerprint_of('post_links')
+def post_links_fingerprint(session):
+    return query_fingerprint(session, 'SELECT count(*), sum(count), sum(pid), sum(length(url)) FROM post_links')
+
+
+@fingerprint_of('my_mods_users')
+def my_mods_users_fingerprint(session):
+    # Not a hash of whole rows, which would read all pages and change when parse_user_profiles marks them parsed.
+    return query_fingerprint(session, "SELECT count(*), sum(uid), "
+                                      "sum(('x' || substr(html_md5, 1, 15))::bit(60)::bigint) FROM my_mods_users")
+
+
+def fingerprint(session, name):
+    """
+    Fingerprint of the stage input *name*: a JSON-serializable value which (most likely) changes with the input.
+
+    Tables without a registered fingerprint function are fingerprinted by their row count and a sum of row
+    hashes. Other inputs without one have no fingerprint (None), i.e. they never count as changed.
+    Registered fingerprint functions return None if their input does not exist (e.g. a deleted file).
+    """
+    if name in FINGERPRINTS:
+        return FINGERPRINTS[name](session)
+    if name in Base.metadata.tables:
+        return query_fingerprint(session, "SELECT count(*), sum(('x' || substr(md5(t::text), 1, 15))::bit(60)::bigint) "
+                                          "FROM %s AS t" % name)
+    return None
+
+
+class Stage:
+    """
+    A step of the analytics run: *function* is called with a session.
+
+    *inputs* and *outputs* name what the stage reads and writes: tables, or anything else (e.g. a file)
+    other stages may depend on. A stage runs once all stages producing its inputs are done.
+
+    Isolated stages run in their own process and transaction. The tables they write are empty copies
+    in the stage schema, so they must completely rewrite their output tables (like the bakes do).
+    Other stages run in the main process and session, i.e. in the final transaction.
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), isolated=True):
+        self.name = name
+        self.function = function
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.isolated = isolated
+
+    @property
+    def output_tables(self):
+        return sorted(output for output in self.outputs if output in Base.metadata.tables)
+
+    def __repr__(self):
+        return '<Stage %s>' % self.name
+
+
+def check_stages(stages):
+    """Raise StageError if *stages* have conflicting outputs or dependencies which can't be satisfied."""
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise StageError('%s is written by both %s and %s' % (output, producers[output].name, stage.name))
+            producers[output] = stage
+
+    for stage in stages:
+        for dependency in stage.inputs:
+            producer = producers.get(dependency)
+            if stage.isolated and producer and not producer.isolated:
+                # Writes of the main session are not committed before the very end.
+                raise StageError('Isolated stage %s can not depend on %s of %s, which runs in the main session'
+                                 % (stage.name, dependency, producer.name))
+
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending if stage_ready(stage, pending, ())]
+        if not ready:
+            raise StageError('Dependency cycle between %s' % ', '.join(stage.name for stage in pending))
+        for stage in ready:
+            pending.remove(stage)
+
+
+def stage_ready(stage, pending, running):
+    """A stage is ready when no other pending or running stage produces one of its inputs."""
+    return not any(stage.inputs & other.outputs for other in list(pending) + list(running) if other is not stage)
+
+
+def run_reason(session, stage, fingerprints, produced, force=()):
+    """
+    Why *stage* has to run (a string), or None if it can be skipped because its inputs are unchanged
+    and its outputs exist.
+
+    *fingerprints* are the current fingerprints of its inputs, *produced* maps outputs of the stages which run
+    (or ran) in this run to their stage names.
+    """
+    if stage.name in force:
+        return 'forced'
+    state = session.query(AnalyticsStageState).get(stage.name)
+    if not state:
+        return 'never ran'
+    for name in sorted(stage.outputs):
+        if name in FINGERPRINTS and FINGERPRINTS[name](session) is None:
+            return '%s is missing' % name
+    for name in sorted(stage.inputs):
+        if name in produced:
+            return '%s is produced by %s' % (name, produced[name])
+    if state.fingerprint != fingerprints:
+        changed = sorted(name for name in set(fingerprints) | set(state.fingerprint)
+                         if state.fingerprint.get(name) != fingerprints.get(name))
+        return '%s changed' % ', '.join(changed)
+    return None
+
+
+def record_stage(session, stage, fingerprints):
+    session.merge(AnalyticsStageState(stage=stage.name, fingerprint=fingerprints,
+                                      completed=datetime.datetime.utcnow()))
+
+
+def topological_order(stages):
+    pending = list(stages)
+    while pending:
+        stage = next(stage for stage in pending if stage_ready(stage, pending, ()))
+        pending.remove(stage)
+        yield stage
+
+
+def plan_stages(session, stages, force=()):
+    """Print which of *stages* would run and why, without running anything."""
+    check_stages(stages)
+    produced = {}
+    for stage in topological_order(stages):
+        fingerprints = {name: fingerprint(session, name) for name in stage.inputs}
+        reason = run_reason(session, stage, fingerprints, produced, force)
+        if reason:
+            produced.update(dict.fromkeys(stage.outputs, stage.name))
+            print('{:30s} runs: {}'.format(stage.name, reason))
+        else:
+            print('{:30s} skipped: inputs unchanged'.format(stage.name))
+
+
+def create_stage_tables(engine, schema, stage):
+    """Create empty copies of the output tables of *stage* in *schema* (creating it if necessary)."""
+    with autocommit(engine) as conn:
+        conn.execute('CREATE SCHEMA IF NOT EXISTS %s' % schema)
+        for table in stage.output_tables:
+            conn.execute('CREATE UNLOGGED TABLE {0}.{1} (LIKE public.{1} INCLUDING DEFAULTS)'.format(schema, table))
+
+
+def run_isolated_stage(url, stage, schema):
+    """Run *stage* in this (forked) process on a new connection, committing into the stage *schema*."""
+    session = sessionmaker(bind=create_engine(url))()
+    session.execute('SET search_path TO %s, public' % schema)
+    with profiling.section('stage ' + stage.name):
+        stage.function(session)
+        session.commit()
+    session.close()
+    session.bind.dispose()
+
+
+def fork_stage(url, stage, schema):
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        run_isolated_stage(url, stage, schema)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Skip interpreter cleanup, which would close connections inherited from the parent.
+        os._exit(status)
+
+
+def merge_stage_tables(session, schema, stages):
+    for stage in stages:
+        for table in stage.output_tables:
+            session.execute('DELETE FROM public.%s' % table)
+            session.execute('INSERT INTO public.{1} SELECT * FROM {0}.{1}'.format(schema, table))
+    # In the same transaction, since it holds locks on the stage tables now.
+    session.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+
+
+def run_stages(session, stages, jobs=4, force=()):
+    """
+    Run *stages*, isolated stages in up to *jobs* processes at a time, as soon as their inputs are available.
+
+    Stages whose inputs have the same fingerprints as when they last ran are skipped, unless named in *force*,
+    some input is produced by another stage which runs or some output is missing.
+
+    Everything is committed at once at the end (by the caller, through *session*): isolated stages write into
+    a stage schema, which is moved into the real tables in *session*, and the stage state is updated.
+    Isolated stages see committed data only, i.e. neither uncommitted changes of *session* nor those of an
+    earlier run_stages in the same transaction.
+    """
+    check_stages(stages)
+    t0 = perf_counter()
+    engine = session.bind
+    # Unique, since the schema of an earlier run in this transaction is only dropped when it commits.
+    schema = '%s_%d_%d' % (STAGE_SCHEMA, os.getpid(), next(RUN_IDS))
+
+    pending = list(stages)
+    running = {}
+    produced = {}
+    fingerprints = {}
+    ran = []
+    failed = []
+    stage_time = 0
+
+    def start(stage):
+        for name in stage.inputs:
+            if name not in fingerprints:
+                fingerprints[name] = fingerprint(session, name)
+        reason = run_reason(session, stage, {name: fingerprints[name] for name in stage.inputs}, produced, force)
+        if not reason:
+            print('Skipping {} (inputs unchanged).'.format(stage.name))
+            return None
+        produced.update(dict.fromkeys(stage.outputs, stage.name))
+        ran.append(stage)
+        if stage.isolated:
+            # Only stages which run get stage tables, the others' outputs are read from the real tables.
+            create_stage_tables(engine, schema, stage)
+            return fork_stage(engine.url, stage, schema)
+        with profiling.section('stage ' + stage.name):
+            stage.function(session)
+
+    try:
+        while pending or running:
+            running_stages = [stage for stage, started in running.values()]
+            ready = [stage for stage in pending if stage_ready(stage, pending, running_stages)]
+            # Fork isolated stages first, so that they are busy while a stage runs in this process.
+            ready.sort(key=lambda stage: not stage.isolated)
+            ready = [stage for stage in ready if not stage.isolated or len(running) < jobs]
+            if ready and not failed:
+                stage = ready[0]
+                pending.remove(stage)
+                started = perf_counter()
+                pid = start(stage)
+                if pid:
+                    running[pid] = stage, started
+                else:
+                    stage_time += perf_counter() - started
+            elif running:
+                pid, status = os.waitpid(-1, 0)
+                stage, started = running.pop(pid)
+                stage_time += perf_counter() - started
+                if status:
+                    failed.append(stage.name)
+            else:
+                break
+        if failed:
+            raise StageError('Stage(s) %s failed' % ', '.join(failed))
+    except BaseException:
+        for pid in running:
+            os.waitpid(pid, 0)
+        # The main session did not touch the stage schema yet, so this doesn't wait for it.
+        with autocommit(engine) as conn:
+            conn.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+        raise
+
+    # Skipped stages did not write stage tables, so the real ones are left alone.
+    merge_stage_tables(session, schema, [stage for stage in ran if stage.isolated])
+
+    # Inputs produced in this run are fingerprinted now that they are in the real tables.
+    for name in produced:
+        fingerprints.pop(name, None)
+    for stage in ran:
+        for name in stage.inputs:
+            if name not in fingerprints:
+                fingerprints[name] = fingerprint(session, name)
+        record_stage(session, stage, {name: fingerprints[name] for name in stage.inputs})
+    print('Ran {} of {} stages in {:.1f} s ({:.1f} s total stage time).'.format(
+        len(ran), len(stages), perf_counter() - t0, stage_time))
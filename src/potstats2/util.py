@@ -1,3 +1,4 @@
+import itertools
 from time import perf_counter
 
 from click._termui_impl import ProgressBar
@@ -31,20 +32,92 @@ class ElapsedProgressBar(ProgressBar):
         super().render_finish()
 
 
+_stream_cursor_ids = itertools.count()
+
+
+def stream_query(query, itersize=2000):
+    """
+    Iterate over the rows of a query as plain tuples, using a server-side (named) cursor.
+
+    The query is planned and executed exactly once; rows are fetched *itersize* at a time.
+    Values are returned as delivered by psycopg2, i.e. without SQLAlchemy type processing
+    (enums are strings, for example).
+
+    The cursor lives inside the current transaction of the query's session,
+    so the session must not be committed while iterating.
+    """
+    statement = query.statement
+    compiled = statement.compile(dialect=query.session.bind.dialect)
+    name = 'stream_query_%d' % next(_stream_cursor_ids)
+    with query.session.connection().connection.cursor(name) as cursor:
+        cursor.itersize = itersize
+        cursor.execute(str(compiled), compiled.params)
+        yield from cursor
+
+
 def chunk_query(query, primary_key, chunk_size=1000):
     """
-    Split a query into smaller ones along the given primary key.
+    Split the result of a query into lists of at most *chunk_size* rows, ordered along the given primary key.
+
+    Rows are plain tuples, see stream_query.
     """
-    last_id = None
+    rows = stream_query(query.order_by(primary_key), itersize=chunk_size)
     while True:
-        q = query
-        if last_id is not None:
-            q = query.filter(primary_key > last_id)
-        rows = q.order_by(primary_key).limit(chunk_size).all()
-        yield rows
-        if not rows:
+        chunk = list(itertools.islice(rows, chunk_size))
+        yield chunk
+        if not chunk:
             break
-        last_id = getattr(rows[-1], primary_key.name)
+
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value):
+    """Format a value for COPY's text format."""
+    if isinstance(value, int):
+        return str(value)
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    return str(value).translate(COPY_ESCAPES)
+
+
+class CopyRowStream:
+    """
+    Read-only file-like object returning *rows* in COPY's text format, for COPY ... FROM STDIN.
+
+    Rows are formatted as they are read, so they are never all held in memory.
+    """
+    def __init__(self, rows, batch_size=1000):
+        self.rows = iter(rows)
+        self.batch_size = batch_size
+        self.pending = ''
+        # Position of the first unread character in pending, which is only copied when the next batch is appended.
+        self.offset = 0
+
+    def read(self, size=-1):
+        available = len(self.pending) - self.offset
+        while size < 0 or available < size:
+            batch = list(itertools.islice(self.rows, self.batch_size))
+            if not batch:
+                break
+            formatted = ''.join('\t'.join(map(copy_value, row)) + '\n' for row in batch)
+            self.pending = self.pending[self.offset:] + formatted
+            self.offset = 0
+            available = len(self.pending)
+        if size < 0:
+            size = available
+        data = self.pending[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def copy_rows(session, table, columns, rows):
+    """COPY an iterable of *rows* (tuples of *columns*) into *table*, within the session's transaction."""
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), CopyRowStream(rows))
+    return cursor.rowcount
 
 
 class explain(Executable, ClauseElement):
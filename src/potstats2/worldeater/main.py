@@ -8,7 +8,7 @@ from sqlalchemy.orm.attributes import set_attribute
 from .api import XmlApiConnector, ProfileNotFoundError, UnreachableProfileError, NoAccess, InvalidThreadError
 from ..config import setup_debugger
 from ..db import get_session, Category, Board, Thread, Post, PostContent, User, WorldeaterState, \
-    WorldeaterThreadsNeedingUpdate, MyModsUserStaging, Avatar
+    WorldeaterThreadsNeedingUpdate, MyModsUserStaging, Avatar, DataVersion
 from ..util import ElapsedProgressBar
 from ..backend import cache
 
@@ -61,6 +61,7 @@ def merge_posts(session, dbthread, posts):
         # We roundtrip to the DB for each post here, but that's most likely not a problem
         # because we get at most 30 posts per 0.2 s (API rate limiting and network speed).
         dbpost = session.query(Post).get(pid) or Post(pid=pid, thread=dbthread)
+        dbpost.board = dbthread.board
         dbpost.timestamp = datetime_from_xml(post.find('./date'))
         dbpost.poster = User.from_xml(session, post.find('./user'), dbpost.timestamp)
         edited = post.find('./message/edited')
@@ -116,8 +117,12 @@ def thread_from_xml(session, thread):
     Precondition: Board object must exist to satisfy foreign key constraint on Thread.bid.
     """
     tid = int(thread.attrib['id'])
+    bid = int(thread.find('./in-board').attrib['id'])
     dbthread = session.query(Thread).get(tid) or Thread(tid=tid)
-    dbthread.board = session.query(Board).get(int(thread.find('./in-board').attrib['id']))
+    if dbthread.bid is not None and dbthread.bid != bid:
+        # Thread was moved to another board, Post.bid needs to follow.
+        session.query(Post).filter(Post.tid == tid).update({Post.bid: bid}, synchronize_session='evaluate')
+    dbthread.board = session.query(Board).get(bid)
     dbthread.title = thread.find('./title').text
     dbthread.subtitle = thread.find('./subtitle').text
     dbthread.is_closed = i2b(thread.find('./flags/is-closed'))
@@ -343,5 +348,6 @@ def main(board_id, only_tnu, force_initial_pass, my_mods_profiles):
     print('Added posts             {:12d}           {:12d}'.format(added_posts, initial_post_count + added_posts))
     print('Added threads           {:12d}           {:12d}'.format(added_threads, initial_thread_count + added_threads))
 
+    DataVersion.bump(session)
     session.commit()
     cache.invalidate()
@@ -0,0 +1,122 @@
+"""
+The original character-by-character implementation of analytics.analyze_post,
+kept as the reference for differential testing and benchmarking the tokenizer-based one.
+"""
+from urllib.parse import urlparse
+
+from potstats2.db import LinkType
+
+
+def analyze_post(post, pids, quotes, urls, search_contents=None):
+    in_tag = False
+    in_quoted_string = False
+    capture_contents = False
+    current_tag = ''
+    tag_contents = ''
+    quote_level = 0
+
+    def update_edge(quote_tag, post):
+        try:
+            # quote=tid,pid,"user"
+            _, _, params = quote_tag.partition('=')
+            # tid,pid,"user"
+            tid, pid, user_name = params.split(',', maxsplit=2)
+            pid = int(pid)
+            if pid not in pids:  # may raise OverflowError
+                print('PID %d: Quoted PID not on record: %d' % (post.pid, pid))
+                return
+        except ValueError as ve:
+            print('PID %d: Malformed quote= tag: %r (%s)' % (post.pid, quote_tag, ve))
+            return
+        except OverflowError:
+            print('PID %d: Invalid quoted PID %d' % (post.pid, pid))
+            return
+
+        quotes.append(dict(pid=post.pid, quoted_pid=pid, count=1))
+
+    def update_url(url, link_type, post):
+        if url:
+            if url.startswith('data:'):
+                print('PID %d: Skipping data: URL' % post.pid)
+                return
+            if len(url) > 300:
+                url = url[:300]
+            if url[0] == url[-1] and url[0] in ("'", '"'):
+                url = url[1:-1]
+            if url.startswith('/'):
+                url = 'http://forum.mods.de' + url
+            elif url.startswith('./'):
+                url = 'http://forum.mods.de/bb/' + url[2:]
+            if '://' not in url:
+                url = 'http://' + url
+        try:
+            domain = urlparse(url).netloc
+        except ValueError:
+            print('PID %d: Could not parse URL: %r' % (post.pid, url))
+            return
+
+        urls.append(dict(pid=post.pid, url=url, domain=domain, count=1, type=link_type))
+
+    def index_for_search(post, original_content):
+        if search_contents is not None:
+            search_contents.append(dict(
+                pid=post.pid,
+                poster_uid=post.poster_uid,
+                bid=post.bid,
+                timestamp=post.timestamp,
+                content=original_content,
+                title=post.title,
+            ))
+
+    if not post.content:
+        return
+
+    original_content = ''
+
+    for char in post.content:
+        if not in_quoted_string and char == '[':
+            in_tag = True
+            current_tag = ''
+        elif not in_quoted_string and char == ']':
+            in_tag = False
+
+            if current_tag.startswith('quote'):
+                quote_level += 1
+            elif current_tag == '/quote':
+                quote_level -= 1
+
+            if quote_level == 1 and current_tag.startswith('quote='):
+                update_edge(current_tag, post)
+
+            if quote_level == 0:
+                if current_tag.startswith('url='):
+                    update_url(current_tag[4:], LinkType.link, post)
+                elif current_tag == 'url':
+                    capture_contents = True
+                elif current_tag == '/url' and capture_contents:
+                    update_url(tag_contents, LinkType.link, post)
+                    capture_contents = False
+                    tag_contents = ''
+                elif current_tag == 'img':
+                    capture_contents = True
+                elif current_tag == '/img' and capture_contents:
+                    update_url(tag_contents, LinkType.image, post)
+                    capture_contents = False
+                    tag_contents = ''
+                elif current_tag in ('video', 'video play', 'video autoplay'):
+                    capture_contents = True
+                elif current_tag == '/video' and capture_contents:
+                    update_url(tag_contents, LinkType.video, post)
+                    capture_contents = False
+                    tag_contents = ''
+        elif in_tag:
+            current_tag += char
+            if char == '"':
+                in_quoted_string = not in_quoted_string
+        elif capture_contents:
+            tag_contents += char
+        if quote_level == 0 and not in_tag and char not in ('[', ']'):
+            original_content += char
+
+    if original_content:
+        index_for_search(post, original_content)
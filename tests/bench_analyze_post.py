@@ -0,0 +1,89 @@
+"""
+Compare analytics.analyze_post against the reference implementation in posts/s.
+
+    python tests/bench_analyze_post.py              # synthetic corpus
+    python tests/bench_analyze_post.py --db 100000  # first 100000 posts from the configured database
+"""
+import contextlib
+import io
+import random
+from time import perf_counter
+
+import click
+
+from potstats2 import analytics, db
+
+import analyze_post_reference
+
+WORDS = ('der', 'die', 'das', 'und', 'ist', 'nicht', 'ich', 'du', 'mal', 'auch', 'Thread', 'Forum', 'Spiel',
+         'eigentlich', 'genau', 'Problem', 'funktioniert', 'überhaupt', 'schön', ':)', ':D', '?', '!', '...')
+
+
+def sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(4, 20))) + '. '
+
+
+def synthetic_post(rng, pid):
+    parts = []
+    if rng.random() < 0.3:
+        quoted_pid = rng.randrange(1, pid)
+        inner = sentence(rng)
+        if rng.random() < 0.2:
+            inner = '[quote=1,%d,"x"]%s[/quote]' % (rng.randrange(1, pid), sentence(rng)) + inner
+        parts.append('[quote=1,%d,"[Höhlenmensch]"]%s[/quote]\n' % (quoted_pid, inner))
+    for _ in range(rng.randrange(1, 8)):
+        parts.append(sentence(rng))
+        r = rng.random()
+        if r < 0.1:
+            parts.append('[url=http://example.com/%d]link[/url] ' % rng.randrange(1000))
+        elif r < 0.15:
+            parts.append('[img]http://i.imgur.com/%d.png[/img]\n' % rng.randrange(1000))
+        elif r < 0.2:
+            parts.append('[b]%s[/b]' % sentence(rng))
+        elif r < 0.22:
+            parts.append('[url="http://example.com/?q=[%d]"]x[/url]' % rng.randrange(1000))
+    return analytics.PostRow(pid=pid, poster_uid=1, bid=1, timestamp=None, edit_count=0, content=''.join(parts),
+                             title=None)
+
+
+def synthetic_corpus(num_posts):
+    rng = random.Random(0)
+    return [synthetic_post(rng, pid) for pid in range(1, num_posts + 1)]
+
+
+def database_corpus(num_posts):
+    session = db.get_session()
+    posts = []
+    for post in analytics.iter_posts(session, 0):
+        posts.append(post)
+        if len(posts) >= num_posts:
+            break
+    return posts
+
+
+def measure(analyze_post, posts, pids):
+    quotes, urls, search_contents = [], [], []
+    t0 = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for post in posts:
+            analyze_post(post, pids, quotes, urls, search_contents)
+    return perf_counter() - t0
+
+
+@click.command()
+@click.option('--posts', 'num_posts', default=50000, help='Size of the synthetic corpus.')
+@click.option('--db', 'db_posts', type=int, default=None, help='Use this many posts from the database instead.')
+def main(num_posts, db_posts):
+    posts = database_corpus(db_posts) if db_posts else synthetic_corpus(num_posts)
+    pids = set(post.pid for post in posts)
+    size = sum(len(post.content or '') for post in posts)
+    print('Corpus: {} posts, {:.1f} MB'.format(len(posts), size / 1e6))
+
+    reference = measure(analyze_post_reference.analyze_post, posts, pids)
+    tokenizer = measure(analytics.analyze_post, posts, pids)
+    print('reference  {:10.0f} posts/s'.format(len(posts) / reference))
+    print('tokenizer  {:10.0f} posts/s  ({:.1f}x)'.format(len(posts) / tokenizer, reference / tokenizer))
+
+
+if __name__ == '__main__':
+    main()
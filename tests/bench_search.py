@@ -0,0 +1,77 @@
+"""
+Compare post search latency of the postgres, elasticsearch and local backends on the same corpus.
+
+All of them have to be populated: run potstats2-analytics with SEARCH_BACKEND=postgres, elasticsearch and local
+(backends which are not populated are skipped, except postgres).
+
+    python tests/bench_search.py
+    python tests/bench_search.py --repeat 50 'haus' '"neue häuser"' 'auto +haus -boot'
+"""
+import statistics
+from time import perf_counter
+
+import click
+
+from potstats2 import config, dal, db, inverted_index
+from potstats2.backend import parse_textual_query, parse_textual_tsquery, parse_textual_index_query
+
+QUERIES = ('haus', 'spiel forum', '"funktioniert nicht"', 'problem +spiel', 'thread -forum', 'überhaupt')
+
+
+def search_postgres(session, query):
+    return dal.search_posts(session, parse_textual_tsquery(query))[0]
+
+
+def search_elasticsearch(es, query):
+    result = es.search(index='post', body={
+        'size': 30,
+        'query': parse_textual_query(query, fields=['content']),
+        'highlight': {'encoder': 'html', 'fields': {'content': {}}},
+    })
+    return result['hits']['total']['value']
+
+
+def search_local(index, query):
+    return index.search(parse_textual_index_query(query))[0]
+
+
+def measure(search, query, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        count = search(query)
+        times.append(perf_counter() - t0)
+    times.sort()
+    return count, statistics.median(times), times[int(len(times) * 0.95) - 1]
+
+
+@click.command()
+@click.option('--repeat', default=20, help='Number of times each query is run.')
+@click.argument('queries', nargs=-1)
+def main(repeat, queries):
+    session = db.get_session()
+    es = config.elasticsearch.Elasticsearch() if config.elasticsearch else None
+    index = inverted_index.current_index()
+    print('{:30s} {:>8s} {:>10s} {:>10s}   {:>8s} {:>10s} {:>10s}   {:>8s} {:>10s} {:>10s}'.format(
+        'query', 'pg hits', 'pg p50', 'pg p95', 'es hits', 'es p50', 'es p95', 'ii hits', 'ii p50', 'ii p95'))
+    for query in queries or QUERIES:
+        line = '{:30s} {:8d} {:8.1f}ms {:8.1f}ms'.format(
+            query, *scale(measure(lambda query: search_postgres(session, query), query, repeat)))
+        if es:
+            line += '   {:8d} {:8.1f}ms {:8.1f}ms'.format(
+                *scale(measure(lambda query: search_elasticsearch(es, query), query, repeat)))
+        else:
+            line += ' ' * 33
+        if index:
+            line += '   {:8d} {:8.1f}ms {:8.1f}ms'.format(
+                *scale(measure(lambda query: search_local(index, query), query, repeat)))
+        print(line)
+
+
+def scale(result):
+    count, median, p95 = result
+    return count, median * 1000, p95 * 1000
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
+import datetime
 import os
+import random
 
 from sqlalchemy import create_engine
 
@@ -66,9 +68,38 @@ def data(session):
     cave = db.User(uid=5000, gid=6, name='[Höhlenmensch]')
     session.add(cave)
     session.add(db.Category(cid=5, name='Fake Kategorie'))
-    session.add(db.Board(bid=7, cid=5, name='Fake Forum für 1 fake Kategorie'))
+    board = db.Board(bid=7, cid=5, name='Fake Forum für 1 fake Kategorie')
+    session.add(board)
     thread = db.Thread(tid=1, bid=7, title='Thread1')
     session.add(thread)
-    cavepost = db.Post(pid=100, thread=thread, poster=cave)
+    cavepost = db.Post(pid=100, thread=thread, board=board, poster=cave)
     cavepost.content = db.PostContent(post=cavepost, content='Foo')
     session.add(cavepost)
+
+
+@pytest.fixture
+def many_posts(session, data):
+    rng = random.Random(0)
+    post = session.query(db.Post).get(100)
+    post.timestamp = datetime.datetime(2018, 1, 1)
+    post.edit_count = post.content_length = 0
+    session.add(db.Board(bid=8, cid=5, name='Noch ein Forum'))
+    for tid in range(2, 6):
+        session.add(db.Thread(tid=tid, bid=7 + tid % 2, title='Thread%d' % tid))
+    session.flush()
+    pids = []
+    for pid in range(200, 400):
+        tid = rng.randrange(2, 6)
+        post = db.Post(pid=pid, tid=tid, bid=7 + tid % 2, poster_uid=rng.choice((1, 2891831, 5000)),
+                       timestamp=datetime.datetime(2017, 12, 30) + datetime.timedelta(hours=rng.randrange(24 * 5)),
+                       edit_count=rng.randrange(3), content_length=rng.randrange(1000))
+        session.add(post)
+        pids.append(pid)
+    session.flush()
+    for tid in range(2, 6):
+        first_pid = session.query(db.Post.pid).filter_by(tid=tid).order_by(db.Post.pid).limit(1).scalar()
+        session.query(db.Thread).get(tid).first_pid = first_pid
+    for pid in pids[10:]:
+        for quoted_pid in set(rng.sample(pids[:pids.index(pid)], rng.randrange(3))):
+            session.add(db.PostQuotes(pid=pid, quoted_pid=quoted_pid, count=rng.randrange(1, 4)))
+    session.flush()
@@ -0,0 +1,124 @@
+import copy
+import fnmatch
+import json
+
+from elasticsearch import NotFoundError, RequestError
+from elasticsearch.serializer import JSONSerializer
+
+
+class FakeTransport:
+    serializer = JSONSerializer()
+
+
+class FakeIndices:
+    """The parts of the indices API used by potstats2, on FakeElasticsearch."""
+
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index):
+        return index in self.es.indices_ or index in self.es.aliases
+
+    def exists_alias(self, name):
+        return name in self.es.aliases
+
+    def get(self, index, ignore_unavailable=False):
+        return {name: copy.deepcopy(self.es.indices_[name]['body']) for name in self.es.resolve(index, pattern=True)}
+
+    def create(self, index, body=None):
+        if self.exists(index):
+            raise RequestError(400, 'resource_already_exists_exception', {})
+        body = copy.deepcopy(body or {})
+        self.es.indices_[index] = dict(body=body, settings=dict(body.get('settings', {})), docs={}, searchable={})
+
+    def delete(self, index, ignore=()):
+        try:
+            names = self.es.resolve(index)
+        except NotFoundError:
+            if 404 in ignore:
+                return
+            raise
+        for name in names:
+            del self.es.indices_[name]
+        self.es.aliases = {alias: indices - set(names) for alias, indices in self.es.aliases.items()
+                           if indices - set(names)}
+
+    def put_settings(self, body, index):
+        for name in self.es.resolve(index):
+            self.es.indices_[name]['settings'].update(body['index'])
+
+    def refresh(self, index):
+        for name in self.es.resolve(index):
+            self.es.indices_[name]['searchable'] = dict(self.es.indices_[name]['docs'])
+
+    def update_aliases(self, body):
+        aliases = copy.deepcopy(dict(self.es.aliases))
+        indices = dict(self.es.indices_)
+        for action in body['actions']:
+            (type, params), = action.items()
+            if type == 'add':
+                aliases.setdefault(params['alias'], set()).add(params['index'])
+            elif type == 'remove':
+                aliases[params['alias']].discard(params['index'])
+            elif type == 'remove_index':
+                del indices[params['index']]
+        # Like Elasticsearch, only the result counts: an index may be replaced by an alias of the same name.
+        if set(aliases) & set(indices):
+            raise RequestError(400, 'invalid_alias_name_exception', {})
+        self.es.aliases = {alias: names for alias, names in aliases.items() if names}
+        self.es.indices_ = indices
+
+
+class FakeElasticsearch:
+    """
+    In-memory stand-in for an Elasticsearch client: indices, aliases and the bulk API.
+
+    Documents become visible to search_docs() only when their index is refreshed.
+    """
+    transport = FakeTransport()
+
+    def __init__(self):
+        self.indices_ = {}
+        self.aliases = {}
+        self.indices = FakeIndices(self)
+        self.bulk_requests = 0
+
+    def resolve(self, name, pattern=False):
+        """Concrete index names of *name* (an index or alias, or with *pattern* a wildcard)."""
+        if pattern:
+            names = set(fnmatch.filter(self.indices_, name))
+            for alias in fnmatch.filter(self.aliases, name):
+                names |= self.aliases[alias]
+            return sorted(names)
+        if name in self.aliases:
+            return sorted(self.aliases[name])
+        if name in self.indices_:
+            return [name]
+        raise NotFoundError(404, 'index_not_found_exception', {'index': name})
+
+    def bulk(self, body, index=None, params=None):
+        self.bulk_requests += 1
+        lines = iter(line for line in body.split('\n') if line)
+        items = []
+        for line in lines:
+            (op_type, meta), = json.loads(line).items()
+            source = json.loads(next(lines)) if op_type in ('index', 'create') else None
+            try:
+                name, = self.resolve(meta.get('_index', index))
+            except NotFoundError:
+                items.append({op_type: dict(_id=meta['_id'], status=404, error='index_not_found_exception')})
+                continue
+            docs = self.indices_[name]['docs']
+            doc_id = str(meta['_id'])
+            if op_type == 'delete':
+                status = 200 if docs.pop(doc_id, None) is not None else 404
+            else:
+                status = 200 if doc_id in docs else 201
+                docs[doc_id] = source
+            items.append({op_type: dict(_index=name, _id=doc_id, status=status)})
+        return dict(took=1, errors=any(item[op]['status'] >= 300 for item in items for op in item), items=items)
+
+    def search_docs(self, index):
+        """Documents searchable (i.e. refreshed) in *index*, by id."""
+        name, = self.resolve(index)
+        return self.indices_[name]['searchable']
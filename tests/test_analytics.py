@@ -1,7 +1,14 @@
+import datetime
+import multiprocessing
+import random
+
 import pytest
+from pyroaring import BitMap
 
 from potstats2 import db, analytics
 
+import analyze_post_reference
+
 
 def test_quotes_with_square_brackets(session, data):
     class QuotePost:
@@ -75,3 +82,205 @@ def test_analyze_post(session, data, text, expect_quotes, expect_urls):
     analytics.analyze_post(Post, {100, 101}, quotes, urls)
     assert quotes == expect_quotes
     assert urls == expect_urls
+
+
+def test_iter_posts(session, data):
+    thread = session.query(db.Thread).get(1)
+    post = db.Post(pid=105, thread=thread, poster_uid=1, edit_count=2)
+    post.content = db.PostContent(post=post, content='Bar', title='Baz')
+    session.add(post)
+    session.flush()
+
+    assert list(analytics.iter_posts(session, 0)) == [(100, 5000, 7, None, None, 'Foo', None),
+                                                    (105, 1, None, None, 2, 'Bar', 'Baz')]
+    assert list(analytics.iter_posts(session, 0, 105)) == [(100, 5000, 7, None, None, 'Foo', None)]
+    assert [post.pid for post in analytics.iter_posts(session, 101, itersize=1)] == [105]
+
+
+
+def test_unanalyzed_posts(session, data):
+    query = analytics.unanalyzed_posts(session.query(db.Post.pid))
+    assert query.all() == [(100,)]
+
+    session.add(db.AnalyzedPost(pid=100, edit_count=None))
+    session.flush()
+    assert query.all() == []
+
+    session.query(db.Post).get(100).edit_count = 1
+    session.flush()
+    assert query.all() == [(100,)]
+
+
+def test_aggregate():
+    quotes = [dict(pid=1, quoted_pid=2, count=1), dict(pid=1, quoted_pid=2, count=1), dict(pid=1, quoted_pid=3, count=1)]
+    assert analytics.aggregate_quotes(quotes) == [(1, 2, 2), (1, 3, 1)]
+    urls = [dict(pid=1, url='x.de', domain='x.de', count=1, type=db.LinkType.link)] * 3
+    urls.append(dict(pid=1, url='x.de', domain='x.de', count=1, type=db.LinkType.image))
+    assert analytics.aggregate_urls(urls) == [(1, 'x.de', 'link', 'x.de', 3), (1, 'x.de', 'image', 'x.de', 1)]
+
+
+def test_merge_analysis(session, data):
+    session.flush()
+    session.add(db.PostQuotes(pid=100, quoted_pid=100, count=5))
+    session.add(db.AnalyzedPost(pid=100, edit_count=None))
+    session.add(db.PostSearch(pid=100, content='alt'))
+    session.flush()
+
+    analytics.create_staging_tables(session)
+    assert analytics.staging_tables_exist(session)
+    analytics.copy_rows(session, 'post_links_staging', ('pid', 'url', 'type', 'domain', 'count'),
+                        [(100, 'a\tb"', 'link', None, 2), (100, '', 'image', '', 1)])
+    analytics.copy_rows(session, 'analyzed_posts_staging', ('pid', 'edit_count'), [(100, 1)])
+    analytics.copy_rows(session, 'post_search_staging', ('pid', 'content'), [(100, 'Neue Häuser')])
+    analytics.merge_analysis(session)
+
+    assert not analytics.staging_tables_exist(session)
+    assert session.query(db.PostQuotes).count() == 0
+    links = session.query(db.PostLinks.url, db.PostLinks.type, db.PostLinks.domain, db.PostLinks.count)
+    assert sorted(links.all()) == [('', db.LinkType.image, '', 1), ('a\tb"', db.LinkType.link, None, 2)]
+    assert session.query(db.AnalyzedPost.edit_count).all() == [(1,)]
+    assert session.query(db.PostSearch.content, db.PostSearch.document).all() == [('Neue Häuser', "'haus':2 'neu':1")]
+
+
+def test_merge_active_users():
+    day_stats = [(2018, 1, 1, 10), (2018, 1, 2, 20), (2018, 2, 1, 30)]
+    active_users = [(2018, 1, 1, 5), (2018, 1, 1, 7), (2018, 1, 3, 9), (2018, 2, 1, 5)]
+    assert list(analytics.merge_active_users(day_stats, active_users)) == [
+        (2018, 1, 1, 10, BitMap([5, 7])),
+        (2018, 1, 2, 20, BitMap()),
+        (2018, 2, 1, 30, BitMap([5])),
+    ]
+
+
+def test_bake_daily_stats(session, data):
+    post = session.query(db.Post).get(100)
+    post.timestamp = datetime.datetime(2018, 1, 1, 12)
+    post.thread.first_post = post
+    session.flush()
+    analytics.bake_daily_stats(session)
+    day = session.query(db.DailyStats).one()
+    assert (day.year, day.day_of_year, day.bid, day.post_count, day.threads_created) == (2018, 1, 7, 1, 1)
+    assert BitMap.deserialize(day.active_users) == BitMap([5000])
+
+
+def test_split_pid_ranges():
+    assert analytics.split_pid_ranges(BitMap([1, 2, 5, 7, 9]), 2) == [(1, 5), (5, 9), (9, None)]
+    assert analytics.split_pid_ranges(BitMap([1, 2]), 2) == [(1, None)]
+    assert analytics.split_pid_ranges(BitMap(), 2) == []
+
+
+def test_claim_pid_ranges():
+    pid_ranges = [(1, 5), (5, 9), (9, None)]
+    next_range = multiprocessing.Value('l', 0)
+    worker1 = analytics.claim_pid_ranges(pid_ranges, next_range)
+    worker2 = analytics.claim_pid_ranges(pid_ranges, next_range)
+    assert next(worker1) == (1, 5)
+    assert list(worker2) == [(5, 9), (9, None)]
+    assert list(worker1) == []
+
+
+BBCODE_FRAGMENTS = (
+    '[', ']', '"', ' ', '\n', 'foo ', 'bär', ',', '=', '"x"', 'quote', '/url', 'url=', 'img',
+    '[quote]', '[/quote]', '[quote=1,100,"a]b"]', '[quote=1,101,x]', '[quote=1,2', '[quotes]',
+    '[url]', '[/url]', '[url=google.de]', '[url="http://x.de/[1]"]', "[url='y.de']",
+    '[img]', '[/img]', '[video]', '[video play]', '[video autoplay]', '[/video]', '[b]', '[/b]',
+    'http://example.com/a?b=c', './img/icons/icon1.gif', '/bb/thread.php', 'data:image/png',
+)
+
+
+def random_bbcode(rng):
+    return ''.join(rng.choice(BBCODE_FRAGMENTS) for _ in range(rng.randrange(30)))
+
+
+def test_analyze_post_matches_reference():
+    rng = random.Random(1234)
+    for _ in range(20000):
+        post = analytics.PostRow(pid=101, poster_uid=1, bid=7, timestamp=None, edit_count=0,
+                                 content=random_bbcode(rng), title='Titel')
+        expected = [], [], []
+        analyze_post_reference.analyze_post(post, {100, 101}, *expected)
+        actual = [], [], []
+        analytics.analyze_post(post, {100, 101}, *actual)
+        assert actual == expected, post.content
+
+
+@pytest.mark.parametrize('text,expect_tokens', (
+    ('', []),
+    ('foo', [(False, 'foo')]),
+    ('a[b]c[/b]', [(False, 'a'), (True, 'b'), (False, 'c'), (True, '/b')]),
+    ('[url="[x]"]', [(True, 'url="[x]"')]),
+    ('[a[b]', [(True, 'b')]),
+    ('[b]]', [(True, 'b'), (True, 'b')]),
+    ('x[b', [(False, 'x')]),
+    ('[url="x]', []),
+))
+def test_tokenize_bbcode(text, expect_tokens):
+    assert list(analytics.tokenize_bbcode(text)) == expect_tokens
+
+
+def test_pid_bitmap_cache(session, data, tmpdir):
+    path = str(tmpdir.join('pids'))
+    assert analytics.load_pid_bitmap(session, BitMap(), path) == BitMap([100])
+    tmpdir.join('pids').write('not a bitmap')
+    assert analytics.load_pid_bitmap(session, BitMap(), path) == BitMap([100])
+
+    session.add(db.Post(pid=200, tid=1, bid=7))
+    session.flush()
+    assert analytics.load_pid_bitmap(session, BitMap(), path) == BitMap([100, 200])
+    with open(path, 'rb') as fd:
+        assert BitMap.deserialize(fd.read()) == BitMap([100, 200])
+
+    # Below the largest cached pid, found through the unanalyzed posts
+    session.add(db.Post(pid=50, tid=1, bid=7))
+    session.flush()
+    assert analytics.load_pid_bitmap(session, BitMap([50]), path) == BitMap([50, 100, 200])
+
+    # The cache of another database
+    session.query(db.Post).filter(db.Post.pid == 200).delete()
+    session.flush()
+    assert analytics.load_pid_bitmap(session, BitMap(), path) == BitMap([50, 100])
+
+
+PROFILE_HTML = '''
+<html><body><div id="content"><table>
+<tr class="bar"><td>Profil</td></tr>
+<tr><td class="attrn">Benutzername:</td><td class="attrv"><div></div> {name}</td></tr>
+<tr><td class="attrn">Dabei seit:</td><td class="attrv">01.02.2003 04:05 Uhr</td></tr>
+<tr><td class="attrn">Zuletzt im Board:</td><td class="attrv"><em>privat</em></td></tr>
+<tr><td class="attrn">Status:</td><td class="attrv">offline</td></tr>
+<tr><td class="attrn">Accountstatus:</td><td class="attrv">gesperrt bis 24.12.2030</td></tr>
+</table>
+<table><tr><td class="vam avatar"><span class="rang">{rank}</span>
+<img alt="*" src="http://forum.mods.de/bb/img/rank/{bar}.gif"></td></tr></table>
+</div></body></html>
+'''
+
+
+def test_parse_user_profiles(session, data):
+    cave = session.query(db.User).get(5000)
+    session.add(db.MyModsUserStaging(uid=5000, html=PROFILE_HTML.format(name='Höhle', rank='Ur', bar='stein')))
+    session.add(db.MyModsUserStaging(uid=2891831, html=PROFILE_HTML.format(name='schneemann', rank='Ur', bar='stein')))
+    session.flush()
+
+    analytics.parse_user_profiles(session, chunk_size=1)
+    assert cave.name == 'Höhle'
+    assert cave.registered == datetime.datetime(2003, 2, 1, 4, 5)
+    assert cave.last_seen is None
+    assert cave.online_status == 'offline'
+    assert cave.account_state == db.AccountState.locked_temp
+    assert cave.locked_until == datetime.datetime(2030, 12, 24)
+    assert cave.user_profile_exists
+    tier, = session.query(db.UserTier).all()
+    assert (tier.name, tier.bars, tier.type) == ('Ur', 'stein', db.TierType.special)
+    assert session.query(db.User).get(2891831).tier is tier
+
+    # Only changed profiles are parsed again
+    cave.name = 'renamed'
+    session.query(db.MyModsUserStaging).filter_by(uid=2891831).update(
+        dict(html=PROFILE_HTML.format(name='schneemann', rank='Neu', bar='herz1')))
+    session.flush()
+    analytics.parse_user_profiles(session)
+    assert cave.name == 'renamed'
+    assert session.query(db.User).get(2891831).tier.name == 'Neu'
+    analytics.parse_user_profiles(session, reparse=True)
+    assert cave.name == 'Höhle'
@@ -0,0 +1,117 @@
+import datetime
+
+from pyroaring import BitMap
+
+from potstats2 import analytics, dal, db
+from potstats2.backend import cube
+
+
+def test_date_dimension():
+    month, weekday = cube.date_dimension([2017, 2020])
+    assert month.shape == weekday.shape == (2, 366)
+    # 2017-01-01 was a Sunday, 2020 is a leap year.
+    assert weekday[0, :3].tolist() == [7, 1, 2]
+    assert month[0, [0, 30, 31, 364]].tolist() == [1, 1, 2, 12]
+    assert month[0, 365] == weekday[0, 365] == 0
+    assert month[1, 365] == 12
+    assert weekday[1, 365] == datetime.date(2020, 12, 31).isoweekday()
+
+
+def test_cube_matches_sql(session, many_posts):
+    analytics.bake_daily_stats(session)
+    daily_stats = cube.DailyStatsCube(session)
+
+    for year, bid in ((None, None), (2018, None), (None, 8), (2017, 7), (2019, None)):
+        expected = [(row.year, row.stats) for row in dal.yearly_stats(session, bid=bid)
+                    if not year or row.year == year]
+        assert list(daily_stats.yearly_stats(year, bid)) == expected
+
+        expected = [(int(row.weekday), row.stats) for row in dal.weekday_stats(session, year, bid)]
+        assert list(daily_stats.weekday_stats(year, bid)) == expected
+
+        expected = [(row.Board.bid, row.post_count, row.thread_count) for row in dal.boards(session, year)]
+        assert [(bid, stats['post_count'], stats['threads_created'])
+                for bid, stats in daily_stats.board_stats(year)] == expected
+
+    for year, bid in ((2017, None), (2018, 8), (2018, 9)):
+        expected = [(row.day_of_year, row.stats) for row in dal.daily_stats(session, year, bid)]
+        assert list(daily_stats.daily_stats(year, bid)) == expected
+
+
+def test_missing_rollups(session, many_posts):
+    analytics.bake_daily_stats(session)
+    daily_stats = cube.DailyStatsCube(session)
+    session.query(db.ActiveUserRollup).filter(db.ActiveUserRollup.year == 2018).delete()
+    without_rollups = cube.DailyStatsCube(session)
+    # Active users of years without rollups come from their days.
+    for year, bid in ((None, None), (2018, None), (None, 8)):
+        assert list(without_rollups.yearly_stats(year, bid)) == list(daily_stats.yearly_stats(year, bid))
+        assert list(without_rollups.weekday_stats(year, bid)) == list(daily_stats.weekday_stats(year, bid))
+    start, end = datetime.date(2017, 12, 1), datetime.date(2018, 12, 31)
+    assert list(without_rollups.yearly_stats(start=start, end=end)) == \
+        list(daily_stats.yearly_stats(start=start, end=end))
+
+
+def test_current_cube(session, many_posts):
+    analytics.bake_daily_stats(session)
+    daily_stats = cube.current_cube(session)
+    assert cube.current_cube(session) is daily_stats
+
+    # Loaded again once the data changed.
+    session.query(db.DailyStats).delete()
+    db.DataVersion.bump(session)
+    assert cube.current_cube(session) is not daily_stats
+    assert list(cube.current_cube(session).yearly_stats()) == []
+
+
+def range_stats(session, start, end, bid=None, weekday=None):
+    """Stats of the DailyStats rows from *start* to *end*, summed up naively."""
+    sums = dict.fromkeys(cube.SUM_COLUMNS, 0)
+    users = BitMap()
+    for row in session.query(db.DailyStats):
+        date = datetime.date(row.year, 1, 1) + datetime.timedelta(days=row.day_of_year - 1)
+        if start <= date <= end and bid in (None, row.bid) and weekday in (None, date.isoweekday()):
+            for name in cube.SUM_COLUMNS:
+                sums[name] += getattr(row, name)
+            users |= BitMap.deserialize(row.active_users)
+    stats = cube.calculate_stats(sums)
+    stats['active_users'] = len(users)
+    return stats
+
+
+def test_date_ranges(session, many_posts):
+    # Posts are from 2017-12-30 to 2018-01-03, add some in other months and years.
+    for pid, timestamp, uid in ((400, datetime.datetime(2016, 2, 29), 1), (401, datetime.datetime(2018, 2, 1), 1),
+                                (402, datetime.datetime(2018, 3, 5), 2891831)):
+        session.add(db.Post(pid=pid, tid=2, bid=7, poster_uid=uid, timestamp=timestamp,
+                            edit_count=1, content_length=10))
+    session.flush()
+    analytics.bake_daily_stats(session)
+    daily_stats = cube.DailyStatsCube(session)
+    date = datetime.date
+
+    for start, end in ((date(2017, 12, 31), date(2018, 1, 2)), (date(2018, 1, 1), date(2018, 3, 31)),
+                       (date(2016, 1, 1), date(2018, 2, 1)), (date(2018, 1, 2), date(2018, 3, 5))):
+        for bid in (None, 7, 8):
+            expected = []
+            for year in range(start.year, end.year + 1):
+                stats = range_stats(session, max(start, date(year, 1, 1)), min(end, date(year, 12, 31)), bid)
+                if stats['post_count']:
+                    expected.append((year, stats))
+            assert list(daily_stats.yearly_stats(bid=bid, start=start, end=end)) == expected
+
+            expected = [(weekday, range_stats(session, start, end, bid, weekday)) for weekday in range(1, 8)]
+            assert list(daily_stats.weekday_stats(bid=bid, start=start, end=end)) == [
+                (weekday, stats) for weekday, stats in expected if stats['post_count']]
+
+        expected = {bid: range_stats(session, start, end, bid) for bid in (7, 8)}
+        assert dict(daily_stats.board_stats(start=start, end=end)) == {
+            bid: {name: stats[name] for name in cube.STATISTICS if name != 'active_users'}
+            for bid, stats in expected.items() if stats['post_count']}
+
+    # Whole years use the rollups.
+    assert list(daily_stats.weekday_stats(start=date(2016, 1, 1), end=date(2018, 12, 31))) == \
+        list(daily_stats.weekday_stats())
+    assert [day for day, stats in daily_stats.daily_stats(2018, start=date(2018, 1, 2), end=date(2018, 2, 1))] == \
+        [2, 3, 32]
+    assert list(daily_stats.yearly_stats(2017, start=date(2018, 1, 1))) == []
@@ -1,6 +1,110 @@
+from datetime import datetime
 
 from potstats2 import db, dal
 
 
 def test_simple(session, data):
     assert session.query(db.User).count() == 3
+
+
+def test_board_filter(session, data):
+    query = session.query(db.Post.pid)
+    assert dal.apply_board_filter(query, 7).all() == [(100,)]
+    assert not dal.apply_board_filter(query, 8).all()
+    assert dal.apply_board_filter(query).count() == 1
+
+
+def test_poster_stats_agg(session, data):
+    session.query(db.Post).get(100).timestamp = datetime(2018, 7, 14)
+    session.query(db.Thread).get(1).first_pid = 100
+    session.flush()
+
+    row, = dal.poster_stats_agg(session, post_count_cutoff=1).all()
+    assert row.bid == 7
+    assert row.year == 2018
+    assert row.uid == 5000
+    assert row.post_count == 1
+    assert row.threads_created == 1
+
+
+def test_post_time_columns(session, data):
+    post = session.query(db.Post).get(100)
+    post.timestamp = datetime(2018, 7, 14, 23, 59)
+    session.flush()
+    session.refresh(post)
+    assert (post.year, post.day_of_year) == (2018, 195)
+
+
+def test_search_posts(session, data):
+    from potstats2.backend import parse_textual_tsquery
+
+    contents = {
+        100: 'Foo',
+        101: 'Die neuen Häuser sind schön. <b>Alte</b> Häuser & Hütten auch.',
+        102: 'Ein Haus am See',
+        103: 'Neue Autos, keine Häuser',
+    }
+    for pid in (101, 102, 103):
+        session.add(db.Post(pid=pid, tid=1, bid=7, poster_uid=5000, timestamp=datetime(2002 + pid % 2, 1, 1)))
+    session.flush()
+    for pid, content in contents.items():
+        session.add(db.PostSearch(pid=pid, content=content))
+    session.flush()
+
+    def search(query, sort='score'):
+        count, rows = dal.search_posts(session, parse_textual_tsquery(query), sort)
+        assert count == len(rows)
+        return [row.pid for row in rows]
+
+    assert sorted(search('Haus')) == [101, 102, 103]
+    assert search('Haus', 'date-desc') == [103, 102, 101]
+    assert search('See Autos', 'date-asc') == [102, 103]
+    assert search('"neue Häuser"') == [101]
+    assert search('Haus +See') == [102]
+    assert search('Haus -neu') == [102]
+    assert search('-Haus') == [100]
+    assert search('') == search('der') == []
+
+    def pages(query, sort):
+        tsquery = parse_textual_tsquery(query)
+        pids = []
+        after = None
+        while True:
+            count, rows = dal.search_posts(session, tsquery, sort, after, limit=1)
+            if not rows:
+                return pids
+            pids.append(rows[0].pid)
+            after = dal.search_sort_values(sort, rows[0].score, rows[0].pid)
+
+    for sort in ('score', 'date-asc', 'date-desc'):
+        assert pages('Haus', sort) == search('Haus', sort)
+    assert pages('Haus', 'date-asc') == [101, 102, 103]
+
+    assert dal.search_post_facets(session, parse_textual_tsquery('Haus')) == dict(
+        years=[(2002, 1), (2003, 2)], boards=[(7, 3)], posters=[(5000, 3)])
+
+    count, (row,) = dal.search_posts(session, parse_textual_tsquery('"alte Häuser"'))
+    assert row.poster_uid == 5000
+    # ts_headline drops the tag
+    assert row.snippet == ('neuen <strong>Häuser</strong> sind schön.  <strong>Alte</strong>  '
+                           '<strong>Häuser</strong> &amp; Hütten auch')
+
+
+def test_search_threads(session, data):
+    from potstats2.backend import parse_textual_tsquery
+
+    session.add(db.Thread(tid=2, bid=7, title='Sammelthread', subtitle='Fragen zu Häusern'))
+    session.flush()
+    count, rows = dal.search_threads(session, parse_textual_tsquery('Haus'))
+    assert count == 1
+    assert [(row.tid, row.title) for row in rows] == [(2, 'Sammelthread')]
+    count, rows = dal.search_threads(session, parse_textual_tsquery('thread1'))
+    assert [row.tid for row in rows] == [1]
+
+
+def test_post_hits(session, data):
+    session.add(db.Post(pid=101, tid=1, bid=7, poster_uid=5000, timestamp=datetime(2003, 4, 5)))
+    session.flush()
+    assert dal.post_hits(session, [101, 102]) == {101: (1, 5000, datetime(2003, 4, 5))}
+    assert dal.user_names(session, {5000}) == {5000: ('[Höhlenmensch]', [])}
+    assert dal.thread_titles(session, {1}) == {1: ('Thread1', None)}
@@ -0,0 +1,75 @@
+import datetime
+
+import numpy as np
+import pytest
+from pyroaring import BitMap
+
+from potstats2 import db, dal, facts
+
+
+def table_rows(session, table):
+    columns = [getattr(table, column.name) for column in table.__table__.columns]
+    return sorted(tuple(bytes(value) if isinstance(value, memoryview) else value for value in row)
+                  for row in session.query(*columns))
+
+
+def test_extract(session, data, tmpdir):
+    post_facts = facts.extract(session, str(tmpdir.join('facts')))
+    assert len(post_facts) == 1
+    assert post_facts.posts['pid'].tolist() == [100]
+    assert post_facts.posts['poster_uid'].tolist() == [5000]
+    assert post_facts.has_timestamp.tolist() == [False]
+    assert len(post_facts.quotes['pid']) == 0
+
+    # Extracting again replaces the previous extract
+    session.query(db.Post).get(100).timestamp = datetime.datetime(2018, 3, 1, 23, 59, 59, 900000)
+    post_facts = facts.extract(session, str(tmpdir.join('facts')))
+    assert (post_facts.year.tolist(), post_facts.day_of_year.tolist()) == ([2018], [60])
+
+
+def test_group_rows():
+    order, starts, (a, b) = facts.group_rows(np.array([2, 1, 2, 1]), np.array([5, 6, 5, 5]))
+    assert (a.tolist(), b.tolist()) == ([1, 1, 2], [5, 6, 5])
+    assert facts.group_sizes(starts, 4).tolist() == [1, 1, 2]
+    assert facts.group_sum(np.array([1, 2, 3, 4])[order], starts).tolist() == [4, 2, 4]
+    assert facts.group_cumsum(np.array([1, 2, 3, 4])[order], starts).tolist() == [4, 2, 1, 4]
+
+
+def test_bakes_match_sql(session, many_posts, tmpdir):
+    post_facts = facts.extract(session, str(tmpdir.join('facts')))
+
+    db.PosterStats.refresh(session, dal.poster_stats_agg(session, post_count_cutoff=1))
+    expected = table_rows(session, db.PosterStats)
+    facts.bake_poster_stats(session, post_facts, post_count_cutoff=1)
+    assert table_rows(session, db.PosterStats) == expected
+
+    db.QuoteRelation.refresh(session, dal.social_graph_agg(session, count_cutoff=0))
+    expected = table_rows(session, db.QuoteRelation)
+    assert expected
+    facts.bake_quote_relation(session, post_facts, count_cutoff=0)
+    assert table_rows(session, db.QuoteRelation) == expected
+
+    from potstats2 import analytics
+    analytics.bake_daily_stats(session)
+    expected = table_rows(session, db.DailyStats)
+    expected_rollups = table_rows(session, db.ActiveUserRollup)
+    facts.bake_daily_stats(session, post_facts)
+    assert table_rows(session, db.DailyStats) == expected
+    assert table_rows(session, db.ActiveUserRollup) == expected_rollups
+
+
+def test_active_user_rollups():
+    rollups = facts.ActiveUserRollups()
+    # 2018-01-01 was a Monday, 2018-02-05 (day 36) as well.
+    rollups.add(2018, 1, 7, BitMap([1, 2]))
+    rollups.add(2018, 2, 8, BitMap([3]))
+    rollups.add(2018, 36, 7, BitMap([2, 4]))
+    rows = {row[:4]: (row[4], set(BitMap.deserialize(row[5]))) for row in rollups.rows()}
+    assert rows[2018, 0, 0, 0] == (4, {1, 2, 3, 4})
+    assert rows[2018, 0, 0, 7] == (3, {1, 2, 4})
+    assert rows[2018, 1, 0, 0] == (3, {1, 2, 3})
+    assert rows[2018, 2, 0, 7] == (2, {2, 4})
+    assert rows[2018, 0, 1, 0] == (3, {1, 2, 4})
+    assert rows[2018, 0, 2, 8] == (1, {3})
+    # Months of boards 0, 7 and 8, weekdays of boards 0, 7 and 8 and the three years.
+    assert len(rows) == 12
@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from potstats2 import inverted_index
+from potstats2.backend import parse_textual_index_query
+
+
+def test_varints():
+    values = np.array([0, 1, 127, 128, 300, 2 ** 31 - 1, 2 ** 40])
+    data, nbytes = inverted_index.encode_varints(values)
+    assert nbytes.tolist() == [1, 1, 1, 2, 2, 5, 6]
+    assert len(data) == nbytes.sum()
+    assert inverted_index.decode_varints(data).tolist() == values.tolist()
+    assert not len(inverted_index.decode_varints(b''))
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path)
+    inverted_index.write_segment(path, '1-100', [
+        (100, 1, 7, datetime(2003, 5, 1), 'Die neuen Häuser sind schön. Alte Häuser & Hütten auch.'),
+        (101, 2, 7, datetime(2003, 5, 2), 'Ein Haus am See'),
+        (102, 1, 8, datetime(2004, 1, 1), 'Neue Autos, keine Häuser'),
+        (103, 2, 8, None, 'Das Boot am See'),
+    ])
+    # A later analysis: 101 was edited, 102 has nothing searchable left.
+    inverted_index.write_segment(path, '2-101', [
+        (101, 2, 7, datetime(2003, 5, 2), 'Ein Haus am Meer'),
+        (102, 1, 8, datetime(2004, 1, 1), None),
+        (104, 5000, 8, datetime(2004, 1, 2), 'Häuser, Häuser, Häuser'),
+    ])
+    inverted_index.register_segments(path)
+    return path
+
+
+def search(index, query, sort='score', after=None, limit=30):
+    result = index.search(parse_textual_index_query(query), sort, after, limit)
+    return [hit.pid for hit in result.hits]
+
+
+def test_search(index_path):
+    index = inverted_index.InvertedIndex(index_path)
+    assert index.num_docs == 4
+    assert search(index, 'häuser') == [104, 100]
+    assert search(index, 'see') == [103]
+    assert search(index, 'haus see') == [101, 103]
+    assert search(index, 'am +see') == [103]
+    assert search(index, 'am -see') == [101]
+    assert search(index, '-häuser') == [101, 103]
+    assert search(index, '"alte häuser"') == [100]
+    assert search(index, '"häuser alte"') == []
+    assert search(index, '') == search(index, '!') == []
+    assert search(index, 'am', 'date-desc') == [103, 101]
+
+    count, (hit,), facets = index.search(parse_textual_index_query('"ALTE häuser"'))
+    assert count == 1
+    assert (hit.pid, hit.poster_uid) == (100, 1)
+    assert hit.snippet == ('Die neuen <strong>Häuser</strong> sind schön. <strong>Alte</strong> '
+                           '<strong>Häuser</strong> &amp; Hütten auch')
+
+
+def test_search_facets(index_path):
+    index = inverted_index.InvertedIndex(index_path)
+    result = index.search(parse_textual_index_query('häuser am'), limit=1, facets=True)
+    assert result.count == 4
+    assert result.facets == {
+        'years': [(2003, 2), (2004, 1)],
+        'boards': [(7, 2), (8, 2)],
+        'posters': [(2, 2), (1, 1), (5000, 1)],
+    }
+    assert index.search(parse_textual_index_query('häuser')).facets is None
+    assert index.search(parse_textual_index_query('xyz'), facets=True).facets == dict(years=[], boards=[], posters=[])
+
+
+def test_search_pages(index_path):
+    index = inverted_index.InvertedIndex(index_path)
+    for sort in ('score', 'date-asc', 'date-desc'):
+        pids = []
+        after = None
+        while True:
+            count, hits, facets = index.search(parse_textual_index_query('häuser am'), sort, after, limit=1)
+            assert count == 4
+            if not hits:
+                break
+            pids.append(hits[0].pid)
+            after = [hits[0].score, hits[0].pid] if sort == 'score' else [hits[0].pid]
+        assert pids == search(index, 'häuser am', sort)
+
+
+def test_merge_segments(index_path):
+    index = inverted_index.InvertedIndex(index_path)
+    results = {query: index.search(parse_textual_index_query(query), facets=True)
+               for query in ('häuser', 'am -see', '"haus am"')}
+
+    inverted_index.merge_segments(index_path, max_segments=1)
+    merged = inverted_index.InvertedIndex(index_path)
+    assert len(merged.segments) == 1
+    # Shadowed and deleted documents are gone.
+    assert merged.segments[0].pids.tolist() == [100, 101, 103, 104]
+    for query, (count, hits, facets) in results.items():
+        merged_count, merged_hits, merged_facets = merged.search(parse_textual_index_query(query), facets=True)
+        assert merged_count == count
+        assert [(hit.pid, hit.snippet) for hit in merged_hits] == [(hit.pid, hit.snippet) for hit in hits]
+        assert merged_facets == facets
+
+
+def test_register_segments(index_path):
+    # Segments of a rebuild replace all others.
+    inverted_index.write_segment(index_path, '3-100', [(101, 2, 7, None, 'Ein Haus am See')])
+    inverted_index.register_segments(index_path, run_id='3')
+    index = inverted_index.current_index(index_path)
+    assert [segment.name for segment in index.segments] == ['3-100']
+    assert search(index, 'see') == [101]
+    # Opened again only once the manifest changes.
+    assert inverted_index.current_index(index_path) is index
@@ -0,0 +1,33 @@
+from potstats2 import maintenance
+
+
+def last_analyzed(engine):
+    with engine.connect() as conn:
+        return dict(conn.execute('SELECT relname, last_analyze FROM pg_stat_user_tables').fetchall())
+
+
+def test_no_missing_indexes(db_engine, schema):
+    assert not maintenance.missing_indexes(db_engine)
+
+
+def test_maintain(db_engine, schema):
+    with maintenance.autocommit(db_engine) as conn:
+        conn.execute("INSERT INTO categories (cid, name) VALUES (1, 'Kategorie')")
+    before = last_analyzed(db_engine)
+    maintenance.maintain(db_engine, ['categories', 'baked_daily_stats'], create_indexes=True)
+    after = last_analyzed(db_engine)
+    with maintenance.autocommit(db_engine) as conn:
+        conn.execute('DELETE FROM categories')
+
+    for table in ('categories', 'baked_daily_stats'):
+        assert after[table] and after[table] != before[table]
+    assert after['users'] == before['users']
+    assert 'categories' in [row.table for row in maintenance.table_bloat(db_engine)]
+
+
+def test_create_indexes(db_engine, schema):
+    with maintenance.autocommit(db_engine) as conn:
+        conn.execute('DROP INDEX ix_posts_poster_uid')
+    assert [index.name for index in maintenance.missing_indexes(db_engine)] == ['ix_posts_poster_uid']
+    maintenance.maintain(db_engine, [], create_indexes=True, report=False)
+    assert not maintenance.missing_indexes(db_engine)
@@ -0,0 +1,55 @@
+import json
+import os.path
+
+import pytest
+
+from potstats2 import db, profiling
+from potstats2.stages import Stage, run_stages
+
+
+def bake_days(session):
+    session.add(db.DailyStats(year=2018, day_of_year=1, bid=7, post_count=1, cumulative_post_count=1,
+                              cumulative_edit_count=0, cumulative_posts_length=0, cumulative_threads_created=0))
+
+
+@pytest.yield_fixture
+def profile_dir(tmpdir):
+    profiling.enable(str(tmpdir))
+    yield tmpdir
+    profiling.disable()
+
+
+def test_profile(session, data, profile_dir):
+    with profiling.section('main'):
+        session.query(db.Post).all()
+        session.query(db.Post).all()
+        blobs = [bytes(1000) for _ in range(1000)]
+    run_stages(session, [Stage('bake_days', bake_days, inputs=['boards'], outputs=['baked_daily_stats'])])
+
+    with open(profiling.write_report(argv=['test'])) as fd:
+        report = json.load(fd)
+    assert report['argv'] == ['test']
+    main, stage = report['sections']
+    assert (main['name'], stage['name']) == ('main', 'stage bake_days')
+    assert main['pid'] == os.getpid() != stage['pid']
+
+    assert main['tracemalloc_peak'] >= len(blobs) * 1000
+    assert main['top_allocations']
+    assert any('sqlalchemy/orm/query.py' in function['function'] for function in main['top_functions'])
+    assert os.path.exists(str(profile_dir.join(main['pstats'])))
+    query, = [sql for sql in main['sql'] if sql['statement'].startswith('SELECT posts.pid')]
+    assert query['count'] == 2
+    assert any(sql['statement'].startswith('INSERT INTO baked_daily_stats') for sql in stage['sql'])
+
+
+def test_no_nesting(profile_dir):
+    with profiling.section('outer'):
+        with pytest.raises(RuntimeError):
+            with profiling.section('inner'):
+                pass
+
+
+def test_disabled(tmpdir):
+    with profiling.section('nothing'):
+        pass
+    assert not tmpdir.listdir()
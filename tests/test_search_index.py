@@ -0,0 +1,125 @@
+import copy
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+
+import elasticsearch.helpers
+
+from potstats2 import analytics, config, db, search_index
+
+from fake_elasticsearch import FakeElasticsearch
+
+
+@pytest.fixture
+def es(monkeypatch):
+    es = FakeElasticsearch()
+    monkeypatch.setattr(config, 'elasticsearch_client', lambda: es)
+    return es
+
+
+def thread_actions(tids):
+    return (dict(_id=tid, _source=dict(tid=tid, title='Thread %d' % tid)) for tid in tids)
+
+
+def test_rebuild_index(es):
+    # An index from before aliases were used
+    es.indices.create('thread', body=search_index.INDICES['thread'])
+    assert search_index.index_exists(es, 'thread')
+
+    assert search_index.rebuild_index(es, 'thread', thread_actions(range(10)), chunk_size=3) == 10
+    first, = es.resolve('thread')
+    assert first.startswith('thread-') and 'thread' not in es.indices_
+    assert len(es.search_docs('thread')) == 10
+    assert es.indices_[first]['settings']['refresh_interval'] == '300s'
+    assert es.bulk_requests == 4
+
+    # A leftover of a failed rebuild
+    leftover = search_index.create_index(es, 'thread')
+    assert search_index.rebuild_index(es, 'thread', thread_actions(range(5)), threads=2, chunk_size=2) == 5
+    second, = es.resolve('thread')
+    assert second not in (first, leftover)
+    assert list(es.indices_) == [second]
+    assert len(es.search_docs('thread')) == 5
+
+
+def test_mapping_outdated(es):
+    search_index.ensure_index(es, 'thread')
+    assert not search_index.mapping_outdated(es, 'thread')
+    # A post index from before bid and timestamp were indexed
+    body = copy.deepcopy(search_index.INDICES['post'])
+    del body['mappings']['properties']['timestamp']
+    es.indices.create('post', body=body)
+    assert search_index.mapping_outdated(es, 'post')
+
+
+def test_rebuild_index_failure(es):
+    search_index.ensure_index(es, 'thread')
+    index, = es.resolve('thread')
+
+    def failing_actions():
+        yield from thread_actions(range(3))
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        search_index.rebuild_index(es, 'thread', failing_actions())
+    assert list(es.indices_) == [index]
+    assert es.resolve('thread') == [index]
+
+
+def test_bulk_index(es):
+    search_index.ensure_index(es, 'post')
+    search_index.ensure_index(es, 'post')
+    assert len(es.indices_) == 1
+
+    actions = list(thread_actions(range(3))) + [dict(_op_type='delete', _id=1), dict(_op_type='delete', _id=100)]
+    assert search_index.bulk_index(es, 'post', actions) == 5
+    index, = es.resolve('post')
+    assert sorted(es.indices_[index]['docs']) == ['0', '2']
+    # Not refreshed yet
+    assert not es.search_docs('post')
+
+    with pytest.raises(elasticsearch.helpers.BulkIndexError):
+        search_index.bulk_index(es, 'missing', thread_actions(range(3)))
+
+
+def test_index_threads(session, data, es):
+    analytics.index_threads(session)
+    assert es.search_docs('thread') == {'1': dict(tid=1, title='Thread1', subtitle=None)}
+    first, = es.resolve('thread')
+
+    # Incremental: only new and changed threads are sent, to the same index
+    session.query(db.Thread).get(1).subtitle = 'Untertitel'
+    session.add(db.Thread(tid=2, bid=7, title='Thread2'))
+    session.add(db.Thread(tid=3, bid=7, title='Thread3'))
+    session.flush()
+    analytics.index_threads(session)
+    assert es.resolve('thread') == [first]
+    assert set(es.search_docs('thread')) == {'1', '2', '3'}
+    assert es.search_docs('thread')['1']['subtitle'] == 'Untertitel'
+
+    requests = es.bulk_requests
+    analytics.index_threads(session)
+    assert es.bulk_requests == requests
+
+    session.query(db.Thread).filter_by(tid=3).delete()
+    analytics.index_threads(session)
+    assert set(es.search_docs('thread')) == {'1', '2'}
+    assert {thread.tid for thread in session.query(db.IndexedThread)} == {1, 2}
+
+    # A deleted index is rebuilt with all threads
+    es.indices.delete('thread')
+    analytics.index_threads(session)
+    assert set(es.search_docs('thread')) == {'1', '2'}
+
+
+def test_queued_search_actions():
+    queue = analytics.Queue()
+    queue.put([dict(pid=1, content='a'), dict(_op_type='delete', _id=2)])
+    queue.put([dict(pid=3, content='b')])
+    queue.put(analytics.ESP_POISON)
+    assert list(analytics.queued_search_actions(queue)) == [
+        dict(_id=1, _source=dict(pid=1, content='a')),
+        dict(_op_type='delete', _id=2),
+        dict(_id=3, _source=dict(pid=3, content='b')),
+    ]
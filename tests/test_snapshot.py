@@ -0,0 +1,78 @@
+import json
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from potstats2 import db, snapshot
+
+
+def truncate_all(engine):
+    with engine.begin() as conn:
+        conn.execute('TRUNCATE %s RESTART IDENTITY CASCADE' % ', '.join(db.Base.metadata.tables))
+
+
+def table_rows(engine, table):
+    with engine.connect() as conn:
+        return sorted(tuple(bytes(value) if isinstance(value, memoryview) else value for value in row)
+                      for row in conn.execute('SELECT * FROM %s' % table))
+
+
+@pytest.yield_fixture
+def committed_data(db_engine, schema):
+    # The snapshot is exported and imported through separate connections.
+    session = sessionmaker(bind=db_engine)()
+    session.add(db.UserTier(name='Tier', bars='1', type=db.TierType.standard))
+    session.add(db.User(uid=1, gid=2, name='foobar'))
+    session.add(db.User(uid=5000, gid=6, name='[Höhlenmensch]'))
+    session.add(db.Category(cid=5, name='Fake Kategorie'))
+    board = db.Board(bid=7, cid=5, name='Fake Forum für 1 fake Kategorie')
+    thread = db.Thread(tid=1, board=board, title='Thread1')
+    session.add(thread)
+    session.flush()
+    for pid in range(100, 105):
+        post = db.Post(pid=pid, thread=thread, board=board, poster_uid=1 + 4999 * (pid % 2))
+        post.content = db.PostContent(post=post, content='Post %d' % pid)
+        session.add(post)
+    session.flush()
+    thread.first_pid, thread.last_pid = 100, 104
+    session.add(db.PostQuotes(pid=103, quoted_pid=100, count=2))
+    session.add(db.AnalyzedPost(pid=103, edit_count=0))
+    session.add(db.DailyStats(year=2018, day_of_year=1, bid=7, post_count=5, cumulative_post_count=5,
+                              cumulative_edit_count=0, cumulative_posts_length=0, cumulative_threads_created=0))
+    session.commit()
+    session.close()
+    yield
+    truncate_all(db_engine)
+
+
+def test_roundtrip(db_engine, committed_data, tmpdir):
+    tables = snapshot.DIMENSION_TABLES + snapshot.BAKED_TABLES + snapshot.POST_TABLES
+    expected = {table: table_rows(db_engine, table) for table in tables}
+    snapshot.export_snapshot(db_engine, str(tmpdir), posts=True, contents=True, chunk_size=2)
+    manifest = snapshot.read_manifest(str(tmpdir))
+    assert [entry['table'] for entry in manifest['tables']] == list(snapshot.DIMENSION_TABLES + snapshot.BAKED_TABLES)
+    assert [(chunk['lower_pid'], chunk['upper_pid']) for chunk in manifest['post_chunks']] == [
+        (100, 102), (102, 104), (104, None)]
+
+    truncate_all(db_engine)
+    snapshot.import_snapshot(db_engine, str(tmpdir), jobs=2)
+    for table in tables:
+        assert table_rows(db_engine, table) == expected[table], table
+
+    # The tier sequence continues after the imported tiers.
+    session = sessionmaker(bind=db_engine)()
+    session.add(db.UserTier(name='Tier', bars='2', type=db.TierType.standard))
+    session.commit()
+    session.close()
+
+
+def test_chunk_size_one(db_engine, committed_data, tmpdir):
+    snapshot.export_snapshot(db_engine, str(tmpdir), posts=True, chunk_size=1)
+    manifest = snapshot.read_manifest(str(tmpdir))
+    assert [chunk['lower_pid'] for chunk in manifest['post_chunks']] == [100, 101, 102, 103, 104]
+
+
+def test_unsupported_version(tmpdir):
+    tmpdir.join(snapshot.MANIFEST).write(json.dumps(dict(format=snapshot.FORMAT, version=snapshot.FORMAT_VERSION + 1)))
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read_manifest(str(tmpdir))
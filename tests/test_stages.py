@@ -0,0 +1,148 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from potstats2 import db
+from potstats2.stages import FINGERPRINTS, Stage, StageError, check_stages, run_stages, plan_stages
+
+
+def noop(session):
+    pass
+
+
+def test_check_stages():
+    check_stages([Stage('a', noop, outputs=['x']), Stage('b', noop, inputs=['x'])])
+    with pytest.raises(StageError, match='written by both'):
+        check_stages([Stage('a', noop, outputs=['x']), Stage('b', noop, outputs=['x'])])
+    with pytest.raises(StageError, match='cycle'):
+        check_stages([Stage('a', noop, inputs=['y'], outputs=['x']), Stage('b', noop, inputs=['x'], outputs=['y'])])
+    with pytest.raises(StageError, match='main session'):
+        check_stages([Stage('a', noop, outputs=['x'], isolated=False), Stage('b', noop, inputs=['x'])])
+
+
+def day_stats(year, day_of_year, post_count, cumulative_post_count=None):
+    """A DailyStats row of board 7 with only posts."""
+    return db.DailyStats(year=year, day_of_year=day_of_year, bid=7, post_count=post_count,
+                         cumulative_post_count=cumulative_post_count or post_count, cumulative_edit_count=0,
+                         cumulative_posts_length=0, cumulative_threads_created=0)
+
+
+def bake_days(session):
+    session.add(day_stats(2018, 1, 1))
+    session.add(day_stats(2018, 2, 2, cumulative_post_count=3))
+
+
+def bake_from_days(session):
+    # Sees the (staged) output of bake_days
+    count = session.query(db.DailyStats).count()
+    session.add(db.QuoteRelation(year=2018, bid=7, quoter_uid=1, quoted_uid=5000, count=count))
+
+
+def rename_user(session):
+    session.query(db.User).get(1).name = 'renamed'
+
+
+def fail(session):
+    raise ValueError
+
+
+def test_run_stages(session, data):
+    session.add(day_stats(2017, 1, 1))
+    session.flush()
+    run_stages(session, [
+        Stage('bake_from_days', bake_from_days, inputs=['baked_daily_stats'], outputs=['baked_quote_stats']),
+        Stage('bake_days', bake_days, outputs=['baked_daily_stats']),
+        Stage('rename_user', rename_user, outputs=['users'], isolated=False),
+    ], jobs=2)
+
+    assert session.query(db.DailyStats.day_of_year).order_by(db.DailyStats.day_of_year).all() == [(1,), (2,)]
+    assert session.query(db.QuoteRelation.count).all() == [(2,)]
+    assert session.query(db.User).get(1).name == 'renamed'
+    assert session.query(db.AnalyticsStageState).count() == 3
+
+
+@pytest.yield_fixture
+def committed_session(db_engine, schema):
+    # Isolated stages only see committed data.
+    session = sessionmaker(bind=db_engine)()
+    yield session
+    session.rollback()
+    session.execute('TRUNCATE analytics_stage_state, baked_daily_stats, baked_quote_stats, categories, users CASCADE')
+    session.commit()
+    session.close()
+
+
+def test_skip_unchanged_stages(committed_session, capsys):
+    session = committed_session
+    session.add(db.Category(cid=5, name='Fake Kategorie'))
+    session.add(db.Board(bid=7, cid=5, name='Fake Forum'))
+    session.add(db.User(uid=1, gid=2, name='foobar'))
+    session.add(db.User(uid=5000, gid=6, name='[Höhlenmensch]'))
+    stages = [
+        Stage('bake_days', bake_days, inputs=['boards'], outputs=['baked_daily_stats']),
+        Stage('bake_from_days', bake_from_days, inputs=['baked_daily_stats'], outputs=['baked_quote_stats']),
+    ]
+    run_stages(session, stages)
+    session.commit()
+    capsys.readouterr()
+
+    # Inputs produced by a stage are recorded as they were merged, so nothing changed since.
+    plan_stages(session, stages)
+    assert capsys.readouterr().out.split() == [
+        'bake_days', 'skipped:', 'inputs', 'unchanged',
+        'bake_from_days', 'skipped:', 'inputs', 'unchanged',
+    ]
+
+    session.query(db.DailyStats).delete()
+    session.add(day_stats(2017, 1, 1))
+    session.commit()
+    plan_stages(session, stages)
+    assert capsys.readouterr().out.split() == [
+        'bake_days', 'skipped:', 'inputs', 'unchanged',
+        'bake_from_days', 'runs:', 'baked_daily_stats', 'changed',
+    ]
+    plan_stages(session, stages, force=['bake_days'])
+    assert 'bake_from_days runs: baked_daily_stats is produced by bake_days' in ' '.join(capsys.readouterr().out.split())
+
+    # bake_days is skipped, so its output is not replaced, and bake_from_days sees the real table.
+    run_stages(session, stages)
+    session.commit()
+    assert session.query(db.DailyStats.year).all() == [(2017,)]
+    assert session.query(db.QuoteRelation.count).all() == [(1,)]
+
+    session.add(db.Board(bid=8, cid=5, name='Noch ein Forum'))
+    session.commit()
+    plan_stages(session, stages)
+    assert 'bake_days runs: boards changed' in ' '.join(capsys.readouterr().out.split())
+
+    # Running twice in one transaction works, too.
+    run_stages(session, stages)
+    run_stages(session, stages, force=['bake_days'])
+    session.commit()
+    assert session.query(db.DailyStats.year).distinct().all() == [(2018,)]
+
+
+def test_missing_output(session, tmpdir, monkeypatch, capsys):
+    extract = tmpdir.join('extract')
+    monkeypatch.setitem(FINGERPRINTS, 'extract', lambda session: extract.read() if extract.check() else None)
+    stages = [Stage('extract', lambda session: extract.write('facts'), outputs=['extract'])]
+    run_stages(session, stages)
+    capsys.readouterr()
+    plan_stages(session, stages)
+    assert capsys.readouterr().out.split() == ['extract', 'skipped:', 'inputs', 'unchanged']
+
+    extract.remove()
+    plan_stages(session, stages)
+    assert capsys.readouterr().out.split() == ['extract', 'runs:', 'extract', 'is', 'missing']
+    run_stages(session, stages)
+    assert extract.read() == 'facts'
+
+
+def test_run_stages_failure(session, data):
+    session.add(day_stats(2017, 1, 1))
+    session.flush()
+    with pytest.raises(StageError, match='fail'):
+        run_stages(session, [
+            Stage('fail', fail, outputs=['x']),
+            Stage('bake_days', bake_days, inputs=['x'], outputs=['baked_daily_stats']),
+        ])
+    assert session.query(db.DailyStats.year).all() == [(2017,)]
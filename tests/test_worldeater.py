@@ -0,0 +1,40 @@
+from lxml import etree
+
+from potstats2 import db, dal
+from potstats2.worldeater.main import thread_from_xml
+
+
+def thread_xml(tid, bid):
+    return etree.fromstring('''
+    <thread id="{tid}">
+        <in-board id="{bid}"/>
+        <title>Thread{tid}</title>
+        <subtitle/>
+        <flags>
+            <is-closed value="0"/>
+            <is-sticky value="0"/>
+            <is-important value="0"/>
+            <is-announcement value="0"/>
+            <is-global value="0"/>
+        </flags>
+        <number-of-hits value="42"/>
+        <number-of-replies value="1"/>
+    </thread>
+    '''.format(tid=tid, bid=bid))
+
+
+def test_thread_moved(session, data):
+    session.add(db.Board(bid=8, cid=5, name='Noch ein Forum'))
+    session.flush()
+
+    thread = thread_from_xml(session, thread_xml(1, 7))
+    assert thread.bid == 7
+    thread = thread_from_xml(session, thread_xml(1, 8))
+    session.flush()
+    assert thread.bid == 8
+    assert session.query(db.Post).get(100).bid == 8
+
+    def board_pids(bid):
+        return [pid for pid, in dal.apply_board_filter(session.query(db.Post.pid), bid)]
+    assert board_pids(8) == [100]
+    assert board_pids(7) == []